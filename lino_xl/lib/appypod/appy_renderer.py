@@ -10,6 +10,9 @@ from __future__ import print_function
 # logger = logging.getLogger(__name__)
 
 import os
+import shutil
+import tempfile
+import uuid
 from copy import copy
 import six
 from io import open
@@ -49,7 +52,13 @@ from lino.utils.html2odf import html2odf, toxml
 from etgen.html import iselement, tostring
 from lino.api import dd
 
-from lino.core.elems import NumberFieldElement
+from lino.core.elems import FieldElement, NumberFieldElement
+
+# element classes whose value2html() just wraps format_value() into a
+# table cell:
+PLAIN_VALUE2HTML = set([
+    six.get_unbound_function(FieldElement.value2html),
+    six.get_unbound_function(NumberFieldElement.value2html)])
 
 
 OAS = '<office:automatic-styles>'
@@ -71,6 +80,50 @@ UL_LIST_STYLE = """\
 """
 
 
+def splice_file(fn, handlers, blocksize=65536):
+    """Rewrite the specified text file `fn` without reading it into
+    memory as a whole.
+
+    `handlers` maps marker strings to functions.  Every occurrence of a
+    marker is replaced by what the corresponding function writes to the
+    output file given as its only argument.  Return a dict mapping
+    every marker to the number of its occurrences.
+
+    """
+    counts = {m: 0 for m in handlers}
+    keep = max([len(m) for m in handlers]) - 1
+    tmp = fn + '.tmp'
+    with open(fn, encoding='utf-8') as src:
+        with open(tmp, 'w', encoding='utf-8') as out:
+            buf = ''
+            eof = False
+            while not eof:
+                block = src.read(blocksize)
+                eof = len(block) == 0
+                buf += block
+                while True:
+                    found = None
+                    for m in handlers:
+                        i = buf.find(m)
+                        if i != -1 and (found is None or i < found[0]):
+                            found = (i, m)
+                    if found is None:
+                        break
+                    i, m = found
+                    out.write(buf[:i])
+                    handlers[m](out)
+                    counts[m] += 1
+                    buf = buf[i + len(m):]
+                if eof:
+                    out.write(buf)
+                elif len(buf) > keep:
+                    # a marker may start in the last `keep` characters
+                    out.write(buf[:len(buf) - keep])
+                    buf = buf[len(buf) - keep:]
+    os.replace(tmp, fn)
+    return counts
+
+
 def cleankw(kw1):
     kw = dict()
     for k, v in kw1.items():
@@ -112,6 +165,9 @@ class AppyRenderer(OriginalAppyRenderer):
         #~ self.my_styles = odf.style.styles()
         self.my_automaticstyles = []
         self.my_styles = []
+        # marker -> name of the temporary file containing the rows of
+        # a table inserted by insert_table()
+        self.table_rows = dict()
 
     def insert_jinja(self, template_name, **kwargs):
 
@@ -191,35 +247,52 @@ class AppyRenderer(OriginalAppyRenderer):
         #~ fn = os.path.join(fn,'content.xml')
         #~ if not self.stylesManager.styles.getStyle('UL'):
             #~ self.insert_chunk(fn,'content.xml',OAS,UL_LIST_STYLE)
-        self.insert_chunk(fn, 'content.xml', OAS, ''.join(
-            [toxml(n) for n in self.my_automaticstyles]))
-        self.insert_chunk(fn, 'styles.xml', OFFICE_STYLES, ''.join(
-            [toxml(n) for n in self.my_styles]))
-
-    def insert_chunk(self, root, leaf, insert_marker, chunk):
+        try:
+            self.insert_chunk(fn, 'content.xml', OAS, ''.join(
+                [toxml(n) for n in self.my_automaticstyles]),
+                self.table_rows)
+            self.insert_chunk(fn, 'styles.xml', OFFICE_STYLES, ''.join(
+                [toxml(n) for n in self.my_styles]))
+        finally:
+            for rows_fn in self.table_rows.values():
+                os.remove(rows_fn)
+            self.table_rows = dict()
+
+    def insert_chunk(self, root, leaf, insert_marker, chunk,
+                     table_rows=None):
         """
         post-process specified xml file by inserting a chunk of XML text
         after the specified insert_marker
+
+        Also replace the markers left by :meth:`insert_table` (given
+        in `table_rows`) by the content of their temporary file.
         """
         #~ insert_marker = insert_marker.encode('utf-8')
         #~ chunk = chunk.encode('utf-8')
         fn = os.path.join(root, leaf)
-        fd = open(fn, encoding='utf-8')
-        s = fd.read()
-        fd.close()
-        chunks = s.split(insert_marker)
-        if len(chunks) != 2:
+
+        def insert(out):
+            out.write(insert_marker)
+            out.write(chunk)
+
+        def copy_rows(rows_fn):
+            def func(out):
+                with open(rows_fn, encoding='utf-8') as f:
+                    shutil.copyfileobj(f, out)
+            return func
+
+        table_rows = table_rows or dict()
+        handlers = {insert_marker: insert}
+        for marker, rows_fn in table_rows.items():
+            handlers[marker] = copy_rows(rows_fn)
+        counts = splice_file(fn, handlers)
+        if counts[insert_marker] != 1:
             raise Exception("%s contains more than one %s element ?!" %
                             (fn, insert_marker))
-        #~ ss = ''.join(self.my_automaticstyles.values())
-        #~ print 20120419, ss
-        s = chunks[0] + insert_marker + chunk + chunks[1]
-        #~ fd = open('tmp.xml',"w")
-        fd = open(fn, "w",encoding='utf-8')
-        #~ fd.write(s)
-        fd.write(s)
-        fd.close()
-        #~ raise Exception(fn)
+        for marker in table_rows.keys():
+            if counts[marker] != 1:
+                raise Exception("%s contains %d times the rows marker %s" %
+                                (fn, counts[marker], marker))
 
     def add_style(self, name, **kw):
         kw.update(name=name)
@@ -418,6 +491,10 @@ class AppyRenderer(OriginalAppyRenderer):
                 return "Number Cell"
             return "Table Contents"
 
+        def is_plain(fld):
+            return six.get_unbound_function(
+                fld.__class__.value2html) in PLAIN_VALUE2HTML
+
         def value2cell(ar, i, fld, val, style_name, tc):
             # if i == 0:
             #     logger.info("20160330a value2cell(%s, %s)", fld.__class__, val)
@@ -452,58 +529,96 @@ class AppyRenderer(OriginalAppyRenderer):
             hr.addElement(tc)
 
         sums = [fld.zero for fld in columns]
-
-        for row in ar.data_iterator:
-            #~ for grp in ar.group_headers(row):
-                #~ raise NotImplementedError()
-            tr = TableRow()
-
-            has_numeric_value = False
-
-            for i, fld in enumerate(columns):
-
-                #~ tc = TableCell(stylename=CELL_STYLE_NAME)
-                tc = TableCell(stylename=cell_style)
-                #~ if fld.field is not None:
-                v = fld.field._lino_atomizer.full_value_from_object(row, ar)
-                stylename = fldstyle(fld)
-                if v is None:
-                    tc.addElement(text.P(stylename=stylename, text=''))
-                else:
-                    value2cell(ar, i, fld, v, stylename, tc)
-
-                    nv = fld.value2num(v)
-                    if nv != 0:
-                        sums[i] += nv
-                        has_numeric_value = True
-                    #~ sums[i] += fld.value2num(v)
-                tr.addElement(tc)
-
-            if has_numeric_value or not ar.actor.hide_zero_rows:
-                table_rows.addElement(tr)
-
-        if not ar.actor.hide_sums:
-            if sums != [fld.zero for fld in columns]:
-                tr = TableRow(stylename=total_row_style)
-                table_rows.addElement(tr)
-                sums = {fld.name: sums[i] for i, fld in enumerate(columns)}
-                for i, fld in enumerate(columns):
-                    tc = TableCell(stylename=cell_style)
-                    stylename = fldstyle(fld)
-                    p = text.P(stylename=stylename)
-                    e = fld.format_sum(ar, sums, i)
-                    html2odf(e, p)
-                    tc.addElement(p)
-                    #~ if len(txt) != 0:
-                        #~ msg = "html2odf() returned "
-                        #~ logger.warning(msg)
-                    #~ txt = tuple(html2odf(fld.format_sum(ar,sums,i),p))
-                    #~ assert len(txt) == 1
-                    #~ tc.addElement(text.P(stylename=stylename,text=txt[0]))
-                    tr.addElement(tc)
-
-        doc.text.addElement(table)
-        return toxml(table)
+        stylenames = [fldstyle(fld) for fld in columns]
+        plain = [is_plain(fld) for fld in columns]
+
+        # The data rows are not added to the table but serialized one
+        # by one into a temporary file, so that we never hold the tree
+        # of more than one row in memory.  The returned table contains
+        # a marker which finalize_func() replaces by the content of
+        # that file.
+        marker = 'lino-table-rows-' + uuid.uuid4().hex
+        fd, rows_fn = tempfile.mkstemp(suffix='.xml', prefix='lino-rows-')
+        os.close(fd)
+        self.table_rows[marker] = rows_fn
+        try:
+            with open(rows_fn, 'w', encoding='utf-8') as rows_xml:
+                for row in ar.data_iterator:
+                    #~ for grp in ar.group_headers(row):
+                        #~ raise NotImplementedError()
+                    tr = TableRow()
+
+                    has_numeric_value = False
+
+                    for i, fld in enumerate(columns):
+
+                        #~ tc = TableCell(stylename=CELL_STYLE_NAME)
+                        tc = TableCell(stylename=cell_style)
+                        #~ if fld.field is not None:
+                        v = fld.field._lino_atomizer.full_value_from_object(
+                            row, ar)
+                        stylename = stylenames[i]
+                        if v is None:
+                            tc.addElement(text.P(stylename=stylename, text=''))
+                        else:
+                            txt = None
+                            if plain[i]:
+                                # plain text and numbers don't need the
+                                # roundtrip through html
+                                txt = fld.format_value(ar, v)
+                                if not isinstance(txt, six.string_types):
+                                    txt = None
+                            if txt is None:
+                                value2cell(ar, i, fld, v, stylename, tc)
+                            else:
+                                tc.addElement(text.P(stylename=stylename, text=txt))
+
+                            nv = fld.value2num(v)
+                            if nv != 0:
+                                sums[i] += nv
+                                has_numeric_value = True
+                            #~ sums[i] += fld.value2num(v)
+                        tr.addElement(tc)
+
+                    if has_numeric_value or not ar.actor.hide_zero_rows:
+                        tr.toXml(1, rows_xml)
+
+                if not ar.actor.hide_sums:
+                    if sums != [fld.zero for fld in columns]:
+                        tr = TableRow(stylename=total_row_style)
+                        sums = {fld.name: sums[i]
+                                for i, fld in enumerate(columns)}
+                        for i, fld in enumerate(columns):
+                            tc = TableCell(stylename=cell_style)
+                            stylename = fldstyle(fld)
+                            p = text.P(stylename=stylename)
+                            e = fld.format_sum(ar, sums, i)
+                            html2odf(e, p)
+                            tc.addElement(p)
+                            #~ if len(txt) != 0:
+                                #~ msg = "html2odf() returned "
+                                #~ logger.warning(msg)
+                            #~ txt = tuple(html2odf(fld.format_sum(ar,sums,i),p))
+                            #~ assert len(txt) == 1
+                            #~ tc.addElement(text.P(stylename=stylename,text=txt[0]))
+                            tr.addElement(tc)
+                        tr.toXml(1, rows_xml)
+
+            doc.text.addElement(table)
+            # Serialize the table only now because odfpy declares the
+            # namespaces used by all elements on the root element.
+            empty = '<{}/>'.format(table_rows.tagName)
+            xml = toxml(table)
+            if xml.count(empty) != 1:
+                raise Exception(
+                    "Serialized table contains {} times {}".format(
+                        xml.count(empty), empty))
+            return xml.replace(empty, '<{0}>{1}</{0}>'.format(
+                table_rows.tagName, marker))
+        except Exception:
+            del self.table_rows[marker]
+            os.remove(rows_fn)
+            raise
         #~ if output_file:
             # ~ doc.save(output_file) # , True)
         #~ return doc
@@ -12,6 +12,7 @@ from a bank.  See :doc:`/specs/b2c`.
     camt
     febelfin
     fixtures.demo
+    management.commands.benchmark_camt
 
 """
 
@@ -47,6 +48,14 @@ class Plugin(ad.Plugin):
 
     """
 
+    import_workers = 0
+    """The number of worker processes to use for parsing the XML files
+    in parallel.  Zero means that every file is parsed right before
+    being imported.  Otherwise at most this number of parsed files are
+    held in memory at a time.
+
+    """
+
     def setup_main_menu(self, site, user_type, m):
         mg = site.plugins.ledger
         m = m.add_menu(mg.app_label, mg.verbose_name)
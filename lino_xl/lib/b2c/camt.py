@@ -319,6 +319,12 @@ class CamtParser(object):
 
     def check_version(self, ns, root):
         """Validate validity of camt file."""
+        self.check_namespace(ns)
+        # Check GrpHdr element:
+        self.check_group_header(ns, root[0][0])
+
+    def check_namespace(self, ns):
+        """Check whether the given namespace is camt 052 or 053."""
         # Check wether it is camt at all:
         re_camt = re.compile(
             r'(^urn:iso:std:iso:20022:tech:xsd:camt.'
@@ -335,8 +341,9 @@ class CamtParser(object):
         )
         if not re_camt_version.search(ns):
             raise ValueError('no camt 052 or 053: ' + ns)
-        # Check GrpHdr element:
-        root_0_0 = root[0][0].tag[len(ns) + 2:]  # strip namespace
+
+    def check_group_header(self, ns, node):
+        root_0_0 = node.tag[len(ns) + 2:]  # strip namespace
         if root_0_0 != 'GrpHdr':
             raise ValueError('expected GrpHdr, got: ' + root_0_0)
 
@@ -358,3 +365,57 @@ class CamtParser(object):
             statement = self.parse_statement(ns, node)
             if len(statement.transactions):
                 yield statement
+
+    def iterparse(self, source):
+        """Parse a camt.052 or camt.053 file incrementally.
+
+        `source` is a filename or a file object.  Same as
+        :meth:`parse`, but yields every statement as soon as its
+        ``<Stmt>`` element has been read and then discards that
+        element, so that memory usage doesn't grow with the size of
+        the file.
+
+        Falls back to :meth:`parse` when the file is not well-formed
+        XML (e.g. because of mixed-up encodings) and no statement has
+        been yielded yet.
+
+        """
+        depth = 0
+        ns = None
+        count = 0  # number of report children (GrpHdr, Stmt) seen
+        yielded = False
+        try:
+            for event, elem in etree.iterparse(
+                    source, events=('start', 'end'),
+                    recover=True, huge_tree=True):
+                if event == 'start':
+                    depth += 1
+                    if depth == 1:
+                        ns = elem.tag[1:elem.tag.index("}")]
+                        self.check_namespace(ns)
+                    elif depth == 3 and count == 0:
+                        self.check_group_header(ns, elem)
+                    continue
+                depth -= 1
+                if depth == 2:
+                    count += 1
+                    if count > 1:
+                        statement = self.parse_statement(ns, elem)
+                        if len(statement.transactions):
+                            yielded = True
+                            yield statement
+                    # free the memory of the processed element and of
+                    # its preceding siblings
+                    elem.clear()
+                    while elem.getprevious() is not None:
+                        del elem.getparent()[0]
+        except etree.XMLSyntaxError:
+            if yielded or not isinstance(source, str):
+                raise
+            with open(source, 'rb') as f:
+                data = f.read()
+            for statement in self.parse(data):
+                yield statement
+        if ns is None:
+            raise IOError(
+                'Not a valid xml file, or not an xml file at all.')
@@ -0,0 +1,145 @@
+# -*- coding: UTF-8 -*-
+# Copyright 2020 Rumma & Ko Ltd
+# License: BSD (see file COPYING for details)
+
+"""Defines the :manage:`benchmark_camt` admin command:
+
+.. management_command:: benchmark_camt
+
+.. py2rst::
+
+  from lino_xl.lib.b2c.management.commands.benchmark_camt \
+      import Command
+  print(Command.help)
+
+
+"""
+
+from __future__ import unicode_literals, print_function
+
+import os
+import time
+import resource
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+
+from django.core.management.base import BaseCommand
+
+from lino.api import dd
+
+from lino_xl.lib.b2c.camt import CamtParser
+
+HEADER = """<?xml version="1.0" encoding="UTF-8"?>
+<Document xmlns="urn:iso:std:iso:20022:tech:xsd:camt.053.001.02">
+<BkToCstmrStmt><GrpHdr><MsgId>BENCHMARK</MsgId>
+<CreDtTm>2020-01-31T19:49:37</CreDtTm></GrpHdr>
+"""
+
+STATEMENT_HEAD = """<Stmt><Id>BENCHMARK-{0}</Id><ElctrncSeqNb>{0}</ElctrncSeqNb>
+<Acct><Id><IBAN>BE79063548638133</IBAN></Id><Ccy>EUR</Ccy>
+<Ownr><Nm>Rumma &amp; Ko OÜ</Nm></Ownr></Acct>
+<Bal><Tp><CdOrPrtry><Cd>OPBD</Cd></CdOrPrtry></Tp>
+<Amt Ccy="EUR">1000.00</Amt><CdtDbtInd>CRDT</CdtDbtInd>
+<Dt><Dt>2020-01-01</Dt></Dt></Bal>
+<Bal><Tp><CdOrPrtry><Cd>CLBD</Cd></CdOrPrtry></Tp>
+<Amt Ccy="EUR">1000.00</Amt><CdtDbtInd>CRDT</CdtDbtInd>
+<Dt><Dt>2020-01-31</Dt></Dt></Bal>
+"""
+
+ENTRY = """<Ntry><Amt Ccy="EUR">{1}.00</Amt><CdtDbtInd>CRDT</CdtDbtInd>
+<BookgDt><Dt>2020-01-15</Dt></BookgDt><ValDt><Dt>2020-01-15</Dt></ValDt>
+<BkTxCd><Prtry><Cd>01500000</Cd><Issr>BBA</Issr></Prtry></BkTxCd>
+<NtryDtls><TxDtls><Refs><EndToEndId>E2E-{0}-{1}</EndToEndId></Refs>
+<RltdPties><Dbtr><Nm>Customer {1}</Nm>
+<PstlAdr><AdrLine>Street {1}</AdrLine><AdrLine>4700 Eupen</AdrLine></PstlAdr>
+</Dbtr><DbtrAcct><Id><IBAN>BE83540256917919</IBAN></Id></DbtrAcct></RltdPties>
+<RltdAgts><DbtrAgt><FinInstnId><BIC>BBRUBEBB</BIC></FinInstnId></DbtrAgt></RltdAgts>
+<RmtInf><Ustrd>Invoice {0}/{1}</Ustrd></RmtInf></TxDtls></NtryDtls></Ntry>
+"""
+
+FOOTER = "</BkToCstmrStmt></Document>\n"
+
+
+def write_camt_file(f, statements, entries):
+    f.write(HEADER.encode('utf-8'))
+    for i in range(statements):
+        f.write(STATEMENT_HEAD.format(i + 1).encode('utf-8'))
+        for j in range(entries):
+            f.write(ENTRY.format(i + 1, j + 1).encode('utf-8'))
+        f.write(b"</Stmt>\n")
+    f.write(FOOTER.encode('utf-8'))
+
+
+def parse_full(fn):
+    with open(fn, 'rb') as f:
+        data = f.read()
+    return CamtParser().parse(data)
+
+
+def parse_streaming(fn):
+    return CamtParser().iterparse(fn)
+
+
+def measure(func, fn):
+    # Runs in a fresh worker process.  We use the maximum resident set
+    # size because most of the memory is allocated by libxml2 and
+    # thus invisible to tracemalloc.
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    t0 = time.time()
+    count = 0
+    for stmt in func(fn):
+        count += 1
+    seconds = time.time() - t0
+    after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return count, (after - before) * 1024, seconds
+
+
+def benchmark_camt(statements, entries):
+    """Called by :manage:`benchmark_camt`. See there."""
+    fd, fn = tempfile.mkstemp(suffix='.xml')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            write_camt_file(f, statements, entries)
+        size = os.path.getsize(fn)
+        dd.logger.info("Generated %s with %d statements of %d entries "
+                       "(%d bytes).", fn, statements, entries, size)
+
+        for name, func in (('parse', parse_full),
+                           ('iterparse', parse_streaming)):
+            with ProcessPoolExecutor(1) as executor:
+                count, peak, seconds = executor.submit(
+                    measure, func, fn).result()
+            dd.logger.info(
+                "%s(): %d statements in %.3f seconds, "
+                "peak memory %d bytes (%.2f x file size)",
+                name, count, seconds, peak, float(peak) / size)
+    finally:
+        os.remove(fn)
+
+
+class Command(BaseCommand):
+    help = """
+
+    Compare the peak memory usage of the full and the incremental camt
+    parser.
+
+    Generates a temporary camt.053 file with the given number of
+    statements and entries per statement, parses it once using
+    :meth:`CamtParser.parse` and once using
+    :meth:`CamtParser.iterparse` and reports the time and the peak
+    memory used by each of them (measured as the growth of the
+    maximum resident set size of a fresh process) relative to the size
+    of the file.
+
+    """
+
+    def add_arguments(self, parser):
+        parser.add_argument('-s', '--statements', type=int,
+                            dest='statements', default=100,
+                            help='Number of statements to generate.')
+        parser.add_argument('-e', '--entries', type=int,
+                            dest='entries', default=1000,
+                            help='Number of entries per statement.')
+
+    def handle(self, *args, **options):
+        benchmark_camt(options['statements'], options['entries'])
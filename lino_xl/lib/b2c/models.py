@@ -7,7 +7,8 @@ import glob
 import os
 
 from django.db import models
-from django.core.exceptions import MultipleObjectsReturned, ValidationError
+from django.db import transaction
+from django.core.exceptions import ValidationError
 from django.utils import translation
 from django.utils.encoding import force_text
 from lino.api import dd, _, rt
@@ -20,10 +21,97 @@ from .febelfin import code2desc
 
 
 
+def stmt2data(stmt):
+    """Convert a statement returned by the camt parser into a compact
+    dict of plain values.
+
+    Return `None` when the statement cannot be imported (after logging
+    the reason).
+
+    """
+    iban = stmt.local_account
+    if iban is None:
+        dd.logger.warning("Statement %s has no IBAN", stmt)
+        return
+    try:
+        unique_id = stmt.unique_id
+    except Exception as e:
+        dd.logger.warning("Statement %s : %s", stmt, e)
+        return
+    transactions = []
+    for mvmt in stmt.transactions:
+        transactions.append(dict(
+            seqno=mvmt.seqno,
+            value_date=mvmt.value_date,
+            booking_date=mvmt.booking_date,
+            amount=mvmt.transferred_amount,
+            # partner_name=mvmt.remote_owner or '',
+            remote_account=mvmt.remote_account_iban or
+            mvmt.remote_account_other or '',
+            remote_bic=mvmt.remote_bank_bic or '',
+            message=mvmt.message or '',
+            eref=mvmt.eref or '',
+            remote_owner=mvmt.remote_owner or '',
+            remote_owner_city=mvmt.remote_owner_city or '',
+            remote_owner_postalcode=mvmt.remote_owner_postalcode or '',
+            remote_owner_country_code=mvmt.remote_owner_country_code or '',
+            txcd=mvmt.txcd,
+            txcd_issuer=mvmt.txcd_issuer,
+            remote_owner_address=mvmt.remote_owner_address))
+    return dict(
+        name=str(stmt),
+        iban=iban,
+        unique_id=unique_id,
+        owner_name=stmt.owner_name,
+        account_name=stmt.account_name,
+        statement=dict(
+            start_date=stmt.start_date,
+            end_date=stmt.end_date,
+            balance_end=stmt.end_balance,
+            balance_start=stmt.start_balance,
+            local_currency=stmt.local_currency),
+        transactions=transactions)
+
+
+def iter_statements(filename):
+    """Parse the given camt file and yield its statements one by one, as
+    returned by :func:`stmt2data`.  Invalid statements are yielded as
+    `None`.
+
+    """
+    for stmt in CamtParser().iterparse(filename):
+        yield stmt2data(stmt)
+
+
+def parse_file(filename):
+    """Parse the given camt file and return the list of its statements,
+    as returned by :func:`stmt2data`.
+
+    This is pure lxml work and does not touch the database, so
+    :class:`ImportStatements` can run it in worker processes.  The
+    compact statements are cheaper to send back than the parser's
+    objects.
+
+    """
+    return list(iter_statements(filename))
+
+
+def iter_chunks(iterable, size):
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
 class ImportStatements(dd.Action):
     label = _("Import SEPA")
     http_method = 'POST'
     select_rows = False
+    chunk_size = 100
 
     def get_view_permission(self, user_type):
         if not dd.plugins.b2c.import_statements_path:
@@ -43,8 +131,27 @@ class ImportStatements(dd.Action):
         self.imported_files = 0
         dd.logger.info("Importing all XML files from %s...", pth)
         wc = os.path.join(pth, '*.[Xx][Mm][Ll]')
-        for filename in glob.iglob(wc):
-            self.import_file(ar, filename)
+        filenames = list(glob.iglob(wc))
+        workers = dd.plugins.b2c.import_workers
+        if workers and len(filenames) > 1:
+            # parse the files in parallel, but import them one after
+            # the other and in the same order.  Keep at most `workers`
+            # files in flight so that the parsed statements waiting to
+            # be imported don't fill the memory.
+            from concurrent.futures import ProcessPoolExecutor
+            pending = list(filenames)
+            futures = []
+            with ProcessPoolExecutor(workers) as executor:
+                while pending or futures:
+                    while pending and len(futures) < workers:
+                        filename = pending.pop(0)
+                        futures.append(
+                            (filename, executor.submit(parse_file, filename)))
+                    filename, future = futures.pop(0)
+                    self.import_file(ar, filename, future.result())
+        else:
+            for filename in filenames:
+                self.import_file(ar, filename)
 
         msg = "{0} XML files with {1} new and {2} updated " \
               "statements have been imported."
@@ -53,145 +160,195 @@ class ImportStatements(dd.Action):
         dd.logger.info(msg)
         return ar.success(msg, alert=_("Success"))
 
-    def import_file(self, ar, filename):
+    def import_file(self, ar, filename, statements=None):
+        """Import the given file.  `statements` is the result of
+        :func:`parse_file` if the file has already been parsed.
+        Otherwise the file is parsed while being imported, so that
+        only :attr:`chunk_size` statements are held in memory.
+
+        Statements are imported in chunks of :attr:`chunk_size`
+        statements (see :meth:`import_statements`).  All changes to a
+        file are written within a single database transaction.
+
+        """
         dd.logger.info("Importing file %s ...", filename)
-        Account = rt.models.b2c.Account
-        parser = CamtParser()
-        data_file = open(filename, 'rb').read()
+        if statements is None:
+            statements = iter_statements(filename)
         # imported_statements = 0
         self.imported_files += 1
         failed_statements = 0
-        for stmt in parser.parse(data_file):
-            iban = stmt.local_account
-            if iban is None:
-                dd.logger.warning("Statement %s has no IBAN", stmt)
-                failed_statements += 1
-                continue
+        accounts = dict()
+        changed_accounts = []
+        with transaction.atomic():
+            for chunk in iter_chunks(statements, self.chunk_size):
+                failed_statements += self.import_statements(
+                    chunk, accounts, changed_accounts)
+            for account in changed_accounts:
+                account.save()
+
+        if failed_statements > 0:
+            dd.logger.warning(
+                "%d statements were NOT imported from %s",
+                failed_statements, filename)
+            self.failed_statements += failed_statements
+        elif dd.plugins.b2c.delete_imported_xml_files:
+            # Delete imported file if there were no errors
             try:
-                unique_id = stmt.unique_id
-            except Exception as e:
-                dd.logger.warning("Statement %s : %s", stmt, e)
+                os.remove(filename)
+            except OSError as err:
+                dd.logger.warning("Failed to delete %s : %s", filename, err)
+            else:
+                dd.logger.info("The file %s has been deleted.", filename)
+        else:
+            dd.logger.info("File %s was imported but NOT deleted.", filename)
+
+    def import_statements(self, statements, accounts, changed_accounts):
+        """Import the given list of statements (as returned by
+        :func:`stmt2data`) and return the number of failed statements.
+
+        Existing accounts, statements and transactions are loaded with
+        one query each, and the changes are written in bulk.
+        `accounts` maps IBANs to the accounts known so far.  Accounts
+        whose `last_transaction` changed are added to
+        `changed_accounts` and saved by the caller.
+
+        """
+        Account = rt.models.b2c.Account
+        failed_statements = 0
+
+        # the foreign keys are known to be valid, validating them
+        # would cost one query per object
+        st_exclude = ['account']
+        tr_exclude = ['statement']
+
+        candidates = []
+        for stmt in statements:
+            if stmt is None:
                 failed_statements += 1
-                continue
+            else:
+                candidates.append(stmt)
+
+        missing = set([stmt['iban'] for stmt in candidates]) \
+            - set(accounts.keys())
+        if missing:
+            accounts.update(Account.objects.in_bulk(
+                missing, field_name='iban'))
+        existing_statements = dict()
+        qs = Statement.objects.filter(
+            account__iban__in=set([stmt['iban'] for stmt in candidates]),
+            statement_number__in=set([
+                stmt['unique_id'] for stmt in candidates]))
+        for s in qs:
+            existing_statements[(s.account_id, s.statement_number)] = s
+        existing_transactions = dict()
+        qs = Transaction.objects.filter(
+            statement__in=list(existing_statements.values()))
+        for m in qs:
+            existing_transactions[(m.statement_id, m.seqno)] = m
+
+        statements_to_update = []
+        transactions_to_create = []
+        transactions_to_save = []
+        for stmt in candidates:
+            iban = stmt['iban']
+            unique_id = stmt['unique_id']
 
             # get or create the Account
-            key = dict(iban=iban)
             data = dict(
-                owner_name=stmt.owner_name,
-                account_name=stmt.account_name)
-            try:
-                account = Account.objects.get(**key)
+                owner_name=stmt['owner_name'],
+                account_name=stmt['account_name'])
+            account = accounts.get(iban)
+            if account is None:
+                account = Account(iban=iban, **data)
+                account.full_clean()
+                account.save()
+                accounts[iban] = account
+            else:
                 for k, v in data.items():
                     if v:
                         setattr(account, k, v)
-            except Account.DoesNotExist:
-                key.update(data)
-                account = Account(**key)
-                account.full_clean()
-                account.save()
-            except MultipleObjectsReturned:
-                dd.logger.warning(
-                    "Found more than one account with IBAN %s", iban)
-                failed_statements += 1
-                continue
 
             # get or create the Statement
-            key = dict(account=account, statement_number=unique_id)
-            data = dict(
-                start_date=stmt.start_date,
-                end_date=stmt.end_date,
-                balance_end=stmt.end_balance,
-                balance_start=stmt.start_balance,
-                local_currency=stmt.local_currency)
-
-            try:
-                s = Statement.objects.get(**key)
+            data = stmt['statement']
+            s = existing_statements.get((account.pk, unique_id))
+            if s is None:
+                s = Statement(
+                    account=account, statement_number=unique_id, **data)
+                transactions_to_update = False
+            else:
                 for k, v in data.items():
                     setattr(s, k, v)
                 transactions_to_update = True
-                self.updated_statements += 1
-            except Statement.DoesNotExist:
-                data.update(key)
-                s = Statement(**data)
-                self.new_statements += 1
-                transactions_to_update = False
             try:
-                s.full_clean()
-                s.save()
+                s.full_clean(exclude=st_exclude)
             except ValidationError as e:
-                dd.logger.warning("Failed to save statement %s : %s", s, e)
+                dd.logger.warning(
+                    "Failed to save statement %s : %s", s, e)
                 failed_statements += 1
                 continue
+            if transactions_to_update:
+                statements_to_update.append(s)
+                self.updated_statements += 1
+            else:
+                # new statements are saved right now because their
+                # transactions need the primary key
+                s.save()
+                existing_statements[(account.pk, unique_id)] = s
+                self.new_statements += 1
 
             last_transaction = ''
-            for mvmt in stmt.transactions:
-                last_transaction = max(last_transaction, mvmt.value_date)
-                key = dict(statement=s, seqno=mvmt.seqno)
-                data = dict(
-                    value_date=mvmt.value_date,
-                    booking_date=mvmt.booking_date,
-                    amount=mvmt.transferred_amount,
-                    # partner_name=mvmt.remote_owner or '',
-                    remote_account=mvmt.remote_account_iban or
-                    mvmt.remote_account_other or '',
-                    remote_bic=mvmt.remote_bank_bic or '',
-                    message=mvmt.message or '',
-                    eref=mvmt.eref or '',
-                    remote_owner=mvmt.remote_owner or '',
-                    remote_owner_city=mvmt.remote_owner_city or '',
-                    remote_owner_postalcode=mvmt.remote_owner_postalcode or '',
-                    remote_owner_country_code=mvmt.remote_owner_country_code or '',
-                    txcd=mvmt.txcd,
-                    txcd_issuer=mvmt.txcd_issuer)
-                data.update(
-                    remote_owner_address=mvmt.remote_owner_address)
-
-                try:
-                    m = Transaction.objects.get(**key)
-                    if m.statement != s:
-                        raise Exception(
-                            "Invalid transaction: statement %s != %s" % (
-                                m.statement, s))
+            for data in stmt['transactions']:
+                data = dict(data)
+                seqno = data.pop('seqno')
+                last_transaction = max(last_transaction, data['value_date'])
+                key = (s.pk, seqno)
+                m = existing_transactions.get(key)
+                if m is None:
+                    m = Transaction(statement=s, seqno=seqno, **data)
+                    existing_transactions[key] = m
+                    lst = transactions_to_create
+                else:
                     if not transactions_to_update:
                         dd.logger.warning(
-                            "Existing transaction in a new statement?! %s",
-                            mvmt)
-
+                            "Existing transaction in a new statement?! "
+                            "%s #%s", stmt['name'], seqno)
                     for k, v in data.items():
-                        setattr(s, k, v)
-                except Transaction.DoesNotExist:
-                    data.update(key)
-                    m = Transaction(**data)
+                        setattr(m, k, v)
+                    if m.pk is None:
+                        # created earlier in this same chunk
+                        lst = None
+                    else:
+                        lst = transactions_to_save
 
                 try:
-                    m.full_clean()
-                    m.save()
+                    m.full_clean(exclude=tr_exclude)
                 except ValidationError as e:
                     dd.logger.warning(
                         "Failed to save transaction %s : %s", s, e)
                     break
+                if lst is not None:
+                    lst.append(m)
 
             if account.last_transaction != last_transaction:
                 account.last_transaction = last_transaction
                 account.full_clean()
-                account.save()
-
-        if failed_statements > 0:
-            dd.logger.warning(
-                "%d statements were NOT imported from %s",
-                failed_statements, filename)
-            self.failed_statements += failed_statements
-        elif dd.plugins.b2c.delete_imported_xml_files:
-            # Delete imported file if there were no errors
-            try:
-                os.remove(filename)
-            except OSError as err:
-                dd.logger.warning("Failed to delete %s : %s", filename, err)
-            else:
-                dd.logger.info("The file %s has been deleted.", filename)
-        else:
-            dd.logger.info("File %s was imported but NOT deleted.", filename)
-
+                if account not in changed_accounts:
+                    changed_accounts.append(account)
+
+        if statements_to_update:
+            Statement.objects.bulk_update(
+                statements_to_update,
+                ['start_date', 'end_date', 'balance_end',
+                 'balance_start', 'local_currency'])
+        if transactions_to_save:
+            Transaction.objects.bulk_update(
+                transactions_to_save,
+                [f.name for f in Transaction._meta.concrete_fields
+                 if not f.primary_key and f.name not in (
+                         'statement', 'seqno')])
+        if transactions_to_create:
+            Transaction.objects.bulk_create(transactions_to_create)
+        return failed_statements
 
 dd.inject_action('system.SiteConfig', import_b2c=ImportStatements())
 
@@ -31,6 +31,12 @@ class Plugin(ad.Plugin):
     demo_absences = True
     """Whether to generate absences in demo calendar."""
 
+    bulk_auto_events = False
+    """Whether :meth:`update_auto_events
+    <lino_xl.lib.cal.EventGenerator.update_auto_events>` should apply its
+    changes using bulk queries instead of saving every entry
+    individually."""
+
     def on_init(self):
         tod = self.site.today()
         # self.ignore_dates_after = tod.replace(year=tod.year+5, day=28)
@@ -10,6 +10,7 @@ from dateutil.rrule import rrule
 
 from django.conf import settings
 from django.db import models
+from django.db import transaction
 from django.utils import translation
 from django.utils.translation import ugettext_lazy as _
 from django.utils.translation import ugettext as gettext
@@ -119,6 +120,220 @@ class UpdateEntriesByEvent(UpdateEntries):
         return obj.owner.update_reminders(ar)
 
 
+class ConflictIndex(object):
+    """An in-memory index of the calendar entries that can conflict with
+    the entries generated by a given :class:`EventGenerator` within a
+    given date range.
+
+    Only entries that can actually conflict with a generated entry are
+    loaded: those of an all-rooms entry type (e.g. holidays), those of
+    the generator itself and those in the room of a generated entry.
+    When the entry type of the generator locks the user, only the
+    locking entries of that user can conflict.  Entries are loaded with
+    one query for the generator, plus one query per room.  Only when
+    the generator's entry type locks all rooms, all entries of the
+    range must be loaded.
+
+    The index then answers the same question as
+    :meth:`Event.get_conflicting_events
+    <lino_xl.lib.cal.Event.get_conflicting_events>` and
+    :meth:`Event.has_conflicting_events
+    <lino_xl.lib.cal.Event.has_conflicting_events>` without hitting
+    the database.
+
+    """
+
+    def __init__(self, start_date, end_date, owner, user=None,
+                 event_type=None):
+        self.start_date = start_date
+        self.end_date = end_date
+        self.owner_type = ContentType.objects.get_for_model(owner.__class__)
+        self.owner_id = owner.pk
+        self.user_id = None if user is None else user.pk
+        self.event_type_id = None if event_type is None else event_type.pk
+        self.locks_user = user is not None and event_type is not None \
+            and event_type.locks_user
+        self.by_room = dict()  # (date, room_id) -> entries in that room
+        self.all_rooms = dict()  # date -> entries locking all rooms
+        self.owned = dict()  # date -> entries of the generator
+        self.rooms = set()  # ids of the rooms loaded so far
+        self.seen = set()  # ids of the entries loaded so far
+        # An entry without room of an all-rooms type conflicts with
+        # entries in any room.
+        self.everything = event_type is not None and event_type.all_rooms
+        self.by_date = dict()  # date -> all entries (only if everything)
+        if self.everything:
+            self.load(models.Q())
+        else:
+            self.load(models.Q(event_type__all_rooms=True) | models.Q(
+                owner_type=self.owner_type, owner_id=self.owner_id))
+
+    def load(self, flt):
+        qs = rt.models.cal.Event.objects.filter(flt, transparent=False)
+        qs = qs.exclude(event_type__transparent=True)
+        if self.locks_user:
+            qs = qs.filter(user_id=self.user_id, event_type__locks_user=True)
+        period = models.Q(
+            end_date__isnull=True, start_date__gte=self.start_date,
+            start_date__lte=self.end_date)
+        period |= models.Q(
+            end_date__isnull=False, start_date__lte=self.end_date,
+            end_date__gte=self.start_date)
+        for e in qs.filter(period).select_related('event_type'):
+            if e.pk not in self.seen:
+                self.seen.add(e.pk)
+                self.add(e)
+
+    def load_room(self, room_id):
+        if room_id not in self.rooms:
+            self.rooms.add(room_id)
+            self.load(models.Q(room_id=room_id))
+
+    def get_dates(self, e):
+        if e.end_date is None:
+            yield e.start_date
+            return
+        # a multi-day entry is indexed under every day of the range
+        d = max(e.start_date, self.start_date)
+        end = min(e.end_date, self.end_date)
+        while d <= end:
+            yield d
+            d += ONE_DAY
+
+    def is_owned(self, e):
+        return e.owner_id == self.owner_id \
+            and e.owner_type_id == self.owner_type.pk
+
+    def add(self, e):
+        """Add the given entry to the index."""
+        if e.transparent:
+            return
+        if e.event_type is not None and e.event_type.transparent:
+            return
+        all_rooms = e.event_type is not None and e.event_type.all_rooms
+        owned = self.is_owned(e)
+        for d in self.get_dates(e):
+            if self.everything:
+                self.by_date.setdefault(d, []).append(e)
+            if all_rooms:
+                self.all_rooms.setdefault(d, []).append(e)
+            if owned:
+                self.owned.setdefault(d, []).append(e)
+            if e.room_id is not None:
+                self.by_room.setdefault((d, e.room_id), []).append(e)
+
+    def get_candidates(self, we):
+        d = we.start_date
+        if we.room_id is None and self.everything:
+            return self.by_date.get(d, [])
+        lst = list(self.all_rooms.get(d, []))
+        if we.room_id is None:
+            lst += self.owned.get(d, [])
+        else:
+            self.load_room(we.room_id)
+            lst += self.by_room.get((d, we.room_id), [])
+        # an entry may be in several lists
+        seen = set()
+        rv = []
+        for e in lst:
+            if id(e) not in seen:
+                seen.add(id(e))
+                rv.append(e)
+        return rv
+
+    def get_conflicting_events(self, we):
+        """Return a list of the entries that conflict with the given entry
+        `we`, or `None` if `we` cannot have any conflicts."""
+        if we.transparent:
+            return
+        ntstates = EntryStates.filter(transparent=False)
+        if we.owner_id is None and we.state.transparent:
+            return
+
+        def same_owner(e):
+            return e.owner_id == we.owner_id \
+                and e.owner_type_id == we.owner_type_id
+
+        def all_rooms(e):
+            return e.event_type is not None and e.event_type.all_rooms
+
+        if we.owner_id != self.owner_id \
+           or (we.owner_id is not None
+               and we.owner_type_id != self.owner_type.pk) \
+           or we.event_type_id != self.event_type_id \
+           or (we.user_id != self.user_id and self.locks_user) \
+           or we.start_date < self.start_date \
+           or (we.end_date or we.start_date) > self.end_date:
+            # not an entry of our generator
+            qs = we.get_conflicting_events()
+            return None if qs is None else list(qs)
+        end_date = we.end_date or we.start_date
+        check_times = end_date == we.start_date \
+            and we.start_time and we.end_time
+        lst = []
+        for e in self.get_candidates(we):
+            if e.end_date is None:
+                if e.start_date != we.start_date:
+                    continue
+            elif e.start_date > we.start_date or e.end_date < end_date:
+                continue
+            if check_times:
+                if e.start_time is None and e.end_time is None:
+                    pass
+                elif e.start_time is None or e.end_time is None:
+                    continue
+                elif not ((e.start_time <= we.start_time
+                           and e.end_time > we.start_time) or
+                          (e.end_time >= we.end_time
+                           and e.start_time < we.end_time)):
+                    continue
+            if we.id is not None and e.id == we.id:
+                continue
+            if we.auto_type and e.auto_type is not None and same_owner(e):
+                continue
+            if we.owner_id is None:
+                if e.state not in ntstates:
+                    continue
+            elif we.state.transparent:
+                if not same_owner(e):
+                    continue
+            elif e.state not in ntstates and not same_owner(e):
+                continue
+            if we.room is None:
+                if we.event_type is None or not we.event_type.all_rooms:
+                    if we.owner_id is None:
+                        if not all_rooms(e):
+                            continue
+                    elif not (all_rooms(e) or same_owner(e)):
+                        continue
+            elif e.room_id != we.room_id and not all_rooms(e):
+                continue
+            if we.user is not None and we.event_type is not None \
+               and we.event_type.locks_user:
+                if e.user_id != we.user_id:
+                    continue
+                if e.event_type is None or not e.event_type.locks_user:
+                    continue
+            lst.append(e)
+        return lst
+
+    def has_conflicting_events(self, we):
+        """Whether the given entry `we` has any conflicting entries."""
+        lst = self.get_conflicting_events(we)
+        if lst is None:
+            return False
+        if we.event_type is not None:
+            if we.event_type.transparent:
+                return False
+            for e in lst:
+                if e.event_type is not None and e.event_type.all_rooms:
+                    return True
+            n = we.event_type.max_conflicting - 1
+        else:
+            n = 0
+        return len(lst) > n
+
+
 class EventGenerator(dd.Model):
     class Meta:
         abstract = True
@@ -202,13 +417,22 @@ class EventGenerator(dd.Model):
     def update_reminders(self, ar):
         return self.update_auto_events(ar)
 
-    def update_auto_events(self, ar):
+    def update_auto_events(self, ar, bulk=None):
         """Generate automatic calendar events owned by this contract.
 
+        If `bulk` is True (or if `bulk` is None and
+        :attr:`bulk_auto_events <lino_xl.lib.cal.Plugin.bulk_auto_events>`
+        is set), compute the full difference first and then apply it
+        using :meth:`apply_auto_events_in_bulk`.
+
         """
         if settings.SITE.loading_from_dump:
             #~ print "20111014 loading_from_dump"
             return 0
+        if bulk is None:
+            bulk = dd.plugins.cal.bulk_auto_events
+        if bulk:
+            return self.apply_auto_events_in_bulk(ar)
         rset = self.update_cal_rset()
         wanted, unwanted = self.get_wanted_auto_events(ar)
         # ar.info(
@@ -242,6 +466,61 @@ class EventGenerator(dd.Model):
         #~ logger.info("20130528 update_auto_events done")
         return count
 
+    def apply_auto_events_in_bulk(self, ar):
+        """Same as :meth:`update_auto_events`, but applies the changes
+        using a single delete, a `bulk_update` and a `bulk_create`
+        inside one transaction, followed by a `bulk_create` of the
+        suggested guests of the new entries.
+
+        Note that this bypasses the :meth:`save` and
+        :meth:`after_ui_save` methods (and the `pre_save` and
+        `post_save` signals) of the individual entries.
+
+        """
+        Event = rt.models.cal.Event
+        Guest = rt.models.cal.Guest
+        rset = self.update_cal_rset()
+        changed = []
+        wanted, unwanted = self.get_wanted_auto_events(ar, changed)
+        count = len(wanted)
+        obsolete = [ee.pk for ee in unwanted.values()
+                    if not ee.is_user_modified()]
+        count += len(obsolete)
+        changed_fields = set()
+        for ee, attnames in changed:
+            changed_fields |= attnames
+        changed_fields = [f.name for f in Event._meta.concrete_fields
+                          if f.attname in changed_fields and not f.primary_key]
+        new = []
+        for we in wanted.values():
+            if not we.is_user_modified():
+                rset.before_auto_event_save(we)
+            # what Component.save() would do:
+            if we.user is not None and we.access_class is None:
+                we.access_class = we.user.access_class
+            new.append(we)
+
+        with transaction.atomic():
+            if obsolete:
+                Event.objects.filter(pk__in=obsolete).delete()
+            if changed and changed_fields:
+                Event.objects.bulk_update(
+                    [ee for ee, attnames in changed], changed_fields)
+            if new:
+                Event.objects.bulk_create(new)
+                if new[0].pk is None:
+                    # the database backend doesn't return primary keys
+                    new = list(self.get_existing_auto_events().filter(
+                        auto_type__in=[we.auto_type for we in new]))
+                guests = []
+                for we in new:
+                    guests.extend(we.suggest_guests())
+                if guests:
+                    Guest.objects.bulk_create(guests)
+        ar.info("%d entries created, %d updated and %d deleted for %s.",
+                len(new), len(changed), len(obsolete), self)
+        return count
+
     def setup_auto_event(self, obj):
         pass
 
@@ -258,7 +537,17 @@ class EventGenerator(dd.Model):
             return
         return rset
 
-    def get_wanted_auto_events(self, ar=None):
+    def get_wanted_auto_events(self, ar=None, changed=None):
+        """Return a tuple of two dicts `(wanted, unwanted)` which map
+        sequence numbers to new (unsaved) and existing (obsolete)
+        entries respectively.
+
+        Existing entries that need to be modified are saved
+        immediately, except when a list `changed` is given. In that
+        case they are appended to that list as tuples `(entry,
+        attnames)` where `attnames` is the set of modified attributes.
+
+        """
         wanted = dict()
         unwanted = dict()
         rset = self.has_auto_events()
@@ -324,6 +613,7 @@ class EventGenerator(dd.Model):
                 date, until, max_events)
         ignore_before = dd.plugins.cal.ignore_dates_before
         user = self.get_events_user()
+        index = ConflictIndex(date, until, self, user, event_type)
         # if max_events is not None and event_no >= max_events:
         #     raise Exception("20180321")
         with translation.override(self.get_events_language()):
@@ -349,7 +639,8 @@ class EventGenerator(dd.Model):
                         start_time=rset.start_time,
                         end_time=rset.end_time)
                     self.setup_auto_event(we)
-                    date = self.resolve_conflicts(we, ar, rset, until)
+                    date = self.resolve_conflicts(
+                        we, ar, rset, until, index)
                     if date is None:
                         ar.info("Could not resolve conflicts for %s",
                                 event_no)
@@ -357,13 +648,18 @@ class EventGenerator(dd.Model):
                     ee = unwanted.pop(event_no, None)
                     if ee is None:
                         wanted[event_no] = we
+                        index.add(we)
                     elif ee.is_user_modified():
                         ar.debug(
                             "%s has been moved from %s to %s."
                             % (ee.summary, date, ee.start_date))
                         date = ee.start_date
-                    else:
+                    elif changed is None:
                         rset.compare_auto_event(ee, we)
+                    else:
+                        attnames = rset.compare_auto_event(ee, we, False)
+                        if attnames:
+                            changed.append((ee, attnames))
                         # we don't need to add it to wanted because
                         # compare_auto_event() saves any changes
                         # immediately.
@@ -409,7 +705,15 @@ class EventGenerator(dd.Model):
     def care_about_conflicts(self, we):
         return True
 
-    def resolve_conflicts(self, we, ar, rset, until):
+    def resolve_conflicts(self, we, ar, rset, until, index=None):
+        """Move the given entry `we` to the next available date until it
+        has no more conflicts.  Return the date or `None` if no
+        conflict-free date was found before `until`.
+
+        If a :class:`ConflictIndex` is given, use it instead of asking
+        the database.
+
+        """
 
         date = we.start_date
         if rset == Recurrencies.once:
@@ -420,8 +724,14 @@ class EventGenerator(dd.Model):
         #     ar.info("20171130 resolve_conflicts() %s",
         #             we.has_conflicting_events())
         # ar.debug("20140310 resolve_conflicts %s", we.start_date)
-        while we.has_conflicting_events():
-            qs = we.get_conflicting_events()
+        if index is None:
+            has_conflicts = we.has_conflicting_events
+            get_conflicts = we.get_conflicting_events
+        else:
+            has_conflicts = lambda: index.has_conflicting_events(we)
+            get_conflicts = lambda: index.get_conflicting_events(we)
+        while has_conflicts():
+            qs = get_conflicts()
             date = rset.get_next_alt_date(ar, date)
             ar.debug("%s wants %s but conflicts with %s, moving to %s. ",
                      we.summary, we.start_date, qs, date)
@@ -675,7 +985,12 @@ class RecurrenceSet(Started, Ended):
             return rv
         return True
 
-    def compare_auto_event(self, obj, ae):
+    def compare_auto_event(self, obj, ae, save=True):
+        """Update the existing automatic entry `obj` so that it matches the
+        wanted entry `ae`.  Return the set of modified attribute
+        names.  Save `obj` if it was modified, unless `save` is False.
+
+        """
         original_state = dict(obj.__dict__)
         summary = force_text(ae.summary)
         if obj.summary != summary:
@@ -696,8 +1011,12 @@ class RecurrenceSet(Started, Ended):
             obj.room = ae.room
         if not obj.is_user_modified():
             self.before_auto_event_save(obj)
-        if obj.__dict__ != original_state:
+        attnames = set([
+            k for k, v in obj.__dict__.items()
+            if k not in original_state or original_state[k] != v])
+        if attnames and save:
             obj.save()
+        return attnames
 
     def before_auto_event_save(self, event):
         """
@@ -2,15 +2,18 @@
 #
 # License: BSD (see file COPYING for details)
 
-"""Adds a radicale caldav server to the application.
+"""Publishes the calendar entries and tasks of each user and the
+calendar entries of each room as iCalendar feeds.
 
-Requires radicale to be installed.
+Requires `icalendar <https://pypi.org/project/icalendar/>`__ to be
+installed.
 
 
 .. autosummary::
     :toctree:
 
     views
+    management.commands.pollcaldav
 
 """
 
@@ -59,7 +62,15 @@ from django.conf.urls import url
 class Plugin(ad.Plugin):
 
     verbose_name = _("CalDav")
-    needs_plugins = ['lino.xl.cal']
+    needs_plugins = ['lino_xl.lib.cal']
+
+    past_days = 30
+    """Number of days before today for which calendar components are
+    published."""
+
+    future_days = 365
+    """Number of days after today for which calendar components are
+    published."""
 
     # RADICALE_CONFIG = {
     # 'server': {
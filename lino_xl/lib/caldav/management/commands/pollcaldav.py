@@ -0,0 +1,92 @@
+# -*- coding: UTF-8 -*-
+# Copyright 2020 Rumma & Ko Ltd
+# License: BSD (see file COPYING for details)
+
+"""Defines the :manage:`pollcaldav` admin command:
+
+.. management_command:: pollcaldav
+
+.. py2rst::
+
+  from lino_xl.lib.caldav.management.commands.pollcaldav \
+      import Command
+  print(Command.help)
+
+
+"""
+
+from __future__ import unicode_literals, print_function
+
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test import RequestFactory
+from django.test.utils import CaptureQueriesContext
+
+from lino.api import rt
+
+from lino_xl.lib.caldav.views import CalDavView
+
+
+def poll(user, url, data=None, **headers):
+    """Send a GET request for the given feed `url` as the given `user`
+    and return a tuple `(response, content, queries, seconds)`."""
+    request = RequestFactory().get('/caldav/' + url, data, **headers)
+    request.user = user
+    with CaptureQueriesContext(connection) as ctx:
+        t0 = time.time()
+        response = CalDavView.as_view()(request, url=url)
+        if response.streaming:
+            content = b''.join(response.streaming_content)
+        else:
+            content = response.content
+        seconds = time.time() - t0
+    return response, content, len(ctx.captured_queries), seconds
+
+
+class Command(BaseCommand):
+    help = """
+
+    Act as a calendar client polling the iCalendar feed of a user.
+
+    Fetches the whole feed, then polls it again with the received
+    ETag (which should give a 304 response) and with the received sync
+    token (which should return only the components modified in
+    between).  Reports the status, size, number of queries and time
+    of each request.
+
+    """
+
+    def add_arguments(self, parser):
+        parser.add_argument('username', help='The user whose feed to poll.')
+        parser.add_argument('-r', '--room', type=int, dest='room',
+                            default=None,
+                            help='Poll the feed of this room instead.')
+
+    def handle(self, *args, **options):
+        user = rt.models.users.User.objects.filter(
+            username=options['username']).first()
+        if user is None:
+            raise CommandError(
+                "No user {}".format(options['username']))
+        if options['room']:
+            url = "room/{}.ics".format(options['room'])
+        else:
+            url = "user/{}.ics".format(user.username)
+
+        def report(name, rv):
+            response, content, queries, seconds = rv
+            self.stdout.write(
+                "{}: status {}, {} bytes, {} queries, {:.3f} seconds".format(
+                    name, response.status_code, len(content), queries,
+                    seconds))
+            return response
+
+        response = report("full", poll(user, url))
+        if response.status_code != 200:
+            return
+        report("etag", poll(
+            user, url, HTTP_IF_NONE_MATCH=response['ETag']))
+        report("sync", poll(
+            user, url, dict(sync_token=response['X-Sync-Token'])))
@@ -1,51 +1,273 @@
+# Copyright 2017-2020 Tonis Piip, Rumma & Ko Ltd
+#
+# License: BSD (see file COPYING for details)
+
+"""Views for the :mod:`lino_xl.lib.caldav` plugin.
+
+The feed of a user is at ``caldav/user/<username>.ics``, the feed of a
+room at ``caldav/room/<pk>.ics``.  A feed contains the calendar
+entries (and, for users, the tasks) whose start date lies within the
+window defined by :attr:`past_days
+<lino_xl.lib.caldav.Plugin.past_days>` and :attr:`future_days
+<lino_xl.lib.caldav.Plugin.future_days>`.
+
+Every response carries an ``ETag`` computed from the number of
+components and their latest modification timestamp, so a client
+sending ``If-None-Match`` gets a 304 response after only two
+aggregate queries.  The ``X-Sync-Token`` response header can be sent
+back as `sync_token` URL parameter to get only the components that
+have been modified since.  Deleted components are not reported
+incrementally, but they change the ETag and collection tag.
+
+"""
+
+import re
+import datetime
+import hashlib
+
+from xml.sax.saxutils import escape
+
+from icalendar import Event, Todo, vText
+
 from django.conf import settings
-from django.http import HttpResponse
+from django.db.models import Q, Count, Max
+from django.http import (HttpResponse, StreamingHttpResponse,
+                         HttpResponseForbidden, HttpResponseNotFound,
+                         HttpResponseBadRequest)
+from django.utils.decorators import method_decorator
+from django.views.decorators.csrf import csrf_exempt
 from django.views.generic import View
 
+from lino.api import dd, rt
+
+
+URL_PATTERN = re.compile(r'^(user|room)/([^/]+?)(\.ics)?/?$')
+
+SYNC_TOKEN_FORMAT = '%Y%m%dT%H%M%S%f'
+
+PROPFIND_TEMPLATE = """<?xml version="1.0" encoding="utf-8"?>
+<d:multistatus xmlns:d="DAV:" xmlns:cs="http://calendarserver.org/ns/">
+<d:response>
+<d:href>{href}</d:href>
+<d:propstat>
+<d:prop>
+<d:displayname>{name}</d:displayname>
+<d:resourcetype><d:collection/></d:resourcetype>
+<d:getetag>{etag}</d:getetag>
+<cs:getctag>{ctag}</cs:getctag>
+<d:sync-token>{token}</d:sync-token>
+</d:prop>
+<d:status>HTTP/1.1 200 OK</d:status>
+</d:propstat>
+</d:response>
+</d:multistatus>
+"""
+
+
+def token2datetime(token):
+    """Convert a sync token back to the modification timestamp it
+    represents.  Return `None` if the token is invalid."""
+    try:
+        dt = datetime.datetime.strptime(token, SYNC_TOKEN_FORMAT)
+    except ValueError:
+        return None
+    if settings.USE_TZ:
+        from django.utils.timezone import utc
+        dt = dt.replace(tzinfo=utc)
+    return dt
+
+
+def datetime2token(dt):
+    if dt is None:
+        return ''
+    if settings.USE_TZ:
+        from django.utils.timezone import utc
+        dt = dt.astimezone(utc)
+    return dt.strftime(SYNC_TOKEN_FORMAT)
+
 
-from datetime import datetime
-from icalendar import Calendar, Event
-import pytz
-from icalendar import vCalAddress, vText
+class Feed(object):
+    """The calendar components published for a given user or room
+    within a given date window."""
 
+    def __init__(self, kind, master, start_date, end_date):
+        self.kind = kind
+        self.master = master
+        self.start_date = start_date
+        self.end_date = end_date
+
+    def get_querysets(self):
+        """Yield one queryset per model of components in this feed."""
+        flt = dict(start_date__gte=self.start_date,
+                   start_date__lte=self.end_date)
+        Event = rt.models.cal.Event
+        qs = Event.objects.filter(**flt)
+        if self.kind == 'user':
+            qs = qs.filter(Q(user=self.master) | Q(assigned_to=self.master))
+        else:
+            qs = qs.filter(room=self.master)
+        yield qs.select_related('event_type', 'room')
+        if self.kind == 'user':
+            yield rt.models.cal.Task.objects.filter(user=self.master, **flt)
+
+    def get_state(self):
+        """Return a tuple `(etag, max_modified)`, using one aggregate
+        query per model."""
+        parts = [self.kind, str(self.master.pk),
+                 str(self.start_date), str(self.end_date)]
+        max_modified = None
+        for qs in self.get_querysets():
+            d = qs.order_by().aggregate(n=Count('id'), m=Max('modified'))
+            parts += [str(d['n']), datetime2token(d['m'])]
+            if d['m'] is not None and (
+                    max_modified is None or d['m'] > max_modified):
+                max_modified = d['m']
+        etag = hashlib.md5(':'.join(parts).encode('utf-8')).hexdigest()
+        return '"{}"'.format(etag), max_modified
+
+    def iter_components(self, since=None):
+        """Yield the components of this feed as icalendar objects.
+
+        When `since` is given, yield only those that have been modified
+        after that timestamp.
+
+        """
+        for qs in self.get_querysets():
+            if since is not None:
+                qs = qs.filter(modified__gt=since)
+            for obj in qs.order_by('start_date', 'id').iterator():
+                yield obj2component(obj)
+
+    def iter_ical(self, since=None):
+        yield b'BEGIN:VCALENDAR\r\n'
+        yield b'VERSION:2.0\r\n'
+        yield 'PRODID:-//{}//Lino//EN\r\n'.format(
+            settings.SITE.title or settings.SITE.verbose_name).encode('utf-8')
+        yield b'X-WR-CALNAME:' + vText(str(self.master)).to_ical() + b'\r\n'
+        for comp in self.iter_components(since):
+            yield comp.to_ical()
+        yield b'END:VCALENDAR\r\n'
+
+
+def add_start_end(comp, obj, start_name, end_name):
+    if obj.start_time:
+        comp.add(start_name, obj.get_datetime('start'))
+    else:
+        comp.add(start_name, obj.start_date)
+    if end_name is None:
+        return
+    if obj.end_time:
+        comp.add(end_name, obj.get_datetime('end', 'start'))
+    elif obj.end_date and not obj.start_time:
+        # DTEND of an all-day entry is exclusive
+        comp.add(end_name, obj.end_date + datetime.timedelta(days=1))
+
+
+def obj2component(obj):
+    """Convert a calendar entry or task to an icalendar component."""
+    if isinstance(obj, rt.models.cal.Event):
+        comp = Event()
+        add_start_end(comp, obj, 'dtstart', 'dtend')
+        if obj.room_id:
+            comp['location'] = vText(str(obj.room))
+        if obj.event_type_id:
+            comp.add('categories', str(obj.event_type))
+        if obj.transparent:
+            comp.add('transp', 'TRANSPARENT')
+        name = obj.state.name if obj.state else ''
+        if name == 'cancelled':
+            comp.add('status', 'CANCELLED')
+        elif name == 'suggested':
+            comp.add('status', 'TENTATIVE')
+        else:
+            comp.add('status', 'CONFIRMED')
+    else:
+        comp = Todo()
+        add_start_end(comp, obj, 'dtstart', None)
+        if obj.due_date:
+            comp.add('due', obj.due_date)
+    comp['uid'] = "{}-{}@{}".format(
+        obj._meta.model_name, obj.pk, settings.SITE.uid or 'lino')
+    comp.add('summary', obj.summary or str(obj))
+    if obj.description:
+        comp.add('description', obj.description)
+    comp.add('sequence', obj.sequence)
+    if obj.created:
+        comp.add('created', obj.created)
+    if obj.modified:
+        comp.add('dtstamp', obj.modified)
+        comp.add('last-modified', obj.modified)
+    return comp
+
+
+@method_decorator(csrf_exempt, name='dispatch')
 class CalDavView(View):
-    
-    def get(self, request, *args, **kwargs):
-        
-        # code copied from http://icalendar.readthedocs.io/en/latest/usage.html#example
-        
-        cal = Calendar()
-        cal.add('prodid', '-//My calendar product//mxm.dk//')
-        cal.add('version', '2.0')
-
-        event = Event()
-        event.add('summary', 'Python meeting about calendaring')
-        event.add('dtstart', datetime(2005,4,4,8,0,0,tzinfo=pytz.utc))
-        event.add('dtend', datetime(2005,4,4,10,0,0,tzinfo=pytz.utc))
-        event.add('dtstamp', datetime(2005,4,4,0,10,0,tzinfo=pytz.utc))
-        organizer = vCalAddress('MAILTO:noone@example.com')
-
-        organizer.params['cn'] = vText('Max Rasmussen')
-        organizer.params['role'] = vText('CHAIR')
-        event['organizer'] = organizer
-        event['location'] = vText('Odense, Denmark')
-
-        event['uid'] = '20050115T101010/27346262376@mxm.dk'
-        event.add('priority', 5)
-
-        attendee = vCalAddress('MAILTO:maxm@example.com')
-        attendee.params['cn'] = vText('Max Rasmussen')
-        attendee.params['ROLE'] = vText('REQ-PARTICIPANT')
-        event.add('attendee', attendee, encode=0)
-
-        attendee = vCalAddress('MAILTO:the-dude@example.com')
-        attendee.params['cn'] = vText('The Dude')
-        attendee.params['ROLE'] = vText('REQ-PARTICIPANT')
-        event.add('attendee', attendee, encode=0)
-        
-        cal.add_component(event)
-        
-        html = cal.to_ical()
-        
-        return HttpResponse(html)
-        
+
+    http_method_names = View.http_method_names + ['propfind']
+
+    def get_feed(self, request, url):
+        """Return a tuple `(feed, error_response)`."""
+        mo = URL_PATTERN.match(url)
+        if mo is None:
+            return None, HttpResponseNotFound()
+        kind, key = mo.group(1), mo.group(2)
+        user = request.user
+        if not user.authenticated:
+            return None, HttpResponseForbidden()
+        if kind == 'user':
+            master = rt.models.users.User.objects.filter(
+                username=key).first()
+            if master is None:
+                return None, HttpResponseNotFound()
+            if master != user and not user.user_type.has_required_roles(
+                    [dd.SiteStaff]):
+                return None, HttpResponseForbidden()
+        else:
+            if not key.isdigit():
+                return None, HttpResponseNotFound()
+            master = rt.models.cal.Room.objects.filter(pk=key).first()
+            if master is None:
+                return None, HttpResponseNotFound()
+        config = dd.plugins.caldav
+        today = dd.today()
+        feed = Feed(kind, master,
+                    today - datetime.timedelta(days=config.past_days),
+                    today + datetime.timedelta(days=config.future_days))
+        return feed, None
+
+    def get(self, request, url='', *args, **kwargs):
+        feed, response = self.get_feed(request, url)
+        if response is not None:
+            return response
+        etag, max_modified = feed.get_state()
+        token = request.GET.get('sync_token')
+        since = None
+        if token:
+            since = token2datetime(token)
+            if since is None:
+                return HttpResponseBadRequest("Invalid sync token")
+        elif request.META.get('HTTP_IF_NONE_MATCH') == etag:
+            response = HttpResponse(status=304)
+            response['ETag'] = etag
+            return response
+        if since is not None and max_modified is not None \
+           and max_modified <= since:
+            response = HttpResponse(status=304)
+        else:
+            response = StreamingHttpResponse(
+                feed.iter_ical(since), content_type='text/calendar')
+        response['ETag'] = etag
+        response['X-Sync-Token'] = datetime2token(max_modified)
+        return response
+
+    def propfind(self, request, url='', *args, **kwargs):
+        feed, response = self.get_feed(request, url)
+        if response is not None:
+            return response
+        etag, max_modified = feed.get_state()
+        xml = PROPFIND_TEMPLATE.format(
+            href=escape(request.path), name=escape(str(feed.master)),
+            etag=escape(etag),
+            ctag=etag.strip('"'), token=datetime2token(max_modified))
+        return HttpResponse(
+            xml, status=207, content_type='application/xml; charset=utf-8')
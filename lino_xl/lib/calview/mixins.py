@@ -9,4 +9,19 @@ class Plannable(dd.Model):
         abstract = True
 
     def get_weekly_chunks(obj, ar, qs, current_week_day):
-        return [e.obj2href(ar, e.colored_calendar_fmt(ar.param_values)) for e in qs]
+        """Return the chunks to show in the cell of the given day, with
+        `qs` being a queryset of the calendar entries of that day.
+
+        Called by the weekly planner only when overridden, otherwise
+        the planner calls :meth:`get_weekly_entry_chunks`.
+
+        """
+        return obj.get_weekly_entry_chunks(ar, qs, current_week_day)
+
+    def get_weekly_entry_chunks(obj, ar, entries, current_week_day):
+        """Same as :meth:`get_weekly_chunks`, but `entries` is a list of
+        calendar entries which the planner has loaded for the whole
+        week.
+
+        """
+        return [e.obj2href(ar, e.colored_calendar_fmt(ar.param_values)) for e in entries]
@@ -23,15 +23,21 @@ class DailyPlannerRow(BabelDesignated, Sequenced, Plannable):
         blank=True, null=True,
         verbose_name=_("End time"))
 
-    def get_weekly_chunks(obj, ar, qs, current_week_day):
-        if obj.start_time:
-            qs = qs.filter(start_time__gte=obj.start_time,
-                           start_time__isnull=False)
-        if obj.end_time:
-            qs = qs.filter(start_time__lt=obj.end_time,
-                           start_time__isnull=False)
+    def filter_entries(self, entries):
+        """Return the calendar entries of the given list that start within
+        the time range of this row."""
+        if not self.start_time and not self.end_time:
+            return [e for e in entries if e.start_time is None]
+        entries = [e for e in entries if e.start_time is not None]
+        if self.start_time:
+            entries = [e for e in entries if e.start_time >= self.start_time]
+        if self.end_time:
+            entries = [e for e in entries if e.start_time < self.end_time]
+        return entries
+
+    def get_weekly_entry_chunks(obj, ar, entries, current_week_day):
+        entries = obj.filter_entries(entries)
         if not obj.start_time and not obj.end_time:
-            qs = qs.filter(start_time__isnull=True)
             link = str(current_week_day.day) \
                 if current_week_day != dd.today() \
                 else E.b(str(current_week_day.day))
@@ -41,7 +47,7 @@ class DailyPlannerRow(BabelDesignated, Sequenced, Plannable):
                    align="center")
         else:
             link = ''
-        chunks = [e.obj2href(ar, e.colored_calendar_fmt(ar.param_values)) for e in qs]
+        chunks = [e.obj2href(ar, e.colored_calendar_fmt(ar.param_values)) for e in entries]
         return [link] + chunks
 
 
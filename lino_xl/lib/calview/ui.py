@@ -25,6 +25,8 @@ from lino_xl.lib.cal.choicelists import PlannerColumns, Weekdays
 from lino_xl.lib.cal.choicelists import DurationUnits, YearMonths
 from lino_xl.lib.cal.utils import when_text
 
+from .mixins import Plannable
+
 from calendar import Calendar as PythonCalendar
 from datetime import timedelta, datetime
 
@@ -41,6 +43,35 @@ def weekname(date):
     text = (date + timedelta(days=-day+1)).strftime("%d %B")
     return _("Week {1} / {0} ({2})").format(year, week, text)
 
+def get_planner_entries(ar, first_day, last_day):
+    """Return a dict that maps each day between `first_day` and
+    `last_day` to the list of calendar entries starting on that day,
+    ordered by start time.
+
+    The entries are loaded using a single query, which is cached on
+    the action request so that all cells of a planner share it.
+
+    """
+    cache = getattr(ar, 'planner_entries_cache', None)
+    if cache is None:
+        cache = ar.planner_entries_cache = dict()
+    k = (first_day, last_day)
+    days = cache.get(k)
+    if days is None:
+        Event = rt.models.cal.Event
+        qs = Event.calendar_param_filter(Event.objects.all(), ar.param_values)
+        qs = qs.filter(start_date__gte=first_day, start_date__lte=last_day)
+        related = ['user', 'event_type', 'room']
+        if settings.SITE.project_model is not None:
+            related.append('project')
+        qs = qs.select_related(*related).order_by('start_time')
+        days = dict()
+        for e in qs:
+            days.setdefault(e.start_date, []).append(e)
+        cache[k] = days
+    return days
+
+
 def gen_insert_button(actor,header_items, Event, ar, target_day):
     """Hackish solution to not having to recreate a new sub request when generating lots of insert buttons.
     Stores values in the actor as a cache, and uses id(ar) to check if it's a new request and needs updating.
@@ -442,27 +473,18 @@ class DailyPlanner(DailyPlannerRows, CalPlannerTable):
     @classmethod
     def get_ventilated_columns(cls):
 
-        Event = rt.models.cal.Event
-
         def w(pc, verbose_name):
             def func(fld, obj, ar):
                 # obj is the DailyPlannerRow instance
                 pv = ar.param_values
-                qs = Event.objects.filter(event_type__planner_column=pc)
-                qs = Event.calendar_param_filter(qs, pv)
-                current_day = pv.get('date',dd.today())
-                if current_day:
-                    qs = qs.filter(start_date=current_day)
-                if obj.start_time:
-                    qs = qs.filter(start_time__gte=obj.start_time,
-                                   start_time__isnull=False)
-                if obj.end_time:
-                    qs = qs.filter(start_time__lt=obj.end_time,
-                                   start_time__isnull=False)
-                if not obj.start_time and not obj.end_time:
-                    qs = qs.filter(start_time__isnull=True)
-                qs = qs.order_by('start_time')
-                chunks = [e.obj2href(ar, e.colored_calendar_fmt(pv)) for e in qs]
+                current_day = pv.get('date') or dd.today()
+                entries = get_planner_entries(
+                    ar, current_day, current_day).get(current_day, [])
+                entries = [e for e in obj.filter_entries(entries)
+                           if e.event_type_id
+                           and e.event_type.planner_column == pc]
+                chunks = [e.obj2href(ar, e.colored_calendar_fmt(pv))
+                          for e in entries]
                 return E.p(*join_elems(chunks))
 
             return dd.VirtualField(dd.HtmlBox(verbose_name), func)
@@ -487,20 +509,27 @@ class WeeklyColumns(EventsParameters, CalPlannerTable, VentilatedColumns):
     @classmethod
     def get_weekday_field(cls, week_day):
 
-        Event = rt.models.cal.Event
-
         def func(fld, obj, ar):
             # obj is a Plannable instance
-            qs = Event.objects.all()
-            qs = Event.calendar_param_filter(qs, ar.param_values)
             delta_days = int(ar.rqdata.get('mk', 0) or 0) if ar.rqdata else ar.master_instance.pk
             # current_day = dd.today() + timedelta(days=delta_days)
             current_day = dd.today(delta_days)
-            current_week_day = current_day + \
-                timedelta(days=int(week_day.value) - current_day.weekday() - 1)
-            qs = qs.filter(start_date=current_week_day)
-            qs = qs.order_by('start_time')
-            chunks = obj.get_weekly_chunks(ar, qs, current_week_day)
+            monday = current_day - timedelta(days=current_day.weekday())
+            current_week_day = monday + timedelta(days=int(week_day.value) - 1)
+            if type(obj).get_weekly_chunks is Plannable.get_weekly_chunks:
+                entries = get_planner_entries(
+                    ar, monday, monday + timedelta(days=6))
+                chunks = obj.get_weekly_entry_chunks(
+                    ar, entries.get(current_week_day, []), current_week_day)
+            else:
+                # the application overrides the old hook, which
+                # expects a queryset
+                Event = rt.models.cal.Event
+                qs = Event.calendar_param_filter(
+                    Event.objects.all(), ar.param_values)
+                qs = qs.filter(start_date=current_week_day)
+                qs = qs.order_by('start_time')
+                chunks = obj.get_weekly_chunks(ar, qs, current_week_day)
             return E.table(E.tr(E.td(E.div(*join_elems(chunks)))),
                 CLASS="fixed-table")
 
@@ -588,15 +617,15 @@ class MonthlyPlanner(CalPlannerTable, EventsParameters, dd.VirtualTable):
                 pv = ar.param_values
                 if pv is None:
                     return
-                qs = Event.objects.all()
-                qs = Event.calendar_param_filter(qs, pv)
                 offset = int(ar.rqdata.get('mk', 0) or 0) if ar.rqdata else ar.master_instance.pk
                 today = dd.today()
                 current_date = dd.today(offset)
                 target_day = week[int(pc.value)-1]
-                qs = qs.filter(start_date=target_day)
-                qs = qs.order_by('start_time')
-                chunks = [E.p(e.obj2href(ar, e.colored_calendar_fmt(pv))) for e in qs]
+                weeks = CALENDAR.monthdatescalendar(
+                    current_date.year, current_date.month)
+                entries = get_planner_entries(
+                    ar, weeks[0][0], weeks[-1][-1]).get(target_day, [])
+                chunks = [E.p(e.obj2href(ar, e.colored_calendar_fmt(pv))) for e in entries]
 
                 pk = date2pk(target_day)
                 daily, weekly, monthly = make_link_funcs(ar)
@@ -33,6 +33,11 @@ class Plugin(ad.Plugin):
     pupil_name_fields = "pupil__name"
     needs_plugins = ['lino_xl.lib.cal']
 
+    hide_full_courses = False
+    """Whether the choices for the activity of an enrolment should
+    hide activities which have no free places left at the date of
+    request."""
+
     def unused_on_plugins_loaded(self, site):
         # from lino.core.fields import fields_list
         self.pupil_name_fields = set(self.pupil_name_fields.split())
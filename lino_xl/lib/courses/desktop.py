@@ -255,6 +255,7 @@ class Activities(dd.Table):
 
         qs = self.model.add_param_filter(
             qs, show_exposed=pv.show_exposed)
+        qs = self.model.annotate_places(qs)
         
         # if pv.start_date:
         #     # dd.logger.info("20160512 start_date is %r", pv.start_date)
@@ -10,7 +10,8 @@ from builtins import str
 from lino_xl.lib.ledger.utils import ZERO, ONE
 
 from django.db import models
-from django.db.models import Q
+from django.db.models import Q, F, Sum
+from django.db.models.functions import Coalesce
 from django.conf import settings
 from django.core.exceptions import ValidationError
 from django.utils.translation import ugettext_lazy as _
@@ -434,12 +435,64 @@ class Course(Reservation, Duplicable, Printable):
         # logger.info("20140819 %s", res)
         return res['places__sum'] or 0
 
+    @classmethod
+    def annotate_places(cls, qs, today=None):
+        """Annotate the given queryset of activities with the number of
+        used, requested, confirmed and trying places.
+
+        This computes the same sums as :meth:`get_places_sum` for all
+        activities at once in a single grouped query.  The
+        annotations are read by :meth:`get_used_places` and the
+        virtual fields :attr:`free_places`, :attr:`requested`,
+        :attr:`confirmed` and :attr:`trying`.
+
+        """
+        Enrolment = rt.models.courses.Enrolment
+        prefix = Enrolment._meta.get_field('course').related_query_name()
+        prefix += '__'
+        if today is None:
+            today = dd.today()
+            active = Q()
+        else:
+            active = Q(**{prefix + 'start_date__isnull': True})
+            active |= Q(**{prefix + 'start_date__lte': today})
+        active &= Q(**{prefix + 'end_date__isnull': True}) | Q(
+            **{prefix + 'end_date__gte': today})
+
+        def places(**flt):
+            flt = {prefix + k: v for k, v in flt.items()}
+            return Coalesce(Sum(
+                prefix + 'places', filter=active & Q(**flt)), 0)
+
+        return qs.annotate(
+            used_places_sum=places(
+                state__in=EnrolmentStates.filter(uses_a_place=True)),
+            requested_places_sum=places(state=EnrolmentStates.requested),
+            confirmed_places_sum=places(state=EnrolmentStates.confirmed),
+            trying_places_sum=places(state=EnrolmentStates.trying))
+
+    @classmethod
+    def exclude_full(cls, qs):
+        """Remove the activities without free places from a queryset
+        returned by :meth:`annotate_places`."""
+        flt = Q(max_places__isnull=True) | Q(max_places=0)
+        flt |= Q(max_places__gt=F('used_places_sum'))
+        return qs.filter(flt)
+
+    def get_annotated_places(self, name, today=None):
+        # return the value set by annotate_places() if available
+        if today is None:
+            return getattr(self, name + '_places_sum', None)
+
     def get_free_places(self, today=None):
         if not self.max_places:
             return None  # _("Unlimited")
         return self.max_places - self.get_used_places(today)
 
     def get_used_places(self, today=None):
+        n = self.get_annotated_places('used', today)
+        if n is not None:
+            return n
         states = EnrolmentStates.filter(uses_a_place=True)
         return self.get_places_sum(today, state__in=states)
 
@@ -452,6 +505,9 @@ class Course(Reservation, Duplicable, Printable):
 
     @dd.virtualfield(models.IntegerField(_("Requested")))
     def requested(self, ar):
+        n = self.get_annotated_places('requested')
+        if n is not None:
+            return n
         return self.get_places_sum(state=EnrolmentStates.requested)
         # pv = dict(start_date=dd.today())
         # pv.update(state=EnrolmentStates.requested)
@@ -460,6 +516,9 @@ class Course(Reservation, Duplicable, Printable):
 
     @dd.virtualfield(models.IntegerField(_("Confirmed")))
     def confirmed(self, ar):
+        n = self.get_annotated_places('confirmed')
+        if n is not None:
+            return n
         return self.get_places_sum(state=EnrolmentStates.confirmed)
         # pv = dict(start_date=dd.today())
         # pv.update(state=EnrolmentStates.confirmed)
@@ -468,6 +527,9 @@ class Course(Reservation, Duplicable, Printable):
 
     @dd.virtualfield(models.IntegerField(_("Trying")))
     def trying(self, ar):
+        n = self.get_annotated_places('trying')
+        if n is not None:
+            return n
         return self.get_places_sum(state=EnrolmentStates.trying)
 
     @dd.requestfield(_("Enrolments"))
@@ -593,6 +655,10 @@ class Enrolment(UserAuthored, Certifiable, DateRange):
             qs = qs.filter(line__course_area=course_area)
         enrollable_states = CourseStates.filter(is_exposed=True)
         qs = qs.filter(state__in=enrollable_states)
+        if dd.plugins.courses.hide_full_courses:
+            Course = rt.models.courses.Course
+            qs = Course.annotate_places(qs, request_date)
+            qs = Course.exclude_full(qs)
         return qs
 
     @dd.chooser()
@@ -9,6 +9,8 @@ See :doc:`/specs/finan`.
 .. autosummary::
    :toctree:
 
+    choicelists
+    pain001
     fixtures.payments
 
 """
@@ -22,6 +24,20 @@ class Plugin(ad.Plugin):
     needs_plugins = ['lino_xl.lib.ledger']
     suggest_future_vouchers = False
 
+    stream_payments_initiation = False
+    """Whether to write SEPA payment initiation files using a streaming
+    writer instead of rendering the :xfile:`pain_001.xml` template.
+
+    Recommended for sites with payment orders of many thousands of
+    items.  Local changes to the template are then ignored.
+    """
+
+    payments_per_block = 0
+    """Maximum number of transactions per payment information block
+    when :attr:`stream_payments_initiation` is set.  0 means no
+    limit.
+    """
+
     # def setup_main_menu(self, site, user_type, m):
     #     m = m.add_menu(self.app_label, self.verbose_name)
     #     ledger = site.modules.ledger
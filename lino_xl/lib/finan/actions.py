@@ -27,14 +27,25 @@ class WritePaymentsInitiation(WriteXML):
     """Generate an XML file (SEPA payment initiation) from this database
 object.
 
+    When :attr:`stream_payments_initiation
+    <lino_xl.lib.finan.Plugin.stream_payments_initiation>` is set, the
+    file is written by the :class:`PaymentsInitiationBuildMethod
+    <lino_xl.lib.finan.choicelists.PaymentsInitiationBuildMethod>`
+    instead of rendering the :xfile:`pain_001.xml` template.
+
     """
 
     tplname = "pain_001"
 
-    def get_printable_context(self, bm, elem, ar):
-        context = super(
-            WritePaymentsInitiation, self).get_printable_context(
-                bm, elem, ar)
+    def __init__(self, *args, **kwargs):
+        super(WritePaymentsInitiation, self).__init__(*args, **kwargs)
+        if dd.plugins.finan.stream_payments_initiation:
+            self.build_method = "pain001"
+
+    def get_initiating_party(self):
+        """Return a dict with `our_name`, `our_id` and `our_issuer`
+        describing the site owner."""
+        context = dict()
         sc = settings.SITE.site_config.site_company
         if not sc:
             raise Warning(_("You must specify a site owner"))
@@ -48,6 +59,13 @@ object.
             context.update(our_name=str(sc))
             context.update(our_id=our_id)
             context.update(our_issuer='KBO-BCE')
+        return context
+
+    def get_printable_context(self, bm, elem, ar):
+        context = super(
+            WritePaymentsInitiation, self).get_printable_context(
+                bm, elem, ar)
+        context.update(self.get_initiating_party())
         # raise Exception(str(context))
         return context
 
@@ -0,0 +1,36 @@
+# -*- coding: UTF-8 -*-
+# Copyright 2020 Rumma & Ko Ltd
+# License: BSD (see file COPYING for details)
+
+import os
+
+from lino.modlib.printing.choicelists import XmlBuildMethod, BuildMethods
+
+from .pain001 import PaymentsInitiationWriter
+
+
+class PaymentsInitiationBuildMethod(XmlBuildMethod):
+    """Writes a SEPA payment initiation file using a
+    :class:`PaymentsInitiationWriter
+    <lino_xl.lib.finan.pain001.PaymentsInitiationWriter>` instead of
+    rendering a template.
+
+    Used by :class:`WritePaymentsInitiation
+    <lino_xl.lib.finan.actions.WritePaymentsInitiation>` when
+    :attr:`stream_payments_initiation
+    <lino_xl.lib.finan.Plugin.stream_payments_initiation>` is set.
+
+    """
+
+    def build(self, ar, action, elem):
+        filename = action.before_build(self, elem)
+        if filename is None:
+            return
+        w = PaymentsInitiationWriter(elem, **action.get_initiating_party())
+        w.write_file(filename)
+        action.validate_result_file(filename)
+        return os.path.getmtime(filename)
+
+
+add = BuildMethods.add_item_instance
+add(PaymentsInitiationBuildMethod('pain001'))
@@ -82,7 +82,9 @@ class FinancialVoucher(ledger.RegistrableVoucher, Certifiable):
         # dd.logger.info("20151211 get_finan_movements()")
         amount = ZERO
         movements_and_items = []
-        for i in self.items.order_by('seqno'):
+        qs = self.items.order_by('seqno').select_related(
+            *dd.plugins.ledger.remove_dummy('partner', 'account', 'project'))
+        for i in qs:
             if i.dc == self.journal.dc:
                 amount += i.amount
             else:
@@ -22,6 +22,7 @@ from lino.api import dd, rt, _
 from .mixins import (FinancialVoucher, FinancialVoucherItem,
                      DatedFinancialVoucher, DatedFinancialVoucherItem)
 
+from .choicelists import *
 from .actions import WritePaymentsInitiation
 
 
@@ -124,7 +125,7 @@ class PaymentOrder(FinancialVoucher, Printable):
         for payment orders.
 
         As a side effect this also computes the :attr:`total` field and saves
-        the voucher.
+        the voucher when the total has changed.
 
         """
         # dd.logger.info("20151211 cosi.PaymentOrder.get_wanted_movements()")
@@ -137,6 +138,7 @@ class PaymentOrder(FinancialVoucher, Printable):
         if abs(amount > MAX_AMOUNT):
             dd.logger.warning("Oops, %s is too big", amount)
             return
+        total_changed = self.total != - amount
         self.total = - amount
         item_partner = self.journal.partner is None
         for m, i in movements_and_items:
@@ -152,8 +154,9 @@ class PaymentOrder(FinancialVoucher, Printable):
                 # 20191226 partner=self.journal.partner, match=self.get_default_match())
 
         # side effect!:
-        self.full_clean()
-        self.save()
+        if total_changed:
+            self.full_clean()
+            self.save()
 
     def add_item_from_due(self, obj, **kwargs):
         # if obj.bank_account is None:
@@ -0,0 +1,180 @@
+# -*- coding: UTF-8 -*-
+# Copyright 2020 Rumma & Ko Ltd
+# License: BSD (see file COPYING for details)
+
+"""A streaming writer for SEPA payment initiation files (pain.001).
+
+Produces the same XML as the :xfile:`pain_001.xml` template, but
+writes it incrementally while iterating over the items of the payment
+order, so that orders with tens of thousands of items need neither a
+rendered template in memory nor one query per item.
+
+"""
+
+import io
+import datetime
+
+from xml.sax.saxutils import escape
+
+from django.db.models import Count, Sum
+
+from lino.api import dd, _
+
+from lino_xl.lib.ledger.utils import ZERO
+
+
+NAMESPACES = (
+    ' xmlns="urn:iso:std:iso:20022:tech:xsd:pain.001.001.02"'
+    ' xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance"')
+
+
+class PaymentsInitiationWriter(object):
+    """Writes a pain.001 file for a given payment order.
+
+    `our_name`, `our_id` and `our_issuer` identify the initiating
+    party (see :meth:`WritePaymentsInitiation.get_initiating_party
+    <lino_xl.lib.finan.actions.WritePaymentsInitiation.get_initiating_party>`).
+
+    .. attribute:: block_size
+
+        Maximum number of transactions per payment information block.
+        Defaults to :attr:`payments_per_block
+        <lino_xl.lib.finan.Plugin.payments_per_block>`.  0 means
+        that all transactions go into a single block.
+
+    """
+
+    block_size = None
+
+    def __init__(self, obj, our_name='', our_id=None, our_issuer=None,
+                 block_size=None):
+        self.obj = obj
+        self.our_name = our_name
+        self.our_id = our_id
+        self.our_issuer = our_issuer
+        if block_size is None:
+            block_size = dd.plugins.finan.payments_per_block
+        self.block_size = block_size
+        self.count = 0
+        self.control_sum = ZERO
+
+    def get_items(self):
+        return self.obj.items.order_by('seqno').select_related(
+            'partner', 'partner__country', 'partner__city', 'bank_account')
+
+    def write_file(self, filename):
+        """Write the pain.001 file to the given `filename`.
+
+        Raises a :class:`Warning` when the items changed while writing
+        (i.e. when the number of transactions or their control sum
+        differs from the values announced in the group header).
+
+        """
+        totals = self.obj.items.aggregate(n=Count('id'), s=Sum('amount'))
+        count, control_sum = totals['n'], totals['s'] or ZERO
+        with io.open(filename, 'w', encoding='utf-8') as f:
+            w = f.write
+            w(u'<?xml version="1.0" encoding="UTF-8"?>\n')
+            w(u'<Document{}>\n<pain.001.001.02>\n'.format(NAMESPACES))
+            self.write_group_header(w, count, control_sum)
+            block = 0
+            in_block = 0
+            for item in self.get_items().iterator():
+                if in_block == 0:
+                    block += 1
+                    self.write_block_header(w, block)
+                self.write_transaction(w, item)
+                in_block += 1
+                if self.block_size and in_block >= self.block_size:
+                    w(u'</PmtInf>\n')
+                    in_block = 0
+            if block == 0:
+                # an empty order still needs one (empty) block
+                self.write_block_header(w, 1)
+                in_block = 1
+            if in_block:
+                w(u'</PmtInf>\n')
+            w(u'</pain.001.001.02>\n</Document>\n')
+        if self.count != count or self.control_sum != control_sum:
+            raise Warning(_(
+                "Items of {} have changed while writing {}.").format(
+                    self.obj, filename))
+        dd.logger.info(
+            "Wrote %d transactions (%s) in %d blocks to %s",
+            self.count, self.control_sum, max(block, 1), filename)
+
+    def write_party_id(self, w, indent):
+        if self.our_id:
+            w(u'{0}<Id><OrgId><PrtryId>\n'
+              u'{0}  <Id>{1}</Id>\n'
+              u'{0}  <Issr>{2}</Issr>\n'
+              u'{0}</PrtryId></OrgId></Id>\n'.format(
+                  indent, escape(self.our_id), escape(self.our_issuer)))
+
+    def write_group_header(self, w, count, control_sum):
+        obj = self.obj
+        w(u'<GrpHdr>\n')
+        w(u'  <MsgId>{}</MsgId>\n'.format(escape(u'{}/{} {}'.format(
+            obj.id, obj.journal.ref, obj.number))))
+        w(u'  <CreDtTm>{}</CreDtTm>\n'.format(
+            datetime.datetime.now().isoformat()))
+        w(u'  <NbOfTxs>{}</NbOfTxs>\n'.format(count))
+        w(u'  <CtrlSum>{}</CtrlSum>\n'.format(control_sum))
+        w(u'  <Grpg>MIXD</Grpg>\n')
+        w(u'  <InitgPty>\n')
+        w(u'    <Nm>{}</Nm>\n'.format(escape(self.our_name)))
+        self.write_party_id(w, '    ')
+        w(u'  </InitgPty>\n')
+        w(u'</GrpHdr>\n')
+
+    def write_block_header(self, w, block):
+        obj = self.obj
+        acc = obj.journal.sepa_account
+        pmtinfid = u'{} {}'.format(obj.journal.ref, obj.number)
+        if block > 1:
+            pmtinfid += u'/{}'.format(block)
+        w(u'<PmtInf>\n')
+        w(u'<PmtInfId>{}</PmtInfId>\n'.format(escape(pmtinfid)))
+        w(u'<PmtMtd>TRF</PmtMtd>\n')
+        w(u'<PmtTpInf><SvcLvl><Cd>SEPA</Cd></SvcLvl></PmtTpInf>\n')
+        w(u'<ReqdExctnDt>{}</ReqdExctnDt>\n'.format(
+            (obj.execution_date or obj.entry_date).isoformat()))
+        w(u'<Dbtr>\n')
+        w(u'  <Nm>{}</Nm>\n'.format(escape(self.our_name)))
+        self.write_party_id(w, '  ')
+        w(u'</Dbtr>\n')
+        w(u'<DbtrAcct><Id><IBAN>{}</IBAN></Id></DbtrAcct>\n'.format(
+            escape(acc.iban)))
+        if acc.bic:
+            w(u'<DbtrAgt><FinInstnId><BIC>{}</BIC></FinInstnId>'
+              u'</DbtrAgt>\n'.format(escape(acc.bic)))
+
+    def write_transaction(self, w, item):
+        partner = item.partner
+        ba = item.bank_account
+        w(u'<CdtTrfTxInf>\n')
+        w(u'<PmtId><EndToEndId>.</EndToEndId></PmtId>\n')
+        w(u'<Amt><InstdAmt Ccy="EUR">{}</InstdAmt></Amt>\n'.format(
+            item.amount))
+        if ba is not None and ba.bic:
+            w(u'<CdtrAgt><FinInstnId><BIC>{}</BIC></FinInstnId>'
+              u'</CdtrAgt>\n'.format(escape(ba.bic)))
+        w(u'<Cdtr>\n')
+        w(u' <Nm>{}</Nm>\n'.format(escape(str(partner))))
+        if partner.country is not None:
+            w(u' <PstlAdr>\n')
+            if partner.street:
+                w(u' <AdrLine>{}</AdrLine>\n'.format(escape(partner.street)))
+            if partner.city is not None:
+                w(u' <AdrLine>{}</AdrLine>\n'.format(
+                    escape(str(partner.city))))
+            w(u' <Ctry>{}</Ctry>\n'.format(escape(partner.country.isocode)))
+            w(u' </PstlAdr>\n')
+        w(u' </Cdtr>\n')
+        w(u'<CdtrAcct><Id><IBAN>{}</IBAN></Id></CdtrAcct>\n'.format(
+            escape(ba.iban if ba is not None else '')))
+        w(u'<RmtInf><Ustrd>{}*{}*{}</Ustrd></RmtInf>\n'.format(
+            escape(item.remark), escape(partner.name), escape(str(self.obj))))
+        w(u'</CdtTrfTxInf>\n')
+        self.count += 1
+        self.control_sum += item.amount
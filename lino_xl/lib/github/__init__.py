@@ -26,6 +26,13 @@ class Plugin(ad.Plugin):
 
     ticket_pattern = re.compile(r"(?<!Merge pull request )#([0-9]+)")
 
+    api_url = "https://api.github.com/"
+    """The base URL of the github API.  Can be pointed to a local stub
+    server for testing."""
+
+    import_batch_size = 500
+    """Number of commits to look up and write at once when importing."""
+
     def on_site_startup(self, site):
         # from .mixins import Workable
         pass
@@ -9,13 +9,25 @@ Actions for `lino_xl.lib.github`.
 from lino.api import dd, rt, _
 import logging
 logger = logging.getLogger(__name__)
+from django.db import transaction
 from django.db.models import Q
 
+# ETag of the first page of commits per repository, used by
+# Import_new_commits to skip repositories that did not change.
+ETAGS = {}
+
+COMMIT_FIELDS = ('repository', 'user', 'ticket', 'git_user',
+                 'commiter_name', 'url', 'created', 'description',
+                 'summary', 'comment', 'data', 'unassignable')
+
+
 class User_commit_finder():
 
     def __init__(self):
         self.users = {}
         self.unknown_users = []
+        # all users are loaded at once, there are usually only a few
+        self.all_users = list(rt.models.users.User.objects.all())
 
     def find_user(self, commit):
         """
@@ -25,13 +37,15 @@ class User_commit_finder():
         :return:
         """
         # Find the user for this commit
-        User = rt.models.users.User
         found_user = self.users.get(commit.git_user, None) or self.users.get(commit.commiter_name, None)
         # not a huge fan of this, just want to avoid having to call filter for every commit
         if found_user is None and \
                 (commit.git_user not in self.unknown_users or commit.commiter_name not in self.unknown_users):
-            found_user = User.objects.filter(
-                Q(github_username=commit.git_user) | Q(first_name__contains=commit.commiter_name.split()[0]))
+            words = commit.commiter_name.split()
+            found_user = [
+                u for u in self.all_users
+                if u.github_username == commit.git_user
+                or (words and words[0] in u.first_name)]
             if len(found_user):
                 found_user = found_user[0]
                 if commit.git_user:
@@ -59,9 +73,11 @@ class Import_all_commits(dd.Action):
     label = _("Import All")
 
     def get_commits(self, **kw):
-        for c in kw.get('repo').github_api_get_all_comments(sha=kw.get('sha', None)):
+        for c in kw.get('repo').github_api_get_all_comments(
+                sha=kw.get('sha', None), etag=kw.get('etag', None)):
             #todo Check to make sure the request worked or not
-            commit = rt.models.github.Commit.from_api(c, kw.get('repo'))
+            commit = rt.models.github.Commit.from_api(
+                c, kw.get('repo'), kw.get('known', None))
             yield commit
 
 
@@ -76,29 +92,94 @@ class Import_all_commits(dd.Action):
         if repo is None:
             repo = ar.selected_rows[0]
             kw['repo'] = repo
-        Ticket = rt.models.tickets.Ticket
+        kw['known'] = dict(
+            rt.models.github.Commit.objects.values_list('sha', 'id'))
         user_finder = User_commit_finder()
+        batch = []
         for commit in self.get_commits(**kw):
             commit.user = user_finder.find_user(commit)
+            batch.append(commit)
+            if len(batch) >= dd.plugins.github.import_batch_size:
+                self.save_commits(batch)
+                batch = []
+        if batch:
+            self.save_commits(batch)
+
+    def save_commits(self, commits):
+        """Assign tickets to the given commits and write them to the
+        database, using one query for the tickets, one for the sessions
+        and one bulk write for new and one for known commits."""
+        Ticket = rt.models.tickets.Ticket
+        pattern = dd.plugins['github'].ticket_pattern
 
-            # Parse the title if there's  a ticket #
-            ticket_ids = dd.plugins['github'].ticket_pattern.findall(commit.description)
+        # Parse the title if there's  a ticket #
+        wanted = []
+        for commit in commits:
+            ticket_ids = pattern.findall(commit.description)
             if ticket_ids:
-                try:
-                    commit.ticket = Ticket.objects.get(**{Ticket._meta.pk.name: ticket_ids[0]})
-                except Ticket.DoesNotExist:
-                    pass
-
-            # if no ticket # find Sessions during that time and pick ticket
-            if commit.ticket is None and commit.user is not None:
-                sessions = self.find_sessions(commit, commit.user)
+                wanted.append((commit, int(ticket_ids[0])))
+        tickets = Ticket.objects.in_bulk(set(pk for c, pk in wanted))
+        for commit, pk in wanted:
+            commit.ticket = tickets.get(pk)
+
+        # if no ticket # find Sessions during that time and pick ticket
+        todo = [c for c in commits if c.ticket is None and c.user is not None]
+        if todo:
+            candidates = self.load_sessions(todo)
+            for commit in todo:
+                sessions = [
+                    s for s in candidates.get(commit.user.pk, [])
+                    if self.session_matches(s, commit)]
                 if len(sessions) == 1:
                     commit.ticket = sessions[0].ticket
                 elif len(sessions) > 1:
                     commit.ticket = sessions[0].ticket
                     commit.comment = ", ".join([str(s.ticket) for s in sessions])
-            # commit.full_clean() #Just update records
-            commit.save()
+
+        # commit.full_clean() #Just update records
+        Commit = rt.models.github.Commit
+        new = [c for c in commits if c.id is None]
+        old = [c for c in commits if c.id is not None]
+        with transaction.atomic():
+            if new:
+                Commit.objects.bulk_create(new)
+            if old:
+                Commit.objects.bulk_update(old, COMMIT_FIELDS)
+
+    @staticmethod
+    def load_sessions(commits):
+        """Return a dict mapping user ids to the list of sessions which
+        might match one of the given commits."""
+        dates = [c.created.date() for c in commits]
+        min_date, max_date = min(dates), max(dates)
+        qs = rt.models.working.Session.objects.filter(
+            user__in=set(c.user for c in commits),
+            start_date__lte=max_date, start_time__isnull=False)
+        qs = qs.filter(
+            Q(end_date__gte=min_date) |
+            Q(end_date__isnull=True, start_date__gte=min_date))
+        qs = qs.select_related('ticket').order_by('id')
+        candidates = dict()
+        for s in qs:
+            candidates.setdefault(s.user_id, []).append(s)
+        return candidates
+
+    @staticmethod
+    def session_matches(s, commit):
+        """Same conditions as :meth:`find_sessions`."""
+        d = commit.created.date()
+        t = commit.created.time()
+        if s.end_date is None:
+            #Because some sessiosn don't have a end_date but are finished on the same day.
+            if s.start_date != d:
+                return False
+        elif not (s.start_date <= d <= s.end_date):
+            return False
+        if s.start_time is None or s.start_time > t:
+            return False
+        if s.end_date is None:
+            return True
+        return s.end_time is not None and s.end_time >= t
 
     @staticmethod
     def find_sessions(commit, user):
@@ -121,15 +202,23 @@ class Import_new_commits(Import_all_commits):
 
 
     def get_commits(self, **kw):
-        shas = frozenset(
-            sha[0] for sha in rt.models.github.Commit.objects.values_list('sha')
-                        )
+        shas = kw['known']
+        kw.update(etag=ETAGS.get(kw['repo'].pk, None))
         for commit in super(Import_new_commits, self).get_commits(**kw):
             if commit.sha in shas:
                 break
             else:
                 yield commit
 
+    def run_from_code(self, ar, *args, **kw):
+        repo = kw.get('repo', None)
+        if repo is None:
+            repo = ar.selected_rows[0]
+            kw['repo'] = repo
+        super(Import_new_commits, self).run_from_code(ar, *args, **kw)
+        # remember the ETag only after the commits have been saved
+        ETAGS[repo.pk] = getattr(repo, 'last_etag', None)
+
 
 class Update_all_repos(Import_new_commits):
     show_in_bbar = True
@@ -65,34 +65,49 @@ class Repository(dd.Model):
                                               self.repo_name)
 
     def api_url(self):
-        return "https://api.github.com/repos/%s/%s/" % (self.user_name,
-                                                        self.repo_name)
+        return "%srepos/%s/%s/" % (dd.plugins.github.api_url,
+                                   self.user_name, self.repo_name)
 
     @dd.displayfield(_("Number Of commits"))
     def size(self, ar):
         return self.commits.count()
 
-    def github_api_get_all_comments(self, sha=None):
+    def github_api_get_all_comments(self, sha=None, etag=None):
         """
 
         :return: yields json commits of comments for this repo's master branch untill none are left
+
+        When `etag` is given, the first page is requested conditionally
+        and nothing is yielded when github answers that it has not
+        changed.  The ETag of the first page is stored in
+        :attr:`last_etag`.
         """
         parms = {
             'page': 1,
             'per_page': 100
         }
+        headers = {}
         if self.o_auth:
-            parms['access_token'] = self.o_auth
+            headers['Authorization'] = "token " + self.o_auth
 
         if sha is not None:
             parms['sha'] = sha
-        r = requests.get(self.api_url() + 'commits', parms)
+        session = requests.Session()
+        session.headers.update(headers)
+        url = self.api_url() + 'commits'
+        if etag:
+            r = session.get(url, params=parms, headers={'If-None-Match': etag})
+        else:
+            r = session.get(url, params=parms)
+        self.last_etag = r.headers.get('ETag', etag)
+        if r.status_code == 304:
+            return
         content = json.loads(r.content.decode())
         for c in content:
             yield c
         while 'rel="next"' in r.headers.get('link', ""):
             parms['page'] += 1
-            r = requests.get(self.api_url() + 'commits', parms)
+            r = session.get(url, params=parms)
             content = json.loads(r.content.decode())
             for c in content:
                 yield c
@@ -197,17 +212,21 @@ class Commit(Created, Authored):
 
 
     @classmethod
-    def from_api(cls, d, repo):
+    def from_api(cls, d, repo, known=None):
         """
         :param d: dict representing the commit from the api
         :param repo: repo which this commit is from
+        :param known: optional dict mapping the sha of every known commit to its id
         :return: Commit instance, without doing session lookup, just parses json return values and returns instance.
         """
-        try:
-            c = Commit.objects.get(sha=d['sha'])
-            id = c.id
-        except Commit.DoesNotExist:
-            id = None
+        if known is not None:
+            id = known.get(d['sha'])
+        else:
+            try:
+                c = Commit.objects.get(sha=d['sha'])
+                id = c.id
+            except Commit.DoesNotExist:
+                id = None
 
         params = dict(
             id=id,
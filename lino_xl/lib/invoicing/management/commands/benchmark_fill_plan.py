@@ -0,0 +1,91 @@
+# -*- coding: UTF-8 -*-
+# Copyright 2020 Rumma & Ko Ltd
+# License: BSD (see file COPYING for details)
+
+"""Defines the :manage:`benchmark_fill_plan` admin command:
+
+.. management_command:: benchmark_fill_plan
+
+.. py2rst::
+
+  from lino_xl.lib.invoicing.management.commands.benchmark_fill_plan \
+      import Command
+  print(Command.help)
+
+
+"""
+
+from __future__ import unicode_literals, print_function
+
+import time
+import datetime
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
+from lino.api import dd, rt
+
+from lino_xl.lib.cal.choicelists import DurationUnits
+
+
+def benchmark_fill_plan(username=None):
+    """Called by :manage:`benchmark_fill_plan`. See there."""
+    from lino_xl.lib.ledger.roles import LedgerStaff
+    Plan = rt.models.invoicing.Plan
+    Area = rt.models.invoicing.Area
+    if username is None:
+        accountants = LedgerStaff.get_user_profiles()
+        users = rt.models.users.User.objects.filter(
+            language=dd.get_default_language(), user_type__in=accountants)
+        if users.count() == 0:
+            dd.logger.info("No accountant to run the invoicing plans.")
+            return
+        username = users.first().username
+    ses = rt.login(username)
+
+    plans = generators = items = queries = 0
+    seconds = 0.0
+    for area in Area.objects.all():
+        today = datetime.date(dd.plugins.ledger.start_year, 1, 1)
+        while today < dd.demo_date(-60):
+            plan = Plan(user=ses.get_user(), today=today, area=area)
+            plan.full_clean()
+            plan.save()
+            generators += len(list(plan.get_generators_for_plan()))
+            with CaptureQueriesContext(connection) as ctx:
+                t0 = time.time()
+                plan.fill_plan(ses)
+                seconds += time.time() - t0
+            queries += len(ctx.captured_queries)
+            items += plan.items.count()
+            plans += 1
+            plan.delete()
+            today = DurationUnits.months.add_duration(today, 1)
+
+    dd.logger.info(
+        "fill_plan() for %d plans: %d generators, %d items, %d queries, "
+        "%.3f seconds", plans, generators, items, queries, seconds)
+
+
+class Command(BaseCommand):
+    help = """
+
+    Measure the time and number of database queries used by
+    :meth:`Plan.fill_plan <lino_xl.lib.invoicing.Plan.fill_plan>`.
+
+    Fills one invoicing plan per area and month over the whole period
+    covered by the demo bookings, i.e. for every invoice generator of
+    the demo database, and then deletes these plans again, so the
+    database content remains unchanged.
+
+    """
+
+    def add_arguments(self, parser):
+        parser.add_argument('-u', '--username', dest='username',
+                            default=None,
+                            help='The user who runs the plans '
+                            '(default: the first accountant).')
+
+    def handle(self, *args, **options):
+        benchmark_fill_plan(options['username'])
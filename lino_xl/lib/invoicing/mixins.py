@@ -18,10 +18,17 @@ from lino_xl.lib.ledger.utils import ZERO
 from lino_xl.lib.cal.utils import day_and_month
 
 from django.contrib.contenttypes.fields import GenericRelation
+from django.contrib.contenttypes.models import ContentType
 
 MAX_SHOWN = 3  # maximum number of invoiced events shown in
                # invoicing_info
 
+def get_editable_states():
+    state_field = dd.plugins.invoicing.voucher_model._meta.get_field(
+        'state')
+    return state_field.choicelist.get_editable_states()
+
+
 class InvoicingInfo(object):
     invoiced_qty = ZERO
     invoiced_events = 0
@@ -35,21 +42,18 @@ class InvoicingInfo(object):
     min_asset = None
     max_asset = None
 
-    def __init__(self, enr, max_date=None):
+    def __init__(self, enr, max_date=None, invoicings=None, used_events=None):
         self.generator = enr
         self.max_date = max_date
         
-        max_date = self.max_date or dd.today()
+        start_date, max_date = enr.get_invoiceable_window(self.max_date)
         end_date = enr.get_invoiceable_end_date()
-        if end_date:
-            max_date = min(max_date, end_date)
-        
+
         product = enr.get_invoiceable_product(max_date)
         # if not product:
         #     # dd.logger.info("20181116c no product")
         #     return
         
-        start_date = enr.get_invoiceable_start_date(max_date)
 
         # if hasattr(product, 'tariff'):
         #     self.tariff = product.tariff
@@ -69,13 +73,17 @@ class InvoicingInfo(object):
             # dd.logger.info("20181116 e no tariff")
             # return
 
-        state_field = dd.plugins.invoicing.voucher_model._meta.get_field(
-            'state')
-        vstates = state_field.choicelist.get_editable_states()
-        qs = enr.invoicings.exclude(voucher__state__in=vstates)
-        if product is not None:
-            qs = qs.filter(product=product)
-        self.invoicings = qs
+        if invoicings is None:
+            qs = enr.invoicings.exclude(voucher__state__in=get_editable_states())
+            if product is not None:
+                qs = qs.filter(product=product)
+            self.invoicings = qs
+        else:
+            # preloaded by InvoiceGenerator.load_invoicing_info()
+            if product is not None:
+                invoicings = [obj for obj in invoicings
+                              if obj.product_id == product.pk]
+            self.invoicings = invoicings
 
         self.invoiced_events = enr.get_invoiceable_free_events() or 0
             
@@ -100,8 +108,9 @@ class InvoicingInfo(object):
         # which sets the asset to min_asset.
 
         # print("20181116 f %s", self.tariff.number_of_events)
-        self.used_events = list(enr.get_invoiceable_events(
-            start_date, max_date))
+        if used_events is None:
+            used_events = enr.get_invoiceable_events(start_date, max_date)
+        self.used_events = list(used_events)
         asset = self.invoiced_events - len(self.used_events)
         
         # dd.logger.info(
@@ -287,6 +296,17 @@ class InvoiceGenerator(dd.Model):
         # don't look at events before this date.
         return None
 
+    def get_invoiceable_window(self, max_date=None):
+        """Return a tuple `(start_date, max_date)` with the period whose
+        events are to be considered when invoicing until `max_date`.
+
+        """
+        max_date = max_date or dd.today()
+        end_date = self.get_invoiceable_end_date()
+        if end_date:
+            max_date = min(max_date, end_date)
+        return self.get_invoiceable_start_date(max_date), max_date
+
     def get_invoiceable_events(self, start_date, max_date):
         yield self
     
@@ -326,6 +346,53 @@ class InvoiceGenerator(dd.Model):
     def get_generators_for_plan(cls, plan, partner=None):
         return []
 
+    @classmethod
+    def load_invoicing_info(cls, generators, max_date=None):
+        """Compute and cache the invoicing info of the given generators
+        (all instances of this model) using grouped queries.
+
+        Loads the existing invoicings of all generators with a single
+        query and asks :meth:`load_invoiceable_events` for their
+        invoiceable events within their :meth:`get_invoiceable_window`.
+
+        """
+        item_model = dd.plugins.invoicing.item_model
+        ct = ContentType.objects.get_for_model(cls)
+        invoicings = dict()
+        for g in generators:
+            invoicings[g.pk] = []
+        qs = item_model.objects.filter(
+            invoiceable_type=ct, invoiceable_id__in=list(invoicings.keys()))
+        qs = qs.exclude(voucher__state__in=get_editable_states())
+        for obj in qs.select_related('voucher'):
+            invoicings[obj.invoiceable_id].append(obj)
+        windows = {g.pk: g.get_invoiceable_window(max_date)
+                   for g in generators}
+        events = cls.load_invoiceable_events(generators, windows)
+        for g in generators:
+            if events is None:
+                used_events = None
+            else:
+                used_events = events.get(g.pk, [])
+            g._invoicing_info = InvoicingInfo(
+                g, max_date, invoicings[g.pk], used_events)
+
+    @classmethod
+    def load_invoiceable_events(cls, generators, windows):
+        """Return a dict that maps the primary key of each of the given
+        generators to the list of its invoiceable events, or `None` if
+        this model has no grouped query for them (in which case
+        :meth:`get_invoiceable_events` is called for every generator).
+
+        `windows` maps the primary key of each generator to the
+        `(start_date, max_date)` returned by its
+        :meth:`get_invoiceable_window`.  An implementation must return
+        for every generator the same events as
+        :meth:`get_invoiceable_events` would return for that window.
+
+        """
+        return None
+
     def setup_invoice_item(self, item):
         pass
     
@@ -209,18 +209,44 @@ class Plan(UserPlan):
         collected = dict()
         # dd.logger.info("20181114 a")
         max_date = self.get_max_date()
+        if dd.is_installed('products'):
+            # price rules may have been changed by another process
+            rt.models.products.clear_price_rules()
 
+        generators = []
+        by_model = dict()
         for ig in self.get_generators_for_plan():
             partner = ig.get_invoiceable_partner()
             if partner is None:
                 continue
                 # raise Exception("{!r} has no invoice recipient".format(
                 #     ig))
-            if hasattr(partner, 'salesrule'):
-                partner = partner.salesrule.invoice_recipient or partner
+            generators.append((ig, partner))
+            by_model.setdefault(ig.__class__, []).append(ig)
+
+        # load invoicings, invoiceable events and invoice recipients
+        # for all generators at once
+        for m, lst in by_model.items():
+            m.load_invoicing_info(lst, max_date)
+        recipients = dict(rt.models.invoicing.SalesRule.objects.filter(
+            partner__in=set([p.pk for ig, p in generators]),
+            invoice_recipient__isnull=False).values_list(
+                'partner', 'invoice_recipient'))
+        recipient_objects = rt.models.contacts.Partner.objects.in_bulk(
+            set(recipients.values()))
+
+        invoices = dict()
+        items = []
+        for ig, partner in generators:
+            pk = recipients.get(partner.pk)
+            if pk is not None:
+                partner = recipient_objects[pk]
 
-            invoice = self.create_invoice(
-                partner=partner, user=ar.get_user())
+            invoice = invoices.get(partner.pk)
+            if invoice is None:
+                invoice = self.create_invoice(
+                    partner=partner, user=ar.get_user())
+                invoices[partner.pk] = invoice
 
             # dd.logger.info("20181114 b", obj)
             info = ig.compute_invoicing_info(max_date)
@@ -237,8 +263,10 @@ class Plan(UserPlan):
                 if item is None:
                     item = Item(plan=self, partner=partner)
                     collected[partner.pk] = item
+                    items.append(item)
             else:
                 item = Item(plan=self, partner=partner, generator=ig)
+                items.append(item)
                 # collected[obj] = item
 
                 # gfk = self._meta.get_field('owner')
@@ -308,8 +336,14 @@ class Plan(UserPlan):
 
             item.amount = total_amount
             # item.number_of_invoiceables += 1
-            item.full_clean()
-            item.save()
+
+        # the foreign keys are known to be valid, validating them
+        # would cost one query per item and field
+        exclude = [f.name for f in Item._meta.concrete_fields
+                   if f.is_relation]
+        for item in items:
+            item.full_clean(exclude=exclude)
+        Item.objects.bulk_create(items)
 
     def create_invoice(self, **kwargs):
         # ITEM_MODEL = dd.plugins.invoicing.item_model
@@ -11,6 +11,7 @@ See :doc:`/specs/ledger`.
     roles
     fields
     management.commands.reregister
+    management.commands.benchmark_clearings
 
 """
 
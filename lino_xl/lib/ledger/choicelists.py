@@ -59,6 +59,16 @@ add('10', _("Open"), 'open')
 add('20', _("Closed"), 'closed')
 
 
+@dd.receiver(dd.pre_analyze)
+def setup_period_workflow(sender=None, **kw):
+    PeriodStates.closed.add_transition(
+        _("Close"), required_states='open',
+        required_roles=dd.login_required(LedgerStaff))
+    PeriodStates.open.add_transition(
+        _("Reopen"), required_states='closed',
+        required_roles=dd.login_required(LedgerStaff))
+
+
 class CommonAccount(dd.Choice):
     show_values = True
     clearable = False
@@ -0,0 +1,96 @@
+# -*- coding: UTF-8 -*-
+# Copyright 2020 Rumma & Ko Ltd
+# License: BSD (see file COPYING for details)
+
+"""Defines the :manage:`benchmark_clearings` admin command:
+
+.. management_command:: benchmark_clearings
+
+.. py2rst::
+
+  from lino_xl.lib.ledger.management.commands.benchmark_clearings \
+      import Command
+  print(Command.help)
+
+
+"""
+
+from __future__ import unicode_literals, print_function
+
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
+from lino.api import dd, rt
+
+from lino_xl.lib.ledger.models import check_clearings_by_partner
+from lino_xl.lib.ledger.models import check_clearings_by_match
+
+
+def benchmark_clearings(num_vouchers):
+    """Called by :manage:`benchmark_clearings`. See there."""
+    Movement = rt.models.ledger.Movement
+    Voucher = rt.models.ledger.Voucher
+    qs = Voucher.objects.filter(journal__auto_check_clearings=True)
+    qs = qs.filter(movement__partner__isnull=False).distinct()
+    qs = qs.order_by('-id')[:num_vouchers]
+
+    results = dict(old=[0, 0.0], new=[0, 0.0])
+    count = 0
+    for voucher in qs:
+        keys = set(Movement.objects.filter(
+            voucher=voucher, partner__isnull=False).values_list(
+                'partner', 'match'))
+        partners = rt.models.contacts.Partner.objects.filter(
+            pk__in=set([k[0] for k in keys]))
+
+        def old():
+            for p in partners:
+                check_clearings_by_partner(p)
+
+        def new():
+            check_clearings_by_match(keys)
+
+        for name, func in (('old', old), ('new', new)):
+            with CaptureQueriesContext(connection) as ctx:
+                t0 = time.time()
+                func()
+                results[name][1] += time.time() - t0
+            results[name][0] += len(ctx.captured_queries)
+        count += 1
+
+    if count == 0:
+        dd.logger.info("No registered vouchers with partner movements.")
+        return
+    for name in ('old', 'new'):
+        queries, seconds = results[name]
+        dd.logger.info(
+            "%s engine: %d vouchers, %d queries, %.3f seconds "
+            "(%.1f ms per voucher)", name, count, queries, seconds,
+            seconds * 1000 / count)
+
+
+class Command(BaseCommand):
+    help = """
+
+    Compare the speed of the partner-based clearing engine with the
+    match-based one.
+
+    Runs both :func:`check_clearings_by_partner` and
+    :func:`check_clearings_by_match` for the partners and match groups
+    of the last registered vouchers of the database (usually a
+    generated demo ledger) and reports the number of queries and the
+    time used by each of them.  Both engines just recompute the
+    `cleared` status, so the database content remains unchanged.
+
+    """
+
+    def add_arguments(self, parser):
+        parser.add_argument('-n', '--vouchers', type=int,
+                            dest='vouchers', default=100,
+                            help='Number of vouchers to check.')
+
+    def handle(self, *args, **options):
+        benchmark_clearings(options['vouchers'])
@@ -3,11 +3,15 @@
 # License: BSD (see file COPYING for details)
 
 import datetime
+import functools
+import operator
 
 from atelier.utils import last_day_of_month
 from dateutil.relativedelta import relativedelta
 from django.conf import settings
 from django.core.exceptions import ValidationError
+from django.db import transaction
+from django.db.models.functions import Coalesce
 from django.dispatch import Signal
 from django.utils.text import format_lazy
 
@@ -241,6 +245,7 @@ class AccountingPeriod(DateRange, Referrable):
         ordering = ['ref']
 
     preferred_foreignkey_width = 10
+    workflow_state_field = 'state'
 
     state = PeriodStates.field(default='open')
     year = dd.ForeignKey('ledger.FiscalYear', blank=True, null=True)
@@ -339,9 +344,128 @@ class AccountingPeriod(DateRange, Referrable):
             # "{0} {1} (#{0})".format(self.pk, self.year)
         return self.ref
 
+    def after_state_change(self, ar, oldstate, newstate):
+        if newstate == PeriodStates.closed:
+            PeriodBalance.build_for_period(self)
+        else:
+            PeriodBalance.invalidate(self)
+        super(AccountingPeriod, self).after_state_change(
+            ar, oldstate, newstate)
+
 AccountingPeriod.set_widget_options('ref', width=6)
 
 
+class PeriodBalance(dd.Model):
+    """A snapshot of the cumulated debit and credit totals of an account
+    (and partner) at the end of a closed accounting period.
+
+    Snapshots are created when an accounting period gets closed and
+    removed (for the period and all later periods) when a voucher of
+    that period gets registered or deregistered.  They are used to
+    compute opening balances without summing up all movements since the
+    beginning.
+
+    """
+    class Meta:
+        app_label = 'ledger'
+        verbose_name = _("Period balance")
+        verbose_name_plural = _("Period balances")
+
+    allow_cascaded_delete = ['period', 'account', 'partner']
+
+    period = dd.ForeignKey('ledger.AccountingPeriod')
+    account = dd.ForeignKey('ledger.Account')
+    partner = dd.ForeignKey('contacts.Partner', blank=True, null=True)
+    debit = dd.PriceField(_("Debit"), default=ZERO)
+    credit = dd.PriceField(_("Credit"), default=ZERO)
+
+    snapshot_links = {'account', 'partner'}
+
+    @classmethod
+    def get_latest_period(cls, period):
+        """Return the latest closed period before the given period for which
+        a snapshot exists, or `None`."""
+        qs = AccountingPeriod.objects.filter(
+            ref__lt=period.ref, state=PeriodStates.closed,
+            periodbalance__isnull=False)
+        return qs.order_by('-ref').first()
+
+    @classmethod
+    def invalidate(cls, period):
+        """Remove the snapshots of the given period and of all later
+        periods."""
+        cls.objects.filter(period__ref__gte=period.ref).delete()
+
+    @classmethod
+    def build_for_period(cls, period):
+        """Create the snapshot for the given period, starting from the
+        latest existing snapshot before it."""
+        cls.objects.filter(period=period).delete()
+        prev = cls.get_latest_period(period)
+        sums = dict()
+        periods = AccountingPeriod.objects.filter(ref__lte=period.ref)
+        if prev is not None:
+            periods = periods.filter(ref__gt=prev.ref)
+            for obj in cls.objects.filter(period=prev):
+                sums[(obj.account_id, obj.partner_id)] = [
+                    obj.debit, obj.credit]
+        qs = rt.models.ledger.Movement.objects.filter(
+            voucher__accounting_period__in=periods)
+        qs = qs.order_by().values('account', 'partner', 'dc')
+        for row in qs.annotate(total=models.Sum('amount')):
+            totals = sums.setdefault(
+                (row['account'], row['partner']), [ZERO, ZERO])
+            if row['dc'] == DEBIT:
+                totals[0] += row['total']
+            else:
+                totals[1] += row['total']
+        cls.objects.bulk_create([
+            cls(period=period, account_id=k[0], partner_id=k[1],
+                debit=v[0], credit=v[1])
+            for k, v in sums.items()])
+
+    @classmethod
+    def add_old_annotations(cls, kw, outer_link, flt, start_period,
+                            output_field=None):
+        """Add to `kw` two annotations `old_d` and `old_c` with the debit and
+        credit totals of the movements matching `flt` before the given
+        start period.
+
+        `flt` may contain an :class:`OuterRef` and `outer_link` is the
+        field to group the movements by.  When possible the totals are
+        computed from the latest snapshot plus the movements after it.
+
+        """
+        if output_field is None:
+            output_field = dd.PriceField()
+        snapshot = None
+        if set([k.split('__')[0] for k in flt]) <= cls.snapshot_links:
+            snapshot = cls.get_latest_period(start_period)
+        periods = AccountingPeriod.objects.filter(ref__lt=start_period.ref)
+        if snapshot is not None:
+            periods = periods.filter(ref__gt=snapshot.ref)
+        mvtflt = dict(flt)
+        mvtflt.update(voucher__accounting_period__in=periods)
+        zero = models.Value(ZERO, output_field=output_field)
+        for name, dc, fldname in (
+                ('old_d', DEBIT, 'debit'), ('old_c', CREDIT, 'credit')):
+            mvts = rt.models.ledger.Movement.objects.filter(dc=dc, **mvtflt)
+            mvts = mvts.order_by().values(outer_link)
+            mvts = mvts.annotate(total=models.Sum(
+                'amount', output_field=output_field)).values('total')
+            expr = models.Subquery(mvts, output_field=output_field)
+            if snapshot is not None:
+                bals = cls.objects.filter(period=snapshot, **flt)
+                bals = bals.order_by().values(outer_link)
+                bals = bals.annotate(total=models.Sum(
+                    fldname, output_field=output_field)).values('total')
+                expr = models.ExpressionWrapper(
+                    Coalesce(models.Subquery(
+                        bals, output_field=output_field), zero)
+                    + Coalesce(expr, zero), output_field=output_field)
+            kw[name] = expr
+
+
 
 class FiscalYear(DateRange, Referrable):
 
@@ -700,21 +824,43 @@ class Voucher(UserAuthored, Duplicable, UploadController, PeriodRangeObservable)
     # def get_voucher_match(self):
     #     return str(self)  # "{0}{1}".format(self.journal.ref, self.number)
 
-    def do_and_clear(self, func, do_clear):
+    def do_and_clear(self, func, do_clear, deferred_clearings=None):
+        """If `deferred_clearings` is a set, add the match groups touched
+        by this voucher to it instead of checking them.  See
+        :func:`register_vouchers`.
+
+        When a voucher gets (de)registered via its workflow, the
+        `deferred_clearings` attribute of the action request, if
+        present, is used as this set.
+
+        """
         existing_mvts = self.movement_set.all()
+        if self.accounting_period_id:
+            PeriodBalance.invalidate(self.accounting_period)
         partners = set()
+        matches = set()
         # accounts = set()
         if not self.journal.auto_check_clearings:
             do_clear = False
         if do_clear:
-            for m in existing_mvts.filter(
-                    account__clearable=True, partner__isnull=False):
-                partners.add(m.partner)
+            for k in existing_mvts.filter(
+                    account__clearable=True, partner__isnull=False
+            ).values_list('partner', 'match'):
+                matches.add(k)
+                partners.add(k[0])
         existing_mvts.delete()
         func(partners)
         if do_clear:
-            for p in partners:
-                check_clearings_by_partner(p)
+            # only the match groups touched by this voucher can change
+            # their cleared status
+            matches |= set(self.movement_set.filter(
+                partner__isnull=False).values_list('partner', 'match'))
+            if deferred_clearings is None:
+                check_clearings_by_match(matches)
+            else:
+                deferred_clearings |= matches
+            # for p in partners:
+            #     check_clearings_by_partner(p)
             # for a in accounts:
             #     check_clearings_by_account(a)
 
@@ -813,15 +959,23 @@ class RegistrableVoucher(Registrable, Voucher):
     def after_state_change(self, ar, oldstate, newstate):
         # movements are created *after* having changed the state, because
         # otherwise the match isn't correct.
+        # a batch may ask to check the clearings only at the end (see
+        # do_and_clear())
+        deferred = getattr(ar, 'deferred_clearings', None)
         if newstate.name == 'draft':
-            self.deregister_voucher(ar)
+            self.deregister_voucher(ar, deferred_clearings=deferred)
         elif newstate.name == 'registered':
-            self.register_voucher(ar)
+            self.register_voucher(ar, deferred_clearings=deferred)
         super(RegistrableVoucher, self).after_state_change(ar, oldstate, newstate)
 
-    def register_voucher(self, ar=None, do_clear=True):
+    def register_voucher(self, ar=None, do_clear=True,
+                         deferred_clearings=None):
         """
         Delete any existing movements and re-create them.
+
+        The movements are validated in memory and then written using a
+        single bulk insert.  Everything happens within a single
+        database transaction.
         """
         # dd.logger.info("20151211 cosi.Voucher.register_voucher()")
         # self.year = FiscalYears.get_or_create_from_date(self.entry_date)
@@ -835,7 +989,16 @@ class RegistrableVoucher(Registrable, Voucher):
             # self.full_clean()
             # self.save()
 
+            # Foreign keys point to existing database objects, so
+            # validating them would cost one query per key and
+            # movement.  We just check that required ones are given.
+            Movement = rt.models.ledger.Movement
+            fks = [f for f in Movement._meta.concrete_fields
+                   if f.is_relation]
+            exclude = [f.name for f in fks]
+            required = [f for f in fks if not f.null]
             fcu = dd.plugins.ledger.suppress_movements_until
+            wanted = []
             for m in movements:
                 # don't create movements before suppress_movements_until
                 if fcu and m.value_date <= fcu:
@@ -847,26 +1010,35 @@ class RegistrableVoucher(Registrable, Voucher):
                 m.seqno = seqno
                 # m.cleared = True
                 try:
-                    m.full_clean()
+                    errors = {
+                        f.name: [f.error_messages['null']] for f in required
+                        if getattr(m, f.attname) is None}
+                    if errors:
+                        raise ValidationError(errors)
+                    m.full_clean(exclude=exclude)
                 except ValidationError as e:
                     dd.logger.warning("20181116 %s : %s", e, dd.obj2str(m))
-                    return
-                m.save()
-                if m.partner:
-                    partners.add(m.partner)
+                    seqno -= 1
+                    break
+                wanted.append(m)
+                if m.partner_id:
+                    partners.add(m.partner_id)
+            Movement.objects.bulk_create(wanted)
             if settings.SITE.history_aware_logging:
                 dd.logger.info("Register %s (%d movements, %d partners)",
                     self, seqno, len(partners))
 
-        self.do_and_clear(doit, do_clear)
+        with transaction.atomic():
+            self.do_and_clear(doit, do_clear, deferred_clearings)
 
-    def deregister_voucher(self, ar, do_clear=True):
+    def deregister_voucher(self, ar, do_clear=True, deferred_clearings=None):
 
         def doit(partners):
             if settings.SITE.history_aware_logging:
                 dd.logger.info("Deregister %s (%d partners)", self, len(partners))
 
-        self.do_and_clear(doit, do_clear)
+        with transaction.atomic():
+            self.do_and_clear(doit, do_clear, deferred_clearings)
 
 
 class Declaration(Payable, RegistrableVoucher, Certifiable, PeriodRange):
@@ -1183,9 +1355,68 @@ PartnerEvents.add_item_instance(
 on_ledger_movement = Signal(['instance'])
 
 
+class VoucherInfoCache(object):
+    """Caches the MTI leaf of vouchers together with their due date,
+    trade type and bank account.
+
+    Used by :class:`DueMovement` so that collecting a series of
+    movements does not cost one query per movement.  The leaves are
+    loaded in bulk, one query per voucher model.
+
+    """
+    def __init__(self):
+        self.leaves = dict()
+        self.infos = dict()
+
+    def load(self, vouchers):
+        """Load the leaves of the given vouchers that are not yet known."""
+        todo = dict()
+        for voucher in vouchers:
+            if voucher.pk in self.leaves:
+                continue
+            model = voucher.journal.voucher_type.model
+            todo.setdefault(model, set()).add(voucher.pk)
+        for model, ids in todo.items():
+            qs = model.objects.filter(pk__in=ids)
+            related = ['journal']
+            if hasattr(model, 'bank_account'):
+                related.append('bank_account')
+            qs = qs.select_related(*related)
+            for leaf in qs:
+                self.leaves[leaf.pk] = leaf
+            for pk in ids:
+                # mti.get_child() returns None when there is no leaf
+                self.leaves.setdefault(pk, None)
+
+    def get_leaf(self, voucher):
+        if voucher.pk not in self.leaves:
+            self.load([voucher])
+        return self.leaves[voucher.pk]
+
+    def get_info(self, voucher):
+        """Return a tuple `(leaf, due_date, trade_type, bank_account)` for
+        the given voucher.  `leaf` is `None` when the voucher has no
+        leaf.
+
+        """
+        info = self.infos.get(voucher.pk)
+        if info is None:
+            leaf = self.get_leaf(voucher)
+            if leaf is None:
+                info = (None, None, None, None)
+            else:
+                info = (leaf, leaf.get_due_date(), leaf.get_trade_type(),
+                        leaf.get_bank_account())
+            self.infos[voucher.pk] = info
+        return info
+
+
 class DueMovement(TableRow):
-    def __init__(self, dc, mvt):
+    def __init__(self, dc, mvt, cache=None):
         self.dc = dc
+        if cache is None:
+            cache = VoucherInfoCache()
+        self.voucher_cache = cache
         # self.match = mvt.get_match()
         self.match = mvt.match
         self.partner = mvt.partner
@@ -1222,9 +1453,18 @@ class DueMovement(TableRow):
     def collect_all(self):
         flt = dict(
             partner=self.partner, account=self.account, match=self.match)
-        for mvt in rt.models.ledger.Movement.objects.filter(**flt):
+        qs = rt.models.ledger.Movement.objects.filter(**flt)
+        qs = qs.select_related('voucher__journal')
+        mvts = list(qs)
+        self.voucher_cache.load([mvt.voucher for mvt in mvts])
+        for mvt in mvts:
             self.collect(mvt)
 
+    def get_voucher_leaf(self, mvt):
+        """Return the MTI leaf of the voucher of the given movement, using
+        the cache of this due movement."""
+        return self.voucher_cache.get_leaf(mvt.voucher)
+
     def collect(self, mvt):
         """
         Add the given movement to the list of movements that are being
@@ -1236,20 +1476,18 @@ class DueMovement(TableRow):
         else:
             self.has_unsatisfied_movement = True
 
-        voucher = mvt.voucher.get_mti_leaf()
-        # voucher = mvt.voucher
+        info = self.voucher_cache.get_info(mvt.voucher)
+        voucher, due_date, trade_type, bank_account = info
         if voucher is None:
             return
-        due_date = voucher.get_due_date()
         if self.due_date is None or due_date < self.due_date:
             self.due_date = due_date
 
         if self.trade_type is None:
-            self.trade_type = voucher.get_trade_type()
+            self.trade_type = trade_type
         if mvt.dc == self.dc:
             self.debts.append(mvt)
             self.balance += mvt.amount
-            bank_account = voucher.get_bank_account()
             if bank_account is not None:
                 if self.bank_account != bank_account:
                     self.bank_account = bank_account
@@ -1281,24 +1519,38 @@ class DueMovement(TableRow):
                 m.save()
 
 
-def get_due_movements(dc, flt):
+def get_due_movements(dc, flt, cache=None):
+    """Yield a :class:`DueMovement` for every unbalanced match group of
+    the clearable movements matching the given filter.
+
+    The vouchers of these movements are loaded in bulk into the given
+    :class:`VoucherInfoCache`.  Pass an existing cache to share it
+    among several calls.
+
+    """
     if dc is None:
         return
+    if cache is None:
+        cache = VoucherInfoCache()
     qs = rt.models.ledger.Movement.objects.filter(flt)
     qs = qs.filter(account__clearable=True)
+    qs = qs.select_related(*dd.plugins.ledger.remove_dummy(
+        'partner', 'account', 'voucher__journal', 'project'))
     # qs = qs.exclude(match='')
     qs = qs.order_by(*dd.plugins.ledger.remove_dummy(
         'value_date', 'account__ref', 'partner', 'project', 'id'))
 
+    mvts = list(qs)
+    cache.load([mvt.voucher for mvt in mvts])
 
     matches_by_account = dict()
     matches = []
-    for mvt in qs:
+    for mvt in mvts:
         k = (mvt.account, mvt.partner, mvt.project, mvt.match)
         # k = (mvt.account, mvt.partner, mvt.project, mvt.get_match())
         dm = matches_by_account.get(k)
         if dm is None:
-            dm = DueMovement(dc, mvt)
+            dm = DueMovement(dc, mvt, cache)
             matches_by_account[k] = dm
             matches.append(dm)
         dm.collect(mvt)
@@ -1351,3 +1603,76 @@ def check_clearings(qs, matches=[]):
         match, account = k
         sat = (balance == ZERO)
         qs.filter(account=account, match=match).update(cleared=sat)
+
+
+CLEARING_CHUNK_SIZE = 200
+
+
+def check_clearings_by_match(keys):
+    """Check and update the cleared status of the movements in the given
+    match groups.
+
+    `keys` is an iterable of `(partner_id, match)` tuples.  Unlike
+    :func:`check_clearings_by_partner`, this looks only at the
+    movements of these match groups, computes their balances using a
+    single grouped aggregate and updates the `cleared` field using at
+    most two bulk updates per chunk of groups.
+
+    """
+    keys = set(keys)
+    if len(keys) == 0:
+        return
+    Movement = rt.models.ledger.Movement
+    Partner = rt.models.contacts.Partner
+    partners = set([k[0] for k in keys])
+    qs = Movement.objects.filter(
+        partner__in=partners, match__in=set([k[1] for k in keys]))
+    qs = qs.values('partner', 'account', 'match').annotate(
+        debit=models.Sum('amount', filter=models.Q(dc=DEBIT)),
+        credit=models.Sum('amount', filter=models.Q(dc=CREDIT)))
+    satisfied = []
+    unsatisfied = []
+    for row in qs.order_by():
+        if (row['partner'], row['match']) not in keys:
+            continue
+        balance = (row['debit'] or ZERO) - (row['credit'] or ZERO)
+        flt = models.Q(partner=row['partner'], account=row['account'],
+                       match=row['match'])
+        if balance == ZERO:
+            satisfied.append(flt)
+        else:
+            unsatisfied.append(flt)
+
+    def update(filters, cleared):
+        # keep the WHERE clause reasonably small
+        for i in range(0, len(filters), CLEARING_CHUNK_SIZE):
+            flt = functools.reduce(
+                operator.or_, filters[i:i+CLEARING_CHUNK_SIZE])
+            Movement.objects.filter(flt).exclude(
+                cleared=cleared).update(cleared=cleared)
+
+    update(satisfied, True)
+    update(unsatisfied, False)
+
+    for partner in Partner.objects.filter(pk__in=partners):
+        on_ledger_movement.send(sender=partner.__class__, instance=partner)
+
+
+def register_vouchers(vouchers, ar=None):
+    """Re-create the movements of the given registered vouchers and then
+    check the clearings of all touched match groups in a single pass.
+
+    This is meant for batch registration (e.g. at the end of a month),
+    where calling :meth:`RegistrableVoucher.register_voucher` for each
+    voucher would check the same match groups over and over.  The
+    caller is responsible for setting the state of the vouchers.
+
+    """
+    matches = set()
+    count = 0
+    with transaction.atomic():
+        for voucher in vouchers:
+            voucher.register_voucher(ar, deferred_clearings=matches)
+            count += 1
+        check_clearings_by_match(matches)
+    return count
@@ -189,7 +189,7 @@ class AccountingPeriods(dd.Table):
     required_roles = dd.login_required(LedgerStaff)
     model = 'ledger.AccountingPeriod'
     order_by = ["ref", "start_date", "year"]
-    column_names = "ref start_date end_date year state remark *"
+    column_names = "ref start_date end_date year workflow_buttons remark *"
 
 
 class PaymentTerms(dd.Table):
@@ -367,13 +367,13 @@ class ExpectedMovements(dd.VirtualTable):
         _("Debts"), help_text=_("List of invoices in this match group"))
     def debts(self, row, ar):
         return E.span(*join_elems([   # E.p(...) until 20150128
-            ar.obj2html(i.voucher.get_mti_leaf()) for i in row.debts]))
+            ar.obj2html(row.get_voucher_leaf(i)) for i in row.debts]))
 
     @dd.displayfield(
         _("Payments"), help_text=_("List of payments in this match group"))
     def payments(self, row, ar):
         return E.span(*join_elems([    # E.p(...) until 20150128
-            ar.obj2html(i.voucher.get_mti_leaf()) for i in row.payments]))
+            ar.obj2html(row.get_voucher_leaf(i)) for i in row.payments]))
 
     @dd.virtualfield(dd.PriceField(_("Balance")))
     def balance(self, row, ar):
@@ -538,15 +538,10 @@ class AccountBalances(dd.Table):
         qs = super(AccountBalances, self).get_request_queryset(ar)
 
         flt = self.rowmvtfilter(ar)
-        oldflt = dict()
-        oldflt.update(flt)
         duringflt = dict()
         duringflt.update(flt)
         during_periods = AccountingPeriod.objects.filter(
             ref__gte=sp.ref, ref__lte=ep.ref)
-        before_periods = AccountingPeriod.objects.filter(
-            ref__lt=sp.ref)
-        oldflt.update(voucher__accounting_period__in=before_periods)
         duringflt.update(voucher__accounting_period__in=during_periods)
 
         outer_link = self.model._meta.model_name
@@ -561,8 +556,8 @@ class AccountBalances(dd.Table):
             kw[name] = Subquery(mvts, output_field=dd.PriceField())
 
         kw = dict()
-        addann(kw, 'old_d', DEBIT, oldflt)
-        addann(kw, 'old_c', CREDIT, oldflt)
+        rt.models.ledger.PeriodBalance.add_old_annotations(
+            kw, outer_link, flt, sp)
         addann(kw, 'during_d', DEBIT, duringflt)
         addann(kw, 'during_c', CREDIT, duringflt)
 
@@ -717,24 +712,39 @@ class DebtorsCreditors(dd.VirtualTable):
             end_date = ar.param_values.today
         else:   # called from Situation report
             end_date = mi.today
-        get_due_movements = rt.models.ledger.get_due_movements
-        qs = rt.models.contacts.Partner.objects.order_by('name')
+        Movement = rt.models.ledger.Movement
+        # A single pass over the movements of all partners instead of
+        # one get_due_movements() call per partner.  Cleared movements
+        # can be ignored unless their match group continues after
+        # end_date, in which case they were not yet cleared at that
+        # date.
+        later = Movement.objects.filter(
+            value_date__gt=end_date).values('match')
+        flt = models.Q(partner__isnull=False, value_date__lte=end_date)
+        flt &= models.Q(cleared=False) | models.Q(match__in=later)
+        expected = dict()
+        for dm in rt.models.ledger.get_due_movements(self.d_or_c, flt):
+            expected.setdefault(dm.partner.pk, []).append(dm)
+
+        balances = dict()
+        for pk, dms in expected.items():
+            balance = sum([dm.balance for dm in dms], ZERO)
+            if balance > ZERO:
+                balances[pk] = balance
+        if len(balances) == 0:
+            return rows
+
+        qs = rt.models.contacts.Partner.objects.filter(
+            pk__in=list(balances.keys())).order_by('name')
         for row in qs:
-            row._balance = ZERO
+            row._balance = balances[row.pk]
             row._due_date = None
-            row._expected = tuple(
-                get_due_movements(
-                    self.d_or_c,
-                    models.Q(partner=row, value_date__lte=end_date)))
+            row._expected = tuple(expected[row.pk])
             for dm in row._expected:
-                row._balance += dm.balance
                 if dm.due_date is not None:
                     if row._due_date is None or row._due_date > dm.due_date:
                         row._due_date = dm.due_date
-                # logger.info("20140105 %s %s", row, dm)
-
-            if row._balance > ZERO:
-                rows.append(row)
+            rows.append(row)
 
         def k(a):
             return a._due_date
@@ -3,6 +3,7 @@
 # License: BSD (see file COPYING for details)
 
 from django.db import models
+from django.db.models import Count
 from django.utils.translation import ugettext_lazy as _
 from django.utils.translation import pgettext_lazy as pgettext
 
@@ -503,29 +504,66 @@ class AnswerRemarkField(dd.VirtualField):
 
 
 
+class AnswerGrid(object):
+    """The remarks and chosen answers of a set of responses to a set of
+    questions, loaded with one query for the remarks and one for the
+    choices.
+
+    """
+    def __init__(self, responses, questions):
+        self.remarks = dict()
+        self.choices = dict()
+        self.choicesets = dict()
+        qs = AnswerRemark.objects.filter(
+            response__in=responses, question__in=questions).order_by()
+        for obj in qs:
+            self.remarks[(obj.response_id, obj.question_id)] = obj
+        qs = AnswerChoice.objects.filter(
+            response__in=responses, question__in=questions)
+        for obj in qs.select_related('choice').order_by('id'):
+            self.choices.setdefault(
+                (obj.response_id, obj.question_id), []).append(obj)
+
+    def get_remark(self, response, question):
+        return self.remarks.get((response.pk, question.pk))
+
+    def get_choices(self, response, question):
+        return self.choices.get((response.pk, question.pk), [])
+
+    def get_choiceset_choices(self, cs):
+        lst = self.choicesets.get(cs.pk)
+        if lst is None:
+            lst = self.choicesets[cs.pk] = list(cs.choices.all())
+        return lst
+
+
+def get_poll_questions(poll):
+    return list(rt.models.polls.Question.objects.filter(
+        poll=poll).select_related('poll__default_choiceset', 'choiceset'))
+
+
 class AnswersByResponseRow(TableRow):
     FORWARD_TO_QUESTION = tuple(
         "full_clean after_ui_save disable_delete save_new_instance save_watched_instance delete_instance".split())
 
-    def __init__(self, response, question):
+    def __init__(self, response, question, grid=None):
         self.response = response
         self.question = question
+        self.grid = grid
         # Needed by AnswersByResponse.get_row_by_pk
         self.pk = self.id = question.pk
-        try:
-            self.remark = AnswerRemark.objects.get(
-                question=question, response=response)
-        except AnswerRemark.DoesNotExist:
+        if grid is None:
+            grid = AnswerGrid([response], [question])
+        self.remark = grid.get_remark(response, question)
+        if self.remark is None:
             self.remark = AnswerRemark(
                 question=question, response=response)
-
-        self.choices = AnswerChoice.objects.filter(
-            question=question, response=response)
+        self.choices = grid.get_choices(response, question)
         for k in self.FORWARD_TO_QUESTION:
             setattr(self, k, getattr(question, k))
 
     def __str__(self):
-        if self.choices.count() == 0:
+        if len(self.choices) == 0:
             return str(_("N/A"))
         return ', '.join([str(ac.choice) for ac in self.choices])
 
@@ -555,8 +593,10 @@ class AnswersByResponseBase(dd.VirtualTable):
         response = ar.master_instance
         if response is None:
             return
-        for q in rt.models.polls.Question.objects.filter(poll=response.poll):
-            yield AnswersByResponseRow(response, q)
+        questions = get_poll_questions(response.poll)
+        grid = AnswerGrid([response], questions)
+        for q in questions:
+            yield AnswersByResponseRow(response, q, grid)
 
     @classmethod
     def get_pk_field(self):
@@ -599,6 +639,10 @@ class AnswersByResponseEditor(AnswersByResponseBase):
             poll=response.poll).order_by('date')
         if response.partner:
             all_responses = all_responses.filter(partner=response.partner)
+        all_responses = list(all_responses)
+        questions = get_poll_questions(response.poll)
+        grid = AnswerGrid(
+            set([r.pk for r in all_responses] + [response.pk]), questions)
         ht = xghtml.Table()
         ht.attrib.update(cellspacing="5px", bgcolor="#ffffff", width="100%")
         cellattrs = dict(align="left", valign="top", bgcolor="#eeeeee")
@@ -622,7 +666,8 @@ class AnswersByResponseEditor(AnswersByResponseBase):
         insert = AnswerRemarks.insert_action.request_from(
             ar, known_values=kv)
         detail = AnswerRemarks.detail_action.request_from(ar)
-        for answer in self.get_data_rows(ar):
+        for q in questions:
+            answer = AnswersByResponseRow(response, q, grid)
             cells = [self.question.value_from_object(answer, ar)]
             for r in all_responses:
                 if editable and r == response:
@@ -647,10 +692,11 @@ class AnswersByResponseEditor(AnswersByResponseBase):
                         items += [" (", btn, ")"]
 
                 else:
-                    other_answer = AnswersByResponseRow(r, answer.question)
+                    other_answer = AnswersByResponseRow(
+                        r, answer.question, grid)
                     items = [str(other_answer)]
                     if other_answer.remark.remark:
-                        items += [E.br(), answer.remark.remark]
+                        items += [E.br(), other_answer.remark.remark]
                 cells.append(E.p(*items))
             ht.add_body_row(*cells, **cellattrs)
 
@@ -686,19 +732,16 @@ class AnswersByResponseEditor(AnswersByResponseBase):
         if not sar.get_permission():
             return str(obj)
 
-        AnswerChoice = rt.models.polls.AnswerChoice
-        for c in cs.choices.all():
+        if obj.grid is None:
+            choices = cs.choices.all()
+        else:
+            choices = obj.grid.get_choiceset_choices(cs)
+        selected = set([ac.choice_id for ac in obj.choices])
+        for c in choices:
             pv.update(choice=c)
             text = str(c)
-            qs = AnswerChoice.objects.filter(
-                response=obj.response, **pv)
-            if qs.count() == 1:
+            if c.pk in selected:
                 text = [E.b('[', text, ']')]
-            elif qs.count() == 0:
-                pass
-            else:
-                raise Exception(
-                    "Oops: %s returned %d rows." % (qs.query, qs.count()))
             sar.set_action_param_values(**pv)
             e = sar.ar2button(obj.response, text, style="text-decoration:none")
             elems.append(e)
@@ -720,7 +763,7 @@ class AnswersByResponsePrint(AnswersByResponseBase):
                                        # get_data_rows() needs it.
         items = []
         for obj in self.get_data_rows(ar):
-            if len(obj.remark.remark) == 0 and obj.choices.count() == 0:
+            if len(obj.remark.remark) == 0 and len(obj.choices) == 0:
                 continue
             chunks = [obj.get_question_html(ar), " — "]  # unicode em dash
             chunks += [str(ac.choice) for ac in obj.choices]
@@ -735,24 +778,21 @@ class AnswersByQuestionRow(TableRow):
     FORWARD_TO_RESPONSE = tuple(
         "full_clean after_ui_save disable_delete obj2href".split())
 
-    def __init__(self, response, question):
+    def __init__(self, response, question, grid=None):
         self.response = response
         self.question = question
         # Needed by AnswersByQuestion.get_row_by_pk
         self.pk = self.id = response.pk
-        try:
-            self.remark = AnswerRemark.objects.get(
-                question=question, response=response).remark
-        except AnswerRemark.DoesNotExist:
-            self.remark = ''
-
-        self.choices = AnswerChoice.objects.filter(
-            question=question, response=response)
+        if grid is None:
+            grid = AnswerGrid([response], [question])
+        remark = grid.get_remark(response, question)
+        self.remark = '' if remark is None else remark.remark
+        self.choices = grid.get_choices(response, question)
         for k in self.FORWARD_TO_RESPONSE:
             setattr(self, k, getattr(question, k))
 
     def __str__(self):
-        if self.choices.count() == 0:
+        if len(self.choices) == 0:
             return str(_("N/A"))
         return ', '.join([str(ac.choice) for ac in self.choices])
 
@@ -769,8 +809,11 @@ class AnswersByQuestion(dd.VirtualTable):
         question = ar.master_instance
         if question is None:
             return
-        for r in rt.models.polls.Response.objects.filter(poll=question.poll):
-            yield AnswersByQuestionRow(r, question)
+        responses = list(rt.models.polls.Response.objects.filter(
+            poll=question.poll))
+        grid = AnswerGrid(responses, [question])
+        for r in responses:
+            yield AnswersByQuestionRow(r, question, grid)
 
     @dd.displayfield(_("Response"))
     def response(self, obj, ar):
@@ -785,9 +828,63 @@ class AnswersByQuestion(dd.VirtualTable):
         return str(obj)
 
 
+class PollCrossTab(object):
+    """The number of answers per question and choice of a poll, computed
+    with one grouped query."""
+
+    def __init__(self, poll):
+        self.counts = dict()
+        self.totals = dict()
+        self.choicesets = dict()
+        qs = AnswerChoice.objects.filter(question__poll=poll).order_by()
+        qs = qs.values('question', 'choice').annotate(n=Count('id'))
+        for row in qs:
+            q = row['question']
+            self.counts[(q, row['choice'])] = row['n']
+            self.totals[q] = self.totals.get(q, 0) + row['n']
+
+    def get_count(self, question, choice):
+        return self.counts.get((question.pk, choice.pk), 0)
+
+    def get_total(self, question):
+        return self.totals.get(question.pk, 0)
+
+    def get_choiceset_choices(self, cs):
+        lst = self.choicesets.get(cs.pk)
+        if lst is None:
+            lst = self.choicesets[cs.pk] = list(cs.choices.all())
+        return lst
+
+
 class PollResult(Questions):
     master_key = 'poll'
-    column_names = "question choiceset answers a1"
+    column_names = "question choiceset total_answers choice_counts"
+
+    @classmethod
+    def get_crosstab(cls, obj, ar):
+        # computed once per request and poll
+        if ar is None:
+            return PollCrossTab(obj.poll)
+        ct = getattr(ar, '_poll_crosstab', None)
+        if ct is None or ct.poll_id != obj.poll_id:
+            ct = PollCrossTab(obj.poll)
+            ct.poll_id = obj.poll_id
+            ar._poll_crosstab = ct
+        return ct
+
+    @dd.virtualfield(models.IntegerField(_("#Answers")))
+    def total_answers(self, obj, ar):
+        return self.get_crosstab(obj, ar).get_total(obj)
+
+    @dd.displayfield(_("Answers per choice"))
+    def choice_counts(self, obj, ar):
+        cs = obj.get_choiceset()
+        if cs is None:
+            return ''
+        ct = self.get_crosstab(obj, ar)
+        return ', '.join([
+            "{}: {}".format(c, ct.get_count(obj, c))
+            for c in ct.get_choiceset_choices(cs)])
 
     # @classmethod
     # def get_data_rows(self, ar):
@@ -4,6 +4,7 @@
 
 
 from django.db import models
+from django.db.models.signals import post_delete
 from django.utils.translation import ugettext_lazy as _
 
 from lino.api import dd, rt
@@ -72,40 +73,13 @@ class Product(mixins.BabelNamed, Duplicable):
     def get_product_choices(cls, partner):
         """Return a list of products (fees) that are allowed for the specified partner.
         """
-        Product = cls
-        qs = Product.objects.filter(product_type=ProductTypes.default)
-        qs = qs.order_by('name')
-        rules = PriceRule.objects.all()
-        for pf in PriceFactors.get_list_items():
-            rules = rules.filter(
-                Q(**{pf.field_name: getattr(partner, pf.field_name)}) |
-                Q(**{pf.field_name + '__isnull': True}))
-        return [p for p in qs if rules.filter(product=p).count() > 0]
-        # TODO: add rules condition as subquery to qs and return the query, not
-        # the list
+        return get_price_rules().get_allowed_fees(partner)
 
     @classmethod
     def get_rule_fee(cls, partner, event_type):
         if partner is None:
             return
-        for rule in rt.models.products.PriceRule.objects.order_by('seqno'):
-            ok = True
-            for pf in PriceFactors.get_list_items():
-                rv = getattr(rule, pf.field_name)
-                if rv:
-                    pv = getattr(partner, pf.field_name)
-                    if pv != rv:
-                        # print("20181128a {} != {}".format(rv, pv))
-                        ok = False
-            # if rule.tariff and rule.tariff != tariff:
-            #     # print("20181128b {} != {}".format(rule.tariff, tariff))
-            #     ok = False
-            if rule.event_type and rule.event_type != event_type:
-                # print("20181128c {} != {}".format(rule.event_type, event_type))
-                ok = False
-
-            if ok and rule.fee is not None:
-                return rule.fee
+        return get_price_rules().get_fee(partner, event_type)
 
     def full_clean(self):
         # print("20191210", self.name, self.vat_class)
@@ -171,6 +145,108 @@ class PriceRule(Sequenced):
     fee = dd.ForeignKey('products.Product', blank=True, null=True)
 
 
+class CompiledPriceRules(object):
+    """A decision table compiled from all price rules.
+
+    Each rule is indexed by its *mask*, i.e. the tuple of price factors
+    (and whether the event type) for which it specifies a value.  Within
+    a mask, rules are looked up by the values of the factors they
+    specify, so that answering a question needs one dict lookup per
+    mask and no database access.
+
+    Use :func:`get_price_rules` to get the current instance.  It is
+    discarded whenever a price rule or a product gets saved or deleted
+    in this process, and at the beginning of every invoicing run
+    (:meth:`Plan.fill_plan <lino_xl.lib.invoicing.Plan.fill_plan>`) so
+    that changes made by other processes are seen there.
+
+    """
+
+    def __init__(self):
+        self.factors = [pf.field_name for pf in PriceFactors.get_list_items()]
+        # mask -> key -> (seqno, fee_id) of the first matching rule
+        self.fees = dict()
+        # mask -> key -> set of fee ids
+        self.allowed = dict()
+        fee_ids = set()
+        qs = rt.models.products.PriceRule.objects.filter(
+            fee__isnull=False).order_by('seqno')
+        for rule in qs:
+            values = [choice2key(getattr(rule, k)) for k in self.factors]
+            mask = tuple(v is not None for v in values)
+            key = tuple(v for v in values if v is not None)
+            fee_ids.add(rule.fee_id)
+            self.allowed.setdefault(mask, dict()).setdefault(
+                key, set()).add(rule.fee_id)
+            et = rule.event_type_id
+            mask += (et is not None,)
+            if et is not None:
+                key += (et,)
+            self.fees.setdefault(mask, dict()).setdefault(
+                key, (rule.seqno, rule.fee_id))
+        # the fees in the order of get_product_choices()
+        qs = rt.models.products.Product.objects.filter(
+            pk__in=fee_ids).order_by('name')
+        self.products = list(qs)
+        self.product_by_id = {p.pk: p for p in self.products}
+
+    def get_partner_values(self, partner):
+        return [choice2key(getattr(partner, k)) for k in self.factors]
+
+    def get_fee(self, partner, event_type):
+        """Return the fee of the first rule (in order of `seqno`) that
+        applies to the given partner and event type."""
+        values = self.get_partner_values(partner)
+        values.append(None if event_type is None else event_type.pk)
+        found = None
+        for mask, rules in self.fees.items():
+            key = tuple(v for v, m in zip(values, mask) if m)
+            if None in key:
+                continue
+            rv = rules.get(key)
+            if rv is not None and (found is None or rv < found):
+                found = rv
+        if found is not None:
+            return self.product_by_id.get(found[1])
+
+    def get_allowed_fees(self, partner):
+        """Return the list of fees allowed by any rule that applies to the
+        given partner, ordered by name."""
+        values = self.get_partner_values(partner)
+        fee_ids = set()
+        for mask, rules in self.allowed.items():
+            key = tuple(v for v, m in zip(values, mask) if m)
+            fee_ids |= rules.get(key, set())
+        return [p for p in self.products
+                if p.pk in fee_ids and p.product_type == ProductTypes.default]
+
+
+def choice2key(choice):
+    # An empty factor of a rule matches any value.
+    if not choice:
+        return None
+    return choice.value
+
+
+_price_rules = None
+
+
+def get_price_rules():
+    """Return the :class:`CompiledPriceRules` of this process, compiling
+    them if needed."""
+    global _price_rules
+    if _price_rules is None:
+        _price_rules = CompiledPriceRules()
+    return _price_rules
+
+
+def clear_price_rules(**kwargs):
+    """Discard the compiled price rules so that they get compiled again
+    on next use."""
+    global _price_rules
+    _price_rules = None
+
+
 class PriceRules(dd.Table):
     model = "products.PriceRule"
     column_names_tpl = "seqno {factors} #tariff event_type fee *"
@@ -182,6 +258,14 @@ class PriceRules(dd.Table):
         return cls.column_names_tpl.format(factors=factors)
 
 
+@dd.receiver(dd.post_analyze)
+def connect_price_rules_signals(sender, **kw):
+    # the models may be overridden by another plugin
+    for m in (rt.models.products.PriceRule, rt.models.products.Product):
+        dd.post_save.connect(clear_price_rules, sender=m)
+        post_delete.connect(clear_price_rules, sender=m)
+
+
 @dd.receiver(dd.pre_analyze)
 def inject_pricefactor_fields(sender, **kw):
     for pf in PriceFactors.get_list_items():
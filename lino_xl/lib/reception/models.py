@@ -34,7 +34,9 @@ import datetime
 
 
 from django.db import models
-from django.db.models import Q
+from django.db import connection
+from django.db.models import Q, F, Window
+from django.db.models.functions import Rank
 from django.conf import settings
 from django.utils.translation import ugettext_lazy as _
 from django.utils import timezone
@@ -453,6 +455,13 @@ class Visitors(cal.Guests):
         kw.update(guest_state=self.visitor_state)
         return kw
 
+    @classmethod
+    def get_request_queryset(self, ar, **kwargs):
+        qs = super(Visitors, self).get_request_queryset(ar, **kwargs)
+        if isinstance(qs, list):
+            return qs
+        return qs.select_related('event', 'event__user', 'partner')
+
     #~ doesn't work because cls is always Visitors
     #~ @dd.displayfield(_('Since'))
     #~ def since(cls,obj,ar):
@@ -475,6 +484,42 @@ class BusyVisitors(Visitors):
         return naturaltime(obj.busy_since)
 
 
+def get_queue_positions():
+    """Return a dict mapping the id of every waiting guest to its
+    position in the waiting queue of the agent (the user of the
+    calendar entry).
+
+    Computed with a single query using a window function, or, on
+    database backends that don't support them, with a single query
+    ordered by agent and arrival.  Guests who checked in at the same
+    moment share their position.  Guests without `waiting_since` are
+    not ranked.
+
+    """
+    qs = rt.models.cal.Guest.objects.filter(
+        state=GuestStates.waiting, waiting_since__isnull=False)
+    if connection.features.supports_over_clause:
+        qs = qs.order_by().annotate(position=Window(
+            expression=Rank(), partition_by=[F('event__user')],
+            order_by=F('waiting_since').asc()))
+        return dict(qs.values_list('id', 'position'))
+    positions = dict()
+    user = since = position = None
+    n = 0  # number of guests ranked so far for this user
+    qs = qs.order_by('event__user', 'waiting_since')
+    for pk, u, ws in qs.values_list('id', 'event__user', 'waiting_since'):
+        if n == 0 or u != user:
+            user = u
+            n = 0
+            since = None
+        n += 1
+        if ws != since:
+            since = ws
+            position = n
+        positions[pk] = position
+    return positions
+
+
 class WaitingVisitors(Visitors):
     """Show waiting visitors (for any user)."""
     label = _("Waiting visitors")
@@ -492,12 +537,27 @@ class WaitingVisitors(Visitors):
     @dd.displayfield(
         _('Position'), help_text=_("Position in waiting queue (per agent)"))
     def position(self, obj, ar):
-        n = 1 + rt.models.cal.Guest.objects.filter(
-            #~ waiting_since__isnull=False,
-            #~ busy_since__isnull=True,
-            state=GuestStates.waiting,
-            event__user=obj.event.user,
-            waiting_since__lt=obj.waiting_since).count()
+        # n = 1 + rt.models.cal.Guest.objects.filter(
+        #     #~ waiting_since__isnull=False,
+        #     #~ busy_since__isnull=True,
+        #     state=GuestStates.waiting,
+        #     event__user=obj.event.user,
+        #     waiting_since__lt=obj.waiting_since).count()
+        if ar is None:
+            positions = get_queue_positions()
+        else:
+            positions = getattr(ar, '_queue_positions', None)
+            if positions is None:
+                positions = ar._queue_positions = get_queue_positions()
+        n = positions.get(obj.pk)
+        if n is None:
+            # not (or no longer) waiting
+            if obj.waiting_since is None:
+                return ''
+            n = 1 + rt.models.cal.Guest.objects.filter(
+                state=GuestStates.waiting,
+                event__user_id=obj.event.user_id,
+                waiting_since__lt=obj.waiting_since).count()
         return str(n)
 
 
@@ -3,6 +3,7 @@
 # License: BSD (see file COPYING for details)
 
 from django.db import models
+from django.db.models import Q, Sum
 
 from lino.api import dd, rt, _
 from lino.core import actions
@@ -17,6 +18,7 @@ from lino_xl.lib.ledger.choicelists import TradeTypes
 from lino_xl.lib.ledger.choicelists import VoucherTypes
 from lino_xl.lib.ledger.ui import PartnerVouchers, ByJournal, PrintableByJournal
 from lino_xl.lib.ledger.roles import LedgerStaff, LedgerUser
+from lino_xl.lib.ledger.utils import ZERO
 from .mixins import SalesDocument, ProductDocItem
 
 TradeTypes.sales.update(
@@ -166,24 +168,126 @@ class VatProductInvoice(SalesDocument, Matching):
     def get_print_items(self, ar):
         return self.print_items_table.request(self)
 
+    def get_balances(self, ar):
+        """Return a tuple `(balance_before, balance_to_pay)` for this
+        invoice.
+
+        When this invoice is a row of the current page of `ar`, the
+        balances of all invoices on that page are computed together
+        (see :func:`load_balances`) and cached on the request for as
+        long as it shows that page.
+
+        """
+        # Don't execute the request just for this. When it has been
+        # executed, its rows are the page being rendered.
+        rows = getattr(ar, '_sliced_data_iterator', None)
+        if rows is None or self not in rows:
+            return load_balances([self])[self.pk]
+        cached = getattr(ar, '_invoice_balances', None)
+        if cached is None or cached[0] is not rows:
+            invoices = [obj for obj in rows
+                        if isinstance(obj, rt.models.sales.VatProductInvoice)]
+            cached = ar._invoice_balances = (rows, load_balances(invoices))
+        return cached[1][self.pk]
+
     @dd.virtualfield(dd.PriceField(_("Balance to pay")))
     def balance_to_pay(self, ar):
-        Movement = rt.models.ledger.Movement
-        qs = Movement.objects.filter(
-            partner=self.get_partner(),
-            cleared=False,
-            match=self.get_match())
-        return Movement.get_balance(not self.journal.dc, qs)
+        return self.get_balances(ar)[1]
 
     @dd.virtualfield(dd.PriceField(_("Balance before")))
     def balance_before(self, ar):
-        Movement = rt.models.ledger.Movement
-        qs = Movement.objects.filter(
-            partner=self.get_partner(),
-            cleared=False,
-            value_date__lte=self.entry_date)
-        qs = qs.exclude(voucher=self)
-        return Movement.get_balance(not self.journal.dc, qs)
+        return self.get_balances(ar)[0]
+
+
+def load_balances(invoices):
+    """Return a dict mapping the id of each of the given `invoices` to a
+    tuple `(balance_before, balance_to_pay)`.
+
+    The *balance to pay* of an invoice is the balance of the uncleared
+    movements of its partner and match.  The *balance before* is the
+    balance of the uncleared movements of its partner with a value
+    date until the entry date of the invoice, excluding those of the
+    invoice itself.  Both are seen from the partner's side, i.e. in
+    the opposite direction of the journal.
+
+    Uses three grouped queries (and one for the journals) for any
+    number of invoices.
+
+    """
+    Movement = rt.models.ledger.Movement
+
+    def collect(qs, *fields):
+        # sum the amounts per key and dc
+        sums = dict()
+        qs = qs.order_by().values(*(fields + ('dc',))).annotate(
+            total=Sum('amount'))
+        for row in qs:
+            key = tuple(row[k] for k in fields)
+            d = sums.setdefault(key, dict())
+            d[row['dc']] = d.get(row['dc'], ZERO) + (row['total'] or ZERO)
+        return sums
+
+    def balance(dc, d):
+        if d is None:
+            return ZERO
+        bal = ZERO
+        for k, v in d.items():
+            if k == dc:
+                bal += v
+            else:
+                bal -= v
+        return bal
+
+    invoices = list(invoices)
+    result = dict()
+    if len(invoices) == 0:
+        return result
+    # the journals are needed for the direction and for the default
+    # match of every invoice
+    journals = rt.models.ledger.Journal.objects.in_bulk(
+        set([inv.journal_id for inv in invoices]))
+    partners = set()
+    matches = set()
+    ids = set()
+    for inv in invoices:
+        inv.journal = journals[inv.journal_id]
+        partners.add(inv.partner_id)
+        matches.add(str(inv.get_match()))
+        ids.add(inv.pk)
+    flt = Q(partner_id__in=[pk for pk in partners if pk is not None])
+    if None in partners:
+        flt |= Q(partner__isnull=True)
+    qs = Movement.objects.filter(flt, cleared=False)
+
+    to_pay = collect(qs.filter(match__in=matches), 'partner', 'match')
+    max_date = max([inv.entry_date for inv in invoices])
+    by_date = collect(
+        qs.filter(value_date__lte=max_date), 'partner', 'value_date')
+    own = dict()  # voucher -> [(partner, value_date, sums), ...]
+    for (voucher, partner, value_date), d in collect(
+            qs.filter(voucher_id__in=ids),
+            'voucher', 'partner', 'value_date').items():
+        own.setdefault(voucher, []).append((partner, value_date, d))
+
+    dates = dict()  # partner -> [(value_date, sums), ...]
+    for (partner, value_date), d in by_date.items():
+        dates.setdefault(partner, []).append((value_date, d))
+
+    for inv in invoices:
+        dc = not inv.journal.dc
+        partner = inv.partner_id
+        bal_to_pay = balance(
+            dc, to_pay.get((partner, str(inv.get_match()))))
+        bal_before = ZERO
+        for value_date, d in dates.get(partner, []):
+            if value_date <= inv.entry_date:
+                bal_before += balance(dc, d)
+        for p, value_date, d in own.get(inv.pk, []):
+            if p == partner and value_date is not None \
+               and value_date <= inv.entry_date:
+                bal_before -= balance(dc, d)
+        result[inv.pk] = (bal_before, bal_to_pay)
+    return result
 
 
 class InvoiceDetail(dd.DetailLayout):
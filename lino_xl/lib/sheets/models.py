@@ -353,21 +353,19 @@ class Report(UserPlan, PeriodRange, Certifiable, Story):
 
         during_periods = AccountingPeriod.objects.filter(
             ref__gte=sp.ref, ref__lte=ep.ref)
-        before_periods = AccountingPeriod.objects.filter(
-            ref__lt=sp.ref)
 
-        oldflt = coll.get_mvt_filter()
         duringflt = coll.get_mvt_filter()
         # oldflt = dict()
         # oldflt.update(coll.rowmvtflt)
         # duringflt = dict()
         # duringflt.update(coll.rowmvtflt)
-        oldflt.update(voucher__accounting_period__in=before_periods)
         duringflt.update(voucher__accounting_period__in=during_periods)
 
         kw = dict()
-        coll.addann(kw, 'old_d', DEBIT, oldflt)
-        coll.addann(kw, 'old_c', CREDIT, oldflt)
+        # old balances come from the latest period balance snapshot
+        rt.models.ledger.PeriodBalance.add_old_annotations(
+            kw, coll.outer_link, coll.get_mvt_filter(), sp,
+            dd.PriceField(decimal_places=14))
         coll.addann(kw, 'during_d', DEBIT, duringflt)
         coll.addann(kw, 'during_c', CREDIT, duringflt)
 
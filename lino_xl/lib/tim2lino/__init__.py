@@ -58,6 +58,17 @@ class Plugin(ad.Plugin):
 
     """
 
+    dbf_workers = 0
+    """
+    The number of worker processes to use for decoding DBF files in
+    parallel.  Zero means that every file is decoded when it is being
+    loaded.  Works only when :attr:`use_dbfread` is True.
+
+    At most this number of tables is being decoded or waiting to be
+    loaded at any moment, so that prefetching doesn't keep all the
+    tables in memory.
+    """
+
     dbf_table_ext = '.DBF'
     # dbf_table_ext = '.FOX'
     """The file extension of TIM tables. Meaningful values are `'.DBF'` or
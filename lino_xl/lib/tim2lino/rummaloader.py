@@ -185,9 +185,8 @@ class TimLoader(TimLoader):
                 "Failed to load MBR %s : idpar2 is not empty", row)
             return
 
-        try:
-            lst = List.objects.get(ref=row.idpls.strip())
-        except List.DoesNotExist:
+        lst = self.get_cached(List, row.idpls.strip(), 'ref')
+        if lst is None:
             dd.logger.debug(
                 "Failed to load MBR %s : unknown idpls", row)
             return
@@ -201,9 +200,8 @@ class TimLoader(TimLoader):
             return
         if not row.idpin.strip():
             return
-        try:
-            ticket = tickets.Ticket.objects.get(pk=int(row.idpin))
-        except tickets.Ticket.DoesNotExist:
+        ticket = self.get_cached(tickets.Ticket, int(row.idpin))
+        if ticket is None:
             return
         pk = int(row.iddls)
         kw.update(id=pk)
@@ -128,16 +128,6 @@ def par2dates(row):
             kw.update(end_date=row.date2)
     return kw
 
-def fld2fk(v, model):
-    if v:
-        try:
-            p = model.objects.get(id=int(v))
-        except model.DoesNotExist:
-            p = model(designation=v, pk=int(v))
-            p.full_clean()
-            p.save()
-        return p
-    
 class TimLoader(TimLoader):
 
     # archived_tables = set('GEN ART VEN VNL JNL FIN FNL'.split())
@@ -216,6 +206,15 @@ class TimLoader(TimLoader):
         return (self.get_user(idusr)
                 for idusr in (row.idusr1, row.idusr2, row.idusr3))
 
+    def fld2fk(self, v, model):
+        if v:
+            p = self.get_cached(model, int(v))
+            if p is None:
+                p = model(designation=v, pk=int(v))
+                p.full_clean()
+                p.save()
+            return p
+
     def load_par(self, row):
         # Every PAR potentially yields a partner, a course and an
         # enrolment.  we re-create all courses and enrolments from
@@ -239,14 +238,13 @@ class TimLoader(TimLoader):
         if cl is None:
             partner = None
         else:
-            try:
-                partner = cl.objects.get(pk=pk)
+            partner = self.get_cached(cl, pk)
+            if partner is not None:
                 dd.logger.debug(
                     "Update existing %s %s from %s", cl.__name__, pk, row)
-            except cl.DoesNotExist:
-                try:
-                    partner = Partner.objects.get(pk=pk)
-                except Partner.DoesNotExist:
+            else:
+                partner = self.get_cached(Partner, pk)
+                if partner is None:
                     dd.logger.debug("Create new %s %s from %s",
                                     cl.__name__, pk, row)
                     partner = timloader1.TimLoader.load_par(self, row).next()
@@ -373,7 +371,7 @@ class TimLoader(TimLoader):
                 else:
                     course.therapy_domain = t
                     
-            course.procurer = fld2fk(row.vermitt, Procurer)
+            course.procurer = self.fld2fk(row.vermitt, Procurer)
             if row.vpfl == "X":
                 course.mandatory = True
 
@@ -429,7 +427,7 @@ class TimLoader(TimLoader):
             elif v == '40': v = '31'
             partner.professional_state = ProfessionalStates.get_by_value(v)
 
-            partner.life_mode = fld2fk(row.lebensw, LifeMode)
+            partner.life_mode = self.fld2fk(row.lebensw, LifeMode)
 
         # partner.propagate_contact_details()
 
@@ -470,20 +468,17 @@ class TimLoader(TimLoader):
         if not plptype:
             return
 
-        try:
-            role = GuestRole.objects.get(ref=plptype)
-        except GuestRole.DoesNotExist:
+        role = self.get_cached(GuestRole, plptype, 'ref')
+        if role is None:
             role = GuestRole(ref=plptype, name=plptype)
             yield role
-        try:
-            course = Course.objects.get(ref=row.idpar1)
-        except Course.DoesNotExist:
+        course = self.get_cached(Course, row.idpar1, 'ref')
+        if course is None:
             dd.logger.warning(
                 "Ignored PLP %s : Invalid idpar1", row)
             return
-        try:
-            person = Person.objects.get(pk=self.par_pk(row.idpar2))
-        except Person.DoesNotExist:
+        person = self.get_cached(Person, self.par_pk(row.idpar2))
+        if person is None:
             dd.logger.warning(
                 "Ignored PLP %s : Invalid idpar2", row)
             return
@@ -495,10 +490,7 @@ class TimLoader(TimLoader):
         pk = self.par_pk(idpar.strip())
         if pk is None:
             return None
-        try:
-            return model.objects.get(pk=pk)
-        except model.DoesNotExist:
-            return None
+        return self.get_cached(model, pk)
     
     def load_dlp(self, row, **kw):
         pk = row.iddls.strip()
@@ -563,10 +555,10 @@ class TimLoader(TimLoader):
         
     def get_event_type(self, pk):
         pk = int(pk)
-        try:
-            return EventType.objects.get(pk=pk)
-        except EventType.DoesNotExist:
-            return create_row(EventType, name=str(pk), pk=pk)
+        obj = self.get_cached(EventType, pk)
+        if obj is None:
+            obj = create_row(EventType, name=str(pk), pk=pk)
+        return obj
 
     def load_dls(self, row, **kw):
         pk = row.iddls.strip()
@@ -598,9 +590,8 @@ class TimLoader(TimLoader):
             u1 = u
             # idusr += '@' + str(team.pk)
             idusr += '@' + str(team)
-            try:
-                u = User.objects.get(username=idusr)
-            except User.DoesNotExist:
+            u = self.get_cached(User, idusr, 'username')
+            if u is None:
                 u = create(
                     User, username=idusr, first_name=u1.first_name, team=team,
                     user_type=u1.user_type)
@@ -672,9 +663,8 @@ class TimLoader(TimLoader):
         if not Topic.objects.filter(id=idprb).exists():
             return
         idpar = row.idpar.strip()
-        try:
-            prj = Course.objects.get(ref=idpar)
-        except Course.DoesNotExist:
+        prj = self.get_cached(Course, idpar, 'ref')
+        if prj is None:
             dd.logger.warning(
                 "Cannot import PPR %s : no course ref %s", row, idpar)
             return
@@ -689,9 +679,8 @@ class TimLoader(TimLoader):
         
     def load_msg(self, row, **kw):
         idpar = row.idpar.strip()
-        try:
-            prj = Course.objects.get(ref=idpar)
-        except Course.DoesNotExist:
+        prj = self.get_cached(Course, idpar, 'ref')
+        if prj is None:
             dd.logger.warning(
                 "Cannot import MSG %s : no course ref %s", row, idpar)
             return
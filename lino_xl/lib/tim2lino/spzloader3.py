@@ -50,7 +50,7 @@ from lino.api import dd, rt, _
 
 
 from .spzloader import TimLoader
-from .timloader1 import row2jnl, mton, qton
+from .timloader1 import mton, qton
 
 Person = dd.resolve_model("contacts.Person")
 # Company = dd.resolve_model("contacts.Company")
@@ -171,7 +171,7 @@ class TimLoader(TimLoader):
             return None
 
     def load_ven(self, row, **kw):
-        jnl, year, number = row2jnl(row)
+        jnl, year, number = self.row2jnl(row)
         if jnl is None:
             dd.logger.info("No journal %s (%s)", row.idjnl, row)
             return
@@ -219,7 +219,7 @@ class TimLoader(TimLoader):
         return doc
 
     def load_vnl(self, row, **kw):
-        jnl, year, number = row2jnl(row)
+        jnl, year, number = self.row2jnl(row)
         if year is None or year.ref != '2018':
             return
         if jnl is None:
@@ -253,10 +253,29 @@ class TimLoader(TimLoader):
         if not pk:
             return None
         pk = self.par_pk(pk)
-        try:
-            return contacts.Partner.objects.get(pk=pk)
-        except contacts.Partner.DoesNotExist:
-            return None
+        return self.get_cached(contacts.Partner, pk)
+
+    def year_num(self, iddoc):
+        """Same as :func:`year_num`, but uses a lookup map for the fiscal
+        years."""
+        iyear = 2000 + int(iddoc[:2])
+        if iyear < START_YEAR:
+            return (None, None)
+        ref = ledger.FiscalYear.year2ref(iyear)
+        year = self.get_cached(ledger.FiscalYear, ref, 'ref')
+        if year is None:
+            year = year_num(iddoc)[0]
+            self.lookup_maps[(ledger.FiscalYear, 'ref')][ref] = year
+        return (year, int(iddoc[2:]))
+
+    def row2jnl(self, row):
+        """Same as :func:`row2jnl`, but uses lookup maps for journals and
+        fiscal years."""
+        jnl = self.get_cached(Journal, row.idjnl.strip(), 'ref')
+        if jnl is None:
+            return None, None, None
+        year, num = self.year_num(row.iddoc)
+        return jnl, year, num
 
     def par_pk(self, pk):
         if pk.startswith('T'):
@@ -378,13 +397,10 @@ class TimLoader(TimLoader):
         idgen = idgen.strip()
         if not idgen:
             return None
-        try:
-            return ledger.Account.objects.get(ref=idgen)
-        except ledger.Account.DoesNotExist:
-            return None
+        return self.get_cached(ledger.Account, idgen, 'ref')
         
     def load_fin(self, row, **kw):
-        jnl, year, number = row2jnl(row)
+        jnl, year, number = self.row2jnl(row)
         if jnl is None:
             dblogger.info("No journal %s (%s)", row.idjnl, row)
             return
@@ -406,7 +422,7 @@ class TimLoader(TimLoader):
         return doc
 
     def load_fnl(self, row, **kw):
-        jnl, year, number = row2jnl(row)
+        jnl, year, number = self.row2jnl(row)
         if jnl is None:
             dblogger.info("No journal %s (%s)", row.idjnl, row)
             return
@@ -440,7 +456,10 @@ class TimLoader(TimLoader):
                 kw.update(
                     account=vat.TradeTypes.clearings.get_main_account())
             else:
-                a = Account.objects.get(ref=row.idcpt.strip())
+                a = self.get_account(row.idcpt)
+                if a is None:
+                    raise Account.DoesNotExist(
+                        "No account {}".format(row.idcpt.strip()))
                 kw.update(account=a)
             kw.update(amount=mton(row.mont, ZERO))
             kw.update(dc=self.dc2lino(row.dc))
@@ -462,7 +481,7 @@ class TimLoader(TimLoader):
                 "Failed to load FNL line %s from %s : %s", row, kw, e)
 
     def load_ven(self, row, **kw):
-        jnl, year, number = row2jnl(row)
+        jnl, year, number = self.row2jnl(row)
         if jnl is None:
             dblogger.info("No journal %s (%s)", row.idjnl, row)
             return
@@ -511,7 +530,7 @@ class TimLoader(TimLoader):
         return doc
 
     def load_vnl(self, row, **kw):
-        jnl, year, number = row2jnl(row)
+        jnl, year, number = self.row2jnl(row)
         if jnl is None:
             return
         if year < START_YEAR:
@@ -535,7 +554,11 @@ class TimLoader(TimLoader):
         idart = row.idart.strip()
         if isinstance(doc, sales.VatProductInvoice):
             if row.code in ('A', 'F'):
-                kw.update(product=products.Product.get_by_ref(idart))
+                p = self.get_cached(products.Product, idart, 'ref')
+                if p is None:
+                    raise products.Product.DoesNotExist(
+                        "No product {}".format(idart))
+                kw.update(product=p)
             elif row.code == 'G':
                 a = self.vnlg2product(row)
                 if a is not None:
@@ -893,6 +916,9 @@ class TimLoader(TimLoader):
         
         yield self.create_users()
 
+        tim.prefetch_dbf(
+            'GEN', 'ART', 'JNL', 'PLZ', 'PAR', 'VEN', 'VNL', 'FIN', 'FNL')
+
         # settings.SITE.loading_from_dump = True
 
         if False:
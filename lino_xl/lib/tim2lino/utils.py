@@ -8,15 +8,41 @@ Import legacy data from TIM (basic version).
 
 import traceback
 import os
+import time
 from clint.textui import puts, progress
 from django.conf import settings
 from django.db import models
+from django.db import transaction
 from atelier.utils import AttrDict
 from lino.api import dd, rt
 from lino.utils import dbfreader
+from lino.utils.dpy import FlushDeferredObjects
 from lino_xl.lib.ledger.utils import DEBIT, CREDIT
 
 
+def iter_dbf(fn):
+    """Yield the records of the given DBF file as dicts using
+    :mod:`dbfread`."""
+    from dbfread import DBF
+    dbf = DBF(fn)
+    names = [f.name for f in dbf.fields]
+    for record in dbf:
+        yield {n.lower(): record[n] for n in names}
+
+
+def read_dbf(fn):
+    """Return all records of the given DBF file as a list of dicts.
+    Called in a worker process by :meth:`TimLoader.prefetch_dbf`.
+
+    """
+    return list(iter_dbf(fn))
+
+
+def can_bulk_create(model):
+    # bulk_create() doesn't support multi-table inheritance
+    return len(model._meta.parents) == 0
+
+
 class TimLoader(object):
 
     LEN_IDGEN = 6
@@ -24,6 +50,7 @@ class TimLoader(object):
 
     archived_tables = set()
     archive_name = None
+    bulk_size = 1000
     codepage = 'cp850'
     # codepage = 'cp437'
     # etat_registered = "C"¹
@@ -39,11 +66,16 @@ class TimLoader(object):
         self.must_register = []
         self.must_match = {}
         self.duplicate_zip_codes = dict()
+        self.lookup_maps = dict()
+        self.dbf_futures = dict()
+        self.dbf_pending = []
+        self.dbf_executor = None
         for k, v in kwargs.items():
             assert hasattr(self, k)
             setattr(self, k, v)
 
     def finalize(self):
+        self.shutdown_dbf()
         if len(self.duplicate_zip_codes):
             for country, codes in self.duplicate_zip_codes.items():
                 dd.logger.warning(
@@ -55,13 +87,17 @@ class TimLoader(object):
         
         ses = rt.login(self.ROOT.username)
 
-        Journal = rt.models.ledger.Journal
+        # Register all vouchers but check the clearings of the touched
+        # match groups only once at the end.
+        matches = set()
+        ses.deferred_clearings = matches
         dd.logger.info("Register %d vouchers", len(self.must_register))
         failures = 0
         for doc in progress.bar(self.must_register):
             # puts("Registering {0}".format(doc))
             try:
-                doc.register(ses)
+                with transaction.atomic():
+                    doc.register(ses)
             except Exception as e:
                 dd.logger.warning("Failed to register %s : %s ", doc, e)
                 failures += 1
@@ -72,37 +108,108 @@ class TimLoader(object):
         # Given a string `ms` of type 'VKR940095', locate the corresponding
         # movement.
         dd.logger.info("Resolving %d matches", len(self.must_match))
+        wanted = dict()
         for ms, lst in self.must_match.items():
+            idjnl, iddoc = ms[:3], ms[3:]
+            try:
+                year, num = self.year_num(iddoc)
+            except ValueError as e:
+                for (voucher, matching) in lst:
+                    dd.logger.warning("Ignored match %s in %s (%s)" % (
+                        ms, matching, e))
+                continue
+            if self.get_cached(rt.models.ledger.Journal, idjnl, 'ref') is None:
+                for (voucher, matching) in lst:
+                    dd.logger.warning(
+                        "Ignored match %s in %s (invalid JNL)" % (
+                            ms, matching))
+                continue
+            wanted[ms] = (idjnl, year.pk if year else None, num)
+
+        # load the first partner movement of every wanted voucher using
+        # a single query
+        index = dict()
+        if wanted:
+            qs = rt.models.ledger.Movement.objects.filter(
+                partner__isnull=False,
+                voucher__journal__ref__in=set(
+                    [k[0] for k in wanted.values()]),
+                voucher__number__in=set([k[2] for k in wanted.values()]))
+            qs = qs.select_related('voucher__journal').order_by('id')
+            keys = set(wanted.values())
+            for mvt in qs:
+                k = (mvt.voucher.journal.ref, mvt.voucher.year_id,
+                     mvt.voucher.number)
+                if k in keys:
+                    index.setdefault(k, mvt)
+
+        to_register = dict()  # pk -> voucher, in order of appearance
+        for ms, lst in self.must_match.items():
+            k = wanted.get(ms)
+            if k is None:
+                continue
             for (voucher, matching) in lst:
                 if matching.pk is None:
                     dd.logger.warning("Ignored match %s in %s (pk is None)" % (
                         ms, matching))
                     continue
-                idjnl, iddoc = ms[:3], ms[3:]
-                try:
-                    year, num = year_num(iddoc)
-                except ValueError as e:
-                    dd.logger.warning("Ignored match %s in %s (%s)" % (
-                        ms, matching, e))
-                try:
-                    jnl = Journal.objects.get(ref=idjnl)
-                except Journal.DoesNotExist:
-                    dd.logger.warning("Ignored match %s in %s (invalid JNL)" % (
-                        ms, matching))
-                    continue
-                qs = Movement.objects.filter(
-                    voucher__journal=jnl, voucher__number=num,
-                    voucher__year=year, partner__isnull=False)
-                if qs.count() == 0:
+                mvt = index.get(k)
+                if mvt is None:
                     dd.logger.warning("Ignored match %s in %s (no movement)" % (
                         ms, matching))
                     continue
-                matching.match = qs[0]
+                matching.match = mvt
                 matching.save()
-                voucher.deregister(ses)
-                voucher.register(ses)
-                
-        
+                to_register.setdefault(voucher.pk, voucher)
+
+        # re-register the vouchers whose matches have changed, but only
+        # those which are actually registered (the voucher instances
+        # may be stale, so ask the database)
+        registered = set(rt.models.ledger.Voucher.objects.filter(
+            pk__in=list(to_register.keys()),
+            state=rt.models.ledger.VoucherStates.registered).values_list(
+                'pk', flat=True))
+        failures = 0
+        for pk, voucher in to_register.items():
+            if pk not in registered:
+                continue
+            try:
+                with transaction.atomic():
+                    voucher.register_voucher(ses, deferred_clearings=matches)
+            except Exception as e:
+                dd.logger.warning("Failed to re-register %s : %s ", voucher, e)
+                failures += 1
+                if failures > 100:
+                    dd.logger.warning("Abandoned after 100 failures.")
+                    break
+
+        dd.logger.info("Check clearings of %d match groups", len(matches))
+        rt.models.ledger.check_clearings_by_match(matches)
+
+    def get_cached(self, model, key, field='pk'):
+        """Return the instance of `model` whose `field` has the given value,
+        or `None` if there is no such instance.
+
+        At the first call for a given model and field, this loads all
+        instances into a lookup map using a single query.  Instances
+        created afterwards are looked up in the database and then
+        added to the map.
+
+        """
+        m = self.lookup_maps.get((model, field))
+        if m is None:
+            m = dict()
+            for obj in model.objects.all():
+                m[getattr(obj, field)] = obj
+            self.lookup_maps[(model, field)] = m
+        obj = m.get(key)
+        if obj is None:
+            try:
+                obj = model.objects.get(**{field: key})
+            except model.DoesNotExist:
+                return None
+            m[key] = obj
+        return obj
 
     def par_class(self, row):
         # wer eine nationalregisternummer hat ist eine Person, selbst wenn er
@@ -226,16 +333,64 @@ class TimLoader(object):
         if vcl is not None:
             return vcl.create_journal(**kw)
 
-    def load_dbf(self, tableName, row2obj=None):
-        if row2obj is None:
-            row2obj = getattr(self, 'load_' + tableName[-3:].lower())
+    def get_dbf_filename(self, tableName):
         fn = self.dbpath
         if self.archive_name is not None:
             if tableName in self.archived_tables:
                 fn = os.path.join(fn, self.archive_name)
         fn = os.path.join(fn, tableName)
         fn += dd.plugins.tim2lino.dbf_table_ext
+        return fn
+
+    def prefetch_dbf(self, *tableNames):
+        """Decode the given tables (in the given order) in a pool of
+        :attr:`dbf_workers <lino_xl.lib.tim2lino.Plugin.dbf_workers>`
+        worker processes.  :meth:`load_dbf` will then use the decoded
+        records instead of reading the file itself.
+
+        No more than :attr:`dbf_workers` tables are decoded in advance.
+        The next table is submitted each time a prefetched table
+        starts being loaded.
+
+        Does nothing unless both :attr:`dbf_workers
+        <lino_xl.lib.tim2lino.Plugin.dbf_workers>` and :attr:`use_dbfread
+        <lino_xl.lib.tim2lino.Plugin.use_dbfread>` are set.
+
+        """
+        workers = dd.plugins.tim2lino.dbf_workers
+        if not workers or not dd.plugins.tim2lino.use_dbfread:
+            return
+        if self.dbf_executor is None:
+            from concurrent.futures import ProcessPoolExecutor
+            self.dbf_executor = ProcessPoolExecutor(workers)
+        self.dbf_pending.extend(tableNames)
+        self.submit_dbf()
+
+    def submit_dbf(self):
+        workers = dd.plugins.tim2lino.dbf_workers
+        while self.dbf_pending and len(self.dbf_futures) < workers:
+            tableName = self.dbf_pending.pop(0)
+            self.dbf_futures[tableName] = self.dbf_executor.submit(
+                read_dbf, self.get_dbf_filename(tableName))
+
+    def shutdown_dbf(self):
+        """Stop the worker processes started by :meth:`prefetch_dbf`.
+        Tables which have been prefetched but not loaded are dropped.
+        """
+        if self.dbf_executor is not None:
+            for future in self.dbf_futures.values():
+                future.cancel()
+            self.dbf_futures = dict()
+            self.dbf_pending = []
+            self.dbf_executor.shutdown()
+            self.dbf_executor = None
+
+    def load_dbf(self, tableName, row2obj=None):
+        if row2obj is None:
+            row2obj = getattr(self, 'load_' + tableName[-3:].lower())
+        fn = self.get_dbf_filename(tableName)
         count = 0
+        t0 = time.time()
         if dd.plugins.tim2lino.use_dbf_py:
             dd.logger.info("Loading %s...", fn)
             import dbf  # http://pypi.python.org/pypi/dbf/
@@ -262,12 +417,21 @@ class TimLoader(object):
                     #     yield settings.TIM2LINO_LOCAL(tableName, i)
             table.close()
         elif dd.plugins.tim2lino.use_dbfread:
-            dd.logger.info("Loading readonly %s...", fn)
-            from dbfread import DBF
-            dbf = DBF(fn)
-            for record in dbf:
-                d = { f.name.lower() : record[f.name] for f in dbf.fields}
-                d = AttrDict(d)
+            future = self.dbf_futures.pop(tableName, None)
+            if tableName in self.dbf_pending:
+                self.dbf_pending.remove(tableName)
+            if future is None:
+                dd.logger.info("Loading readonly %s...", fn)
+                records = iter_dbf(fn)
+            else:
+                dd.logger.info("Loading prefetched %s...", fn)
+                records = future.result()
+                del future
+                self.submit_dbf()
+                if not self.dbf_futures:
+                    self.shutdown_dbf()
+            for record in records:
+                d = AttrDict(record)
                 try:
                     yield row2obj(d)
                     count += 1
@@ -296,8 +460,13 @@ class TimLoader(object):
                             "Failed to load record %s : %s", dbfrow, e)
             f.close()
 
+        seconds = time.time() - t0
         dd.logger.info(
-            "{} rows have been loaded from {}.".format(count, fn))
+            "{} rows have been loaded from {} ({:.0f} rows per second).".format(
+                count, fn, count / seconds if seconds else count))
+        # make sure that pending objects are saved before the
+        # listeners and the next table look them up
+        yield FlushDeferredObjects
         self.after_load(tableName)
 
     def after_load(self, tableName):
@@ -310,6 +479,8 @@ class TimLoader(object):
     def expand(self, obj):
         if obj is None:
             pass  # ignore None values
+        elif obj is FlushDeferredObjects:
+            yield obj
         elif isinstance(obj, models.Model):
             yield obj
         elif hasattr(obj, '__iter__'):
@@ -325,21 +496,62 @@ class TimLoader(object):
         return []
     
     @classmethod
-    def run(cls):
+    def run(cls, bulk=False):
         """To be used when running this loader from a run script.
 
         Usage example:: 
 
             from lino_xl.lib.tim2lino.spzloader2 import TimLoader
             TimLoader.run()
+
+        When `bulk` is True, consecutive objects of a same model are
+        written using `bulk_create` in batches of :attr:`bulk_size`
+        rows (except for models with multi-table inheritance, which
+        are saved one by one).  Note that this bypasses the `save()`
+        method of these objects.  Pending objects are written at the
+        end of every table and whenever :meth:`objects` yields a
+        :class:`FlushDeferredObjects <lino.utils.dpy.FlushDeferredObjects>`,
+        so that the code which runs after these points can find them
+        in the database.
         
         """
         self = cls(settings.SITE.legacy_data_path)
         counts = {}
+        batch = []
+
+        def flush():
+            c = counts[batch[0].__class__]
+            try:
+                batch[0].__class__.objects.bulk_create(batch)
+                c[0] += len(batch)
+            except Exception as e:
+                dd.logger.warning(
+                    "Failed to bulk_create %d %s : %s",
+                    len(batch), batch[0].__class__, e)
+                for o in batch:
+                    try:
+                        o.save()
+                        c[0] += 1
+                    except Exception as e:
+                        c[1] += 1
+                        dd.logger.warning(
+                            "Failed to save %s : %s", dd.obj2str(o), e)
+            del batch[:]
+
         for o in self.expand(self.objects()):
+            if o is FlushDeferredObjects:
+                if batch:
+                    flush()
+                continue
+            if batch and (batch[0].__class__ is not o.__class__
+                          or len(batch) >= self.bulk_size):
+                flush()
             c = counts.setdefault(o.__class__, [0, 0])
             try:
                 o.full_clean()
+                if bulk and can_bulk_create(o.__class__):
+                    batch.append(o)
+                    continue
                 o.save()
                 c[0] += 1
             except Exception as e:
@@ -349,6 +561,8 @@ class TimLoader(object):
                 
             # temporary:
             # dd.logger.info("Saved %s", dd.obj2str(o))
+        if batch:
+            flush()
         self.finalize()
         if counts:
             for m in sorted(counts.keys()):
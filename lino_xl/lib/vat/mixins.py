@@ -449,6 +449,21 @@ class QtyVatItemBase(VatItemBase):
                 self.set_amount(ar, myround(self.unit_price * self.qty))
 
 
+class MovementGroup(object):
+    """The sum of a group of movements having the same account,
+    VAT class, VAT regime and booking direction.  Behaves like a
+    :class:`lino_xl.lib.ledger.Movement` for the
+    :meth:`collect_from_movement` method of declaration fields.
+
+    """
+    def __init__(self, account, vat_class, vat_regime, dc, amount):
+        self.account = account
+        self.vat_class = vat_class
+        self.vat_regime = vat_regime
+        self.dc = dc
+        self.amount = amount
+
+
 class VatDeclaration(ledger.Declaration):
 
     class Meta:
@@ -472,12 +487,26 @@ class VatDeclaration(ledger.Declaration):
             voucher__journal__must_declare=True)
 
 
+        # The declaration fields look only at account, vat_class,
+        # vat_regime, dc and amount of a movement, so we can group the
+        # movements in SQL and feed the groups to the fields.
         qs = rt.models.ledger.Movement.objects.filter(**flt)
-        qs = qs.order_by('voucher__journal', 'voucher__number')
+        qs = qs.order_by().values('account', 'vat_class', 'vat_regime', 'dc')
+        qs = qs.annotate(
+            total=models.Sum('amount'),
+            first_journal=models.Min('voucher__journal__seqno'),
+            first_number=models.Min('voucher__number'))
+        qs = qs.order_by('first_journal', 'first_number')
+        rows = list(qs)
+        accounts = rt.models.ledger.Account.objects.in_bulk(
+            set([row['account'] for row in rows]))
 
         # print(20170713, qs)
 
-        for mvt in qs:
+        for row in rows:
+            mvt = MovementGroup(
+                accounts[row['account']], row['vat_class'],
+                row['vat_regime'], row['dc'], row['total'])
             for fld in fields:
                 fld.collect_from_movement(
                     self, mvt, sums, payable_sums)
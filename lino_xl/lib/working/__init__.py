@@ -35,6 +35,18 @@ class Plugin(ad.Plugin):
 
     default_reporting_type = 'regular'
 
+    incremental_summaries = False
+    """Whether to update the working time summaries each time a session
+    is saved or deleted.
+
+    When this is `True`, saving a session adjusts only the
+    :class:`UserSummary <lino_xl.lib.working.UserSummary>` and
+    :class:`SiteSummary <lino_xl.lib.working.SiteSummary>` rows of its
+    worker and site for its period.  Changes to a ticket (e.g. moving
+    it to another site) are not tracked and need a
+    :manage:`checksummaries`.
+    """
+
     def post_site_startup(self, site):
         # from .mixins import Workable
         self.ticket_model = site.models.resolve(self.ticket_model)
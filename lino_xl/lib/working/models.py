@@ -3,7 +3,7 @@
 # License: BSD (see file COPYING for details)
 
 from django.conf import settings
-from django.db import models
+from django.db import models, transaction
 from django.utils import timezone
 
 from lino import mixins
@@ -129,6 +129,30 @@ class Session(UserAuthored, Started, Ended, Workable):
 
         super(Session, self).full_clean(*args, **kwargs)
 
+    def save(self, *args, **kwargs):
+        if settings.SITE.loading_from_dump or \
+           not dd.plugins.working.incremental_summaries:
+            return super(Session, self).save(*args, **kwargs)
+        old = None
+        if self.pk is not None:
+            old = self.__class__.objects.select_related(
+                'ticket__ticket_type', 'ticket__site').filter(
+                    pk=self.pk).first()
+        with transaction.atomic():
+            super(Session, self).save(*args, **kwargs)
+            for m in get_session_summaries():
+                m.update_for_session(old, self)
+
+    def delete(self, *args, **kwargs):
+        if settings.SITE.loading_from_dump or \
+           not dd.plugins.working.incremental_summaries:
+            return super(Session, self).delete(*args, **kwargs)
+        with transaction.atomic():
+            rv = super(Session, self).delete(*args, **kwargs)
+            for m in get_session_summaries():
+                m.update_for_session(self, None)
+        return rv
+
     def unused_save(self, *args, **kwargs):
         if not settings.SITE.loading_from_dump:
             if self.start_date is None:
@@ -244,6 +268,10 @@ class ServiceReport(UserAuthored, ContactRelated, Certifiable, DateRange):
 dd.update_field(ServiceReport, 'user', verbose_name=_("Worker"))
 
 
+def get_session_summaries():
+    return (rt.models.working.UserSummary, rt.models.working.SiteSummary)
+
+
 class SummaryBySession(MonthlySlaveSummary):
     # common base for UserSummary and SiteSummary
 
@@ -269,6 +297,109 @@ class SummaryBySession(MonthlySlaveSummary):
             value = getattr(self, k) + d
             setattr(self, k, value)
 
+    @classmethod
+    def get_session_master_id(cls, ses):
+        """Return the primary key of the master to which the given
+        session contributes, or `None`."""
+        raise NotImplementedError()
+
+    @classmethod
+    def get_session_period(cls, ses):
+        if cls.summary_period == 'yearly':
+            return (ses.start_date.year, None)
+        return (ses.start_date.year, ses.start_date.month)
+
+    @classmethod
+    def get_session_contribution(cls, ses):
+        """Return a tuple `(flt, fieldname, duration)` describing what the
+        given session adds to its summary row, or `None` if it adds
+        nothing."""
+        if ses is None or ses.start_date is None:
+            return None
+        d = ses.get_duration()
+        if not d:
+            return None
+        master_id = cls.get_session_master_id(ses)
+        if master_id is None:
+            return None
+        year, month = cls.get_session_period(ses)
+        flt = dict(master_id=master_id, year=year, month=month)
+        k = ses.get_reporting_type().name + '_hours'
+        return (flt, k, d)
+
+    @classmethod
+    def update_for_session(cls, old, new):
+        """Update the summary rows affected by a session that has changed
+        from `old` to `new`.
+
+        `old` is `None` when the session has been created, `new` is
+        `None` when it has been deleted.  Only the rows of the old and
+        the new period and master are touched.  A missing row is
+        computed from scratch.
+
+        """
+        deltas = []
+        c = cls.get_session_contribution(old)
+        if c is not None:
+            deltas.append((c[0], c[1], -1, c[2]))
+        c = cls.get_session_contribution(new)
+        if c is not None:
+            deltas.append((c[0], c[1], 1, c[2]))
+        done = []
+        for flt, k, sign, d in deltas:
+            if flt in done:
+                continue
+            qs = cls.objects.filter(**flt)
+            if qs.count() != 1:
+                for obj in cls.get_for_filter(**flt):
+                    obj.compute_summary_values()
+                done.append(flt)
+                continue
+            obj = qs.get()
+            value = getattr(obj, k) or ZERO_DURATION
+            if sign < 0:
+                value -= d
+            else:
+                value += d
+            setattr(obj, k, value)
+            obj.full_clean()
+            obj.save()
+
+    @classmethod
+    def check_all_summaries(cls):
+        """Rebuild all rows of this summary in a single pass over the
+        sessions instead of running one query per master and period.
+
+        """
+        config = dd.plugins.summaries
+        qs = rt.models.working.Session.objects.filter(
+            start_date__year__gte=config.start_year,
+            start_date__year__lte=config.end_year)
+        qs = qs.select_related('ticket__ticket_type', 'ticket__site')
+        totals = dict()
+        for ses in qs.iterator():
+            c = cls.get_session_contribution(ses)
+            if c is None:
+                continue
+            flt, k, d = c
+            key = (flt['master_id'], flt['year'], flt['month'])
+            values = totals.setdefault(key, dict())
+            values[k] = values.get(k, ZERO_DURATION) + d
+
+        periods = list(cls.get_summary_periods())
+        objects = []
+        for master_id in cls.get_summary_masters().values_list(
+                'pk', flat=True):
+            for year, month in periods:
+                obj = cls(master_id=master_id, year=year, month=month)
+                obj.reset_summary_data()
+                for k, v in totals.get((master_id, year, month), {}).items():
+                    setattr(obj, k, v)
+                objects.append(obj)
+        with transaction.atomic():
+            cls.objects.all().delete()
+            cls.objects.bulk_create(objects, batch_size=1000)
+
 
 class UserSummary(SummaryBySession):
 
@@ -281,9 +412,14 @@ class UserSummary(SummaryBySession):
     delete_them_all = True
     master = dd.ForeignKey('users.User')
 
+    @classmethod
+    def get_session_master_id(cls, ses):
+        return ses.user_id
+
     def get_summary_collectors(self):
         qs = rt.models.working.Session.objects.filter(
             user=self.master)
+        qs = qs.select_related('ticket__ticket_type', 'ticket__site')
         if self.year:
             qs = qs.filter(
                 start_date__year=self.year)
@@ -332,15 +468,24 @@ class SiteSummary(SummaryBySession):
         self.active_tickets = 0
         self.inactive_tickets = 0
 
+    @classmethod
+    def get_session_master_id(cls, ses):
+        if ses.ticket_id is None:
+            return None
+        return ses.ticket.site_id
+
     def get_summary_collectors(self):
         if self.year is None:
             qs = rt.models.tickets.Ticket.objects.filter(site=self.master)
             # qs = qs.filter(
             #     sessions_by_ticket__start_date__year=self.year)
-            yield (self.add_from_ticket, qs)
+            qs = qs.order_by().values('state').annotate(
+                count=models.Count('id'))
+            yield (self.add_from_ticket_state, qs)
 
         qs = rt.models.working.Session.objects.filter(
             ticket__site=self.master)
+        qs = qs.select_related('ticket__ticket_type', 'ticket__site')
         if self.year:
             qs = qs.filter(
                 start_date__year=self.year)
@@ -357,6 +502,16 @@ class SiteSummary(SummaryBySession):
         else:
             self.inactive_tickets += 1
 
+    def add_from_ticket_state(self, row):
+        # row is a dict with the number of tickets per state
+        ts = row['state']
+        if not isinstance(ts, TicketStates.item_class):
+            ts = TicketStates.get_by_value(ts)
+        if ts.active:
+            self.active_tickets += row['count']
+        else:
+            self.inactive_tickets += row['count']
+
 
 
 @dd.receiver(dd.pre_analyze)
@@ -433,8 +588,9 @@ def welcome_messages(ar):
 
     # your open sessions (i.e. those you are busy with)
     qs = Session.objects.filter(end_time__isnull=True)
+    qs = list(qs.select_related('user', 'ticket'))
     working = {me:[E.b(str(_("You are busy with ")))]}
-    if qs.count() == 0:
+    if len(qs) == 0:
         return
     for ses in qs:
         if ses.user not in working:
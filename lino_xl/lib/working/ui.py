@@ -180,6 +180,7 @@ class SessionsByTicket(Sessions):
         active_sessions = []
         session_summaries = E.ul()
         qs = rt.models.working.Session.objects.filter(ticket=obj)
+        qs = qs.select_related('user')
         tot = Duration()
         for ses in qs:
             d = ses.get_duration()
@@ -277,32 +278,67 @@ class MySessionsByDay(MySessionsByDate):
         return super(MySessionsByDay, cls).get_request_queryset(ar, **flt)
 
 
+def add_session(root2tot, ses):
+    d = ses.get_duration() or MIN_DURATION
+    # root = ses.get_root_project()
+    root = ses.get_reporting_type()
+    # if ses.ticket:
+    #     root = ses.ticket.reporting_type
+    # else:
+    #     root = None
+    root2tot[root] = root2tot.get(root, Duration()) + d
+    root2tot[TOTAL_KEY] = root2tot.get(TOTAL_KEY, Duration()) + d
+
+
 def load_sessions(self, sar):
-    self._root2tot = {}
+    self._root2tot = {TOTAL_KEY: Duration()}
     self._tickets = set()
-    grand_tot = Duration()
     for ses in sar:
         self._tickets.add(ses.ticket)
-        d = ses.get_duration() or MIN_DURATION
-        grand_tot += d
-        # root = ses.get_root_project()
-        root = ses.get_reporting_type()
-        # if ses.ticket:
-        #     root = ses.ticket.reporting_type
-        # else:
-        #     root = None
-        tot = self._root2tot.get(root, Duration()) + d
-        self._root2tot[root] = tot
+        add_session(self._root2tot, ses)
+
+
+def get_report_sessions(mi):
+    """Return a queryset of the sessions covered by the given service
+    report."""
+    qs = rt.models.working.Session.objects.all()
+    qs = dd.PeriodEvents.started.add_filter(qs, mi)
+    if mi.user_id is not None:
+        qs = qs.filter(user_id=mi.user_id)
+    return qs.select_related('ticket__ticket_type', 'ticket__site')
+
+
+def load_report_durations(mi, keyfunc):
+    """Return a dict that maps each key returned by `keyfunc` for the
+    sessions of the given service report to its totals per reporting
+    type (and :class:`TOTAL_KEY`).
+
+    This runs a single query for the whole report instead of one
+    query per ticket or site.
 
-    self._root2tot[TOTAL_KEY] = grand_tot
+    """
+    totals = dict()
+    for ses in get_report_sessions(mi).iterator():
+        k = keyfunc(ses)
+        root2tot = totals.get(k)
+        if root2tot is None:
+            root2tot = totals[k] = {TOTAL_KEY: Duration()}
+        add_session(root2tot, ses)
+    return totals
 
 
 def compute_invested_time(obj, **spv):
     # spv = dict(start_date=pv.start_date, end_date=pv.end_date)
-    spv.update(observed_event=dd.PeriodEvents.started)
-    sar = SessionsByTicket.request(master_instance=obj, param_values=spv)
+    qs = rt.models.working.Session.objects.filter(
+        ticket=obj, start_date__isnull=False)
+    if spv.get('start_date'):
+        qs = qs.filter(start_date__gte=spv['start_date'])
+    if spv.get('end_date'):
+        qs = qs.filter(start_date__lte=spv['end_date'])
+    if spv.get('user') is not None:
+        qs = qs.filter(user=spv['user'])
     tot = Duration()
-    for obj in sar:
+    for obj in qs:
         d = obj.get_duration()
         if d is not None:
             tot += d
@@ -480,6 +516,7 @@ class SessionsByReport(Sessions, DurationReport):
         ar.param_values.update(spv)
 
         qs = super(SessionsByReport, self).get_request_queryset(ar)
+        qs = qs.select_related('ticket__ticket_type', 'ticket__site')
         for obj in qs:
             load_sessions(obj, [obj])
             # obj._invested_time = compute_invested_time(
@@ -520,14 +557,11 @@ class TicketsByReport(Tickets, DurationReport):
         pv.update(interesting_for=mi.interesting_for)
         pv.update(observed_event=TicketEvents.working)
 
-        spv = dict(start_date=mi.start_date, end_date=mi.end_date)
-        spv.update(observed_event=dd.PeriodEvents.started)
-        spv.update(user=mi.user)
+        durations = load_report_durations(mi, lambda ses: ses.ticket_id)
         qs = super(TicketsByReport, self).get_request_queryset(ar)
         for obj in qs:
-            sar = SessionsByTicket.request(
-                master_instance=obj, param_values=spv)
-            load_sessions(obj, sar)
+            obj._root2tot = durations.get(
+                obj.pk, {TOTAL_KEY: Duration()})
             # obj._invested_time = compute_invested_time(
             #     obj, start_date=mi.start_date, end_date=mi.end_date,
             #     user=mi.user)
@@ -558,17 +592,14 @@ class SitesByReport(Sites, DurationReport):
         pv.update(interesting_for=mi.interesting_for)
         pv.update(observed_event=TicketEvents.working)
 
-        spv = dict(start_date=mi.start_date, end_date=mi.end_date)
-        spv.update(observed_event=dd.PeriodEvents.started)
-        spv.update(user=mi.user)
         # qs = super(SitesByReport, self).get_request_queryset(ar)
 
+        durations = load_report_durations(mi, lambda ses: ses.ticket.site_id)
         qs = rt.models.tickets.Site.objects.filter(
             company=mi.interesting_for)
         for obj in qs:
-            sar = SessionsBySite.request(
-                master_instance=obj, param_values=spv)
-            load_sessions(obj, sar)
+            obj._root2tot = durations.get(
+                obj.pk, {TOTAL_KEY: Duration()})
             # obj._invested_time = compute_invested_time(
             #     obj, start_date=mi.start_date, end_date=mi.end_date,
             #     user=mi.user)